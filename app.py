@@ -1,30 +1,124 @@
-from shiny import App, render, reactive, ui
+from shiny import App, render, reactive, req, ui
 from shinywidgets import output_widget, render_widget
+from starlette.applications import Starlette
+from starlette.routing import Mount
 
-import os
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, date
 import faicons as fa
 import pandas as pd
-import plotly.express as px
-import plotly.io as pio
-pio.templates.default = "ggplot2"
 
 import helpers as hp
-
-advisors = hp.advisors
-countries = hp.countries
-types = hp.types
-risk_matrix = hp.risk_matrix
-programmes = hp.programmes
-
-calendar = reactive.Value()
-wash_list = reactive.Value()
-country_calls = reactive.Value()
-
-calendar.set(hp.import_calendar())
-wash_list.set(hp.import_wash_list())
-country_calls.set(hp.import_country_calls())
+import figures
+import grid
+import export
+import metrics
+
+## How often (seconds) the sessions check the shared tables for a new version
+POLL_INTERVAL = 1
+
+## Version of each table as seen by the sessions (see hp.TABLES)
+table_versions = {name: reactive.Value(hp.TABLES.version(name)) for name in hp.TABLES.names}
+
+def sync_versions():
+    """Invalidate the outputs of the tables that changed. Setting an unchanged version is a no-op."""
+    for name, version in table_versions.items():
+        version.set(hp.TABLES.version(name))
+
+## End of the notices of the journal (e.g. a save that failed, see journal.py), moved when notices are appended.
+## Each session reads the notices appended since it started (see server)
+notices_offset = reactive.Value(hp.WRITER.journal.notices()[1])
+
+def sync_notices():
+    with reactive.isolate():
+        offset = notices_offset()
+    notices_offset.set(hp.WRITER.journal.notices(offset)[1])
+
+@reactive.effect
+def _():
+    reactive.invalidate_later(POLL_INTERVAL)
+    sync_versions()
+    sync_notices()
+
+def table(name):
+    """Reactive read of a table: loaded on first use, invalidated when its version changes."""
+    @reactive.calc
+    def read():
+        table_versions[name].get()
+        return hp.TABLES.get(name)
+    return read
+
+advisors = table('advisors')
+countries = table('countries')
+types = table('types')
+risk_matrix = table('risk_matrix')
+programmes = table('programmes')
+calendar = table('calendar')
+country_calls = table('country_calls')
+
+def derived(func):
+    """Reader of a memoized helper (see hp.cache), invalidated when one of the tables it is computed from changes."""
+    def reader(*args):
+        for name in func.tables:
+            table_versions[name]()
+        return func(*args)
+    return reader
+
+## Derived tables shared by all sessions
+days_by_type = derived(hp.days_by_type)
+advisor_work_calendars = derived(hp.advisor_work_calendars)
+active_programmes = derived(hp.active_programmes)
+calls_by = derived(hp.calls_by)
+countries_by_focal = derived(hp.countries_by_focal)
+calendar_display = derived(hp.calendar_display)
+calendar_rows = derived(hp.calendar_rows)
+calls_display = derived(hp.calls_display)
+calls_rows = derived(hp.calls_rows)
+calendar_facets = derived(hp.FACETS['calendar'])
+calls_facets = derived(hp.FACETS['country_calls'])
+
+def facet_choices(facet, update, extra=('All',)):
+    """
+    Choices of a filter control rendered once per session, kept up to date in place: update(choices, previous)
+    is only called when facet() (distinct values of a column, see hp.FACETS) changes, not on every save.
+    Call from the server, returns the reader of the choices to render the control with.
+    Nothing is read before the control is rendered, so the table of a panel that is not open is not loaded.
+    """
+    shown = reactive.Value(None)
+
+    @metrics.effect
+    def _():
+        previous = shown()
+        if previous is None:
+            return
+        values = facet()
+        if values != previous:
+            shown.set(values)
+            with reactive.isolate():
+                update([*values, *extra], previous)
+
+    def choices():
+        with reactive.isolate():
+            values = facet()
+        shown.set(values)
+        return [*values, *extra]
+    return choices
+
+def kept(selected, choices, default='All'):
+    """The selection of a select if it is still one of its choices, otherwise default."""
+    return selected if selected in [str(choice) for choice in choices] else default
+
+## Figures shared by all sessions (see figures.py)
+calendar_timeline = derived(figures.calendar_timeline)
+workload_heatmap = derived(figures.workload_heatmap)
+days_by_type_bar = derived(figures.days_by_type_bar)
+allocation_map = derived(figures.allocation_map)
+allocation_bar = derived(figures.allocation_bar)
+risk_matrix_figure = derived(figures.risk_matrix_map)
+programmes_map = derived(figures.programmes_map)
+programmes_bar = derived(figures.programmes_bar)
+calls_by_country_bar = derived(figures.calls_by_country_bar)
+calls_by_advisor_bar = derived(figures.calls_by_advisor_bar)
 
 app_ui = ui.page_navbar(
     ## TO DO: personal styles
@@ -59,8 +153,18 @@ app_ui = ui.page_navbar(
                         ui.row(ui.column(6, ui.output_ui('table_advisor_select'))),
                         ui.row(ui.column(6, ui.output_ui('table_year_select'))),
                         ui.row(ui.column(6, ui.output_ui('table_type_select'))),
+                        ui.input_action_link('audit_calendar', 'Check for overlapping entries'),
                     ),
-                    ui.column(8, ui.output_data_frame('calendar_df'))
+                    ui.column(
+                        8,
+                        ui.output_data_frame('calendar_df'),
+                        ui.div(
+                            ui.input_action_button('calendar_prev_page', '‹', class_='btn btn-sm btn-outline-secondary'),
+                            ui.output_text('calendar_pager', inline=True),
+                            ui.input_action_button('calendar_next_page', '›', class_='btn btn-sm btn-outline-secondary'),
+                            class_='d-flex align-items-center gap-2 mt-2'
+                        ),
+                    )
                 )
             ),
             ui.card(
@@ -73,7 +177,28 @@ app_ui = ui.page_navbar(
                         full_screen=True
                     ),
                 ),
-                
+                ui.row(
+                    ui.column(9,
+                        ui.input_radio_buttons(
+                            id='workload_freq',
+                            label='Workload by:',
+                            choices={'W': 'Week', 'M': 'Month'},
+                            selected='W',
+                            inline=True
+                        ),
+                        output_widget('plot_workload_heatmap'),
+                    ),
+                    ui.column(3,
+                        ui.input_date_range(
+                            id='free_range',
+                            label='Who is free?',
+                            start=datetime.today(),
+                            end=datetime.today() + timedelta(days=4),
+                            format='dd-M-yyyy'
+                        ),
+                        ui.output_ui('free_advisors'),
+                    ),
+                ),
             ),
             col_widths=12
         ),
@@ -84,12 +209,7 @@ app_ui = ui.page_navbar(
         'Country Allocation',
         ui.layout_sidebar(
             ui.sidebar(
-                ui.input_checkbox_group(
-                    id='map_region_filter',
-                    label='Filter by:',
-                    choices=[region for region in countries.Continent.unique()],
-                    selected=[region for region in countries.Continent.unique()]
-                )
+                ui.output_ui('map_region_filter')
             ),
             ui.layout_columns(
                 ui.card(
@@ -163,7 +283,16 @@ app_ui = ui.page_navbar(
                         ui.row(ui.column(6, ui.output_ui('call_country_select')),),
                         ui.row(ui.column(6, ui.output_ui('call_year_select')),),
                     ),
-                    ui.column(8, ui.output_data_frame('calls_df'),)
+                    ui.column(
+                        8,
+                        ui.output_data_frame('calls_df'),
+                        ui.div(
+                            ui.input_action_button('calls_prev_page', '‹', class_='btn btn-sm btn-outline-secondary'),
+                            ui.output_text('calls_pager', inline=True),
+                            ui.input_action_button('calls_next_page', '›', class_='btn btn-sm btn-outline-secondary'),
+                            class_='d-flex align-items-center gap-2 mt-2'
+                        ),
+                    )
                 )
             ),
             ui.card(
@@ -215,134 +344,200 @@ app_ui = ui.page_navbar(
         'Files',
         ui.markdown('Link to the database.'),
         ui.markdown('You can view, print and download the file in excel format.'),
-        ui.HTML(f'<a href="{hp.url}" target="_blank">Click here</a>')
+        ui.HTML(f'<a href="{hp.url}" target="_blank">Click here</a>'),
+        ui.markdown('Or download a copy of the current data:'),
+        ui.HTML(
+            '<a href="export/xlsx" download>Excel</a> | '
+            '<a href="export/parquet" download>Parquet (zip)</a> | '
+            '<a href="export/csv" download>CSV (zip)</a>'
+        ),
     ),
     title='WASH SAL Dashboard',
 )
 
 
 def server(input, output, session):
+    ##
+    ## Saving
+    ##
+    ## Offset of the notices not shown yet: those appended before the session started were meant for other sessions
+    notices_seen = [hp.WRITER.journal.notices()[1]]
+
+    @metrics.effect
+    def _():
+        if notices_offset() == notices_seen[0]:
+            return
+        notices, notices_seen[0] = hp.WRITER.journal.notices(notices_seen[0])
+        for notice in notices:
+            tables = ', '.join(notice['tables'])
+            if notice['kind'] == 'failed':
+                ui.notification_show(
+                    f'The latest changes to {tables} could not be saved ({notice["error"]}). '
+                    f'They are kept and saving will be retried.',
+                    type='error', duration=None, id='save_failed'
+                )
+            elif notice['kind'] == 'saved':
+                ui.notification_remove('save_failed')
+                ui.notification_show(f'The pending changes to {tables} are now saved.', type='message')
+            elif notice['kind'] == 'rejected' and notice['origin'] == session.id:
+                action = 'deletion of' if notice['op'] == 'delete' else 'change to'
+                ui.notification_show(
+                    f'Your {action} {len(notice["labels"])} row(s) of {tables} was not saved: '
+                    f'they were changed by someone else in the meantime. Please check the table and retry.',
+                    type='error', duration=None
+                )
+
     ##
     ## Calendar - Calendar
     ##
+    def update_advisor_filter(choices, previous):
+        ## Keep the advisors the user selected, new advisors are shown
+        selected = [a for a in input.calendar_advisor_filter_() if a in choices] + [a for a in choices if a not in previous]
+        ui.update_checkbox_group('calendar_advisor_filter_', choices=choices, selected=selected, inline=True)
+
+    calendar_advisors = facet_choices(lambda: calendar_facets()['advisor'], update_advisor_filter, extra=())
+
+    @metrics.output
     @render.ui
     def calendar_advisor_filter():
-        data = calendar.get()
+        advisors = calendar_advisors()
         return ui.input_checkbox_group(
                     id='calendar_advisor_filter_',
                     label='Filter by:',
-                    choices=[advisor for advisor in data.advisor.unique()],
-                    selected=[advisor for advisor in data.advisor.unique()],
+                    choices=advisors,
+                    selected=advisors,
                     inline=True
                 )
 
+    @metrics.output
     @render.ui
     def calendar_date_range():
-        data = calendar.get()
+        data = calendar()
+        ## The default range is on the steps of the slider, so that the first view of every session is the same
+        start, end = figures.default_calendar_range(data.start_date.min())
         return ui.input_slider(
                     id='calendar_date_range_',
                     label='',
                     min=data.start_date.min(),
                     max=datetime.today() + timedelta(weeks=52),
-                    value=[datetime.today() - timedelta(weeks=2), datetime.today() + timedelta(weeks=6)],
+                    value=[datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time())],
                     step=14,
                     ticks=True,
                     time_format='%d-%b-%Y'
                 ),
 
+    ## Range shown by the timeline, set by the slider or by panning / zooming the plot
+    calendar_view = reactive.Value(None)
+    ## Dates of the events plotted in the timeline, a bit larger than the shown range (see figures.calendar_window)
+    calendar_window = reactive.Value(None)
+
+    @metrics.effect
+    def _():
+        try:
+            range_x_start, range_x_end = input.calendar_date_range_()
+        except (TypeError, ValueError):
+            return
+        calendar_view.set((pd.Timestamp(range_x_start), pd.Timestamp(range_x_end)))
+
+    @metrics.effect
+    def _():
+        ## Move the window when the shown range leaves it (the timeline is then rebuilt with the events of the new window)
+        view = calendar_view()
+        if view is not None:
+            with reactive.isolate():
+                calendar_window.set(figures.calendar_window(*view, calendar_window()))
+
+    @metrics.output
     @render_widget
     def plot_calendar():
-        data = calendar.get()
-        filtered_calendar = data[data.advisor.isin(input.calendar_advisor_filter_())]
-        ## If remarks is nan it creates an error when plotting (cannot create JSON object from nan)
-        ## TO DO this is a temporary workaround, find another way to fix this!
-        filtered_calendar['remarks'] = filtered_calendar.remarks.fillna(' ')
+        ## Only rebuilt when the data or the window change, the shown range and the advisor filter are patched in place (below)
+        data = calendar()
+        window = req(calendar_window())
+        advisors = tuple(sorted(data.advisor.dropna().unique()))
+        return calendar_timeline(advisors, *window, date.today())
 
-        ## Ensure the dataframe is valid
-        if filtered_calendar.empty or filtered_calendar[['start_date', 'end_date']].isna().any().any():
-            return None  # Return an empty plot or suitable default
+    @metrics.effect
+    def _():
+        widget = plot_calendar.widget
+        view = calendar_view()
+        if view is not None:
+            figures.set_x_range(widget, *view)
 
-        ## Handle calendar_date_range
-        try:
-            range_x_start, range_x_end = input.calendar_date_range_()
-            ## Transform date range into a datetime object to be used in the range_x of px.timeline
-            range_x_start = datetime(range_x_start.year, range_x_start.month, range_x_start.day)
-            range_x_end = datetime(range_x_end.year, range_x_end.month, range_x_end.day)
-            assert range_x_start is not None and range_x_end is not None
-        except (TypeError, AssertionError):
-            range_x_start, range_x_end = None, None  # Default values if invalid
-
-        ## eEnsure that single days events are represented with a visible width
-        single_day_mask = filtered_calendar.start_date == filtered_calendar.end_date
-        filtered_calendar.loc[single_day_mask, 'end_date'] = filtered_calendar.end_date + timedelta(hours=11, minutes=59)
-
-        hover_data={
-            'start_date':False,
-            'end_date':False,
-            'advisor':False,
-            'type':False,
-            'from':filtered_calendar.start_date.apply(hp.date_prettify),
-            'to':filtered_calendar.end_date.apply(hp.date_prettify)
-        }
-
-        fig = px.timeline(
-            data_frame=filtered_calendar,
-            x_start='start_date',
-            x_end='end_date',
-            y='advisor',
-            color='type',
-            color_discrete_map=dict(zip(types, hp.TYPE_PALETTE)),
-            hover_name='type',
-            hover_data=hover_data,
-            text='remarks',
-            range_x=[range_x_start, range_x_end] if range_x_start and range_x_end else None,
-            labels={'type':'', 'advisor':''}
-        )
-        fig.update_xaxes(
-            tickformat='%d-%b', dtick=86400000.0*7,
-            rangeslider_visible=False,
-            # rangeselector=dict(
-            #     buttons=list([
-            #         dict(count=1, label='1M', step='month', stepmode='backward'),
-            #         dict(count=3, label='3M', step='month', stepmode='backward'),
-            #         dict(count=6, label='6M', step='month', stepmode='backward'),
-            #         # dict(count=1, label='YTD', step='year', stepmode='todate'),
-            #         dict(count=1, label='1Y', step='year', stepmode='backward'),
-            #         dict(step='all')
-            #     ])
-            # )
-        )
-        fig.update_traces(textposition='inside')
-        fig.add_vline(x=datetime.today(), line_dash='dot', line_width=3, opacity=1, line_color='black')
+    @metrics.effect
+    def _():
+        ## Panning or zooming in the browser updates the shown range, which may move the window
+        def on_range(xaxis, x_range):
+            if x_range is not None:
+                calendar_view.set((pd.Timestamp(x_range[0]), pd.Timestamp(x_range[1])))
+        plot_calendar.widget.layout.xaxis.on_change(on_range, 'range')
 
-        return fig
+    @metrics.effect
+    def _():
+        figures.show_categories(plot_calendar.widget, input.calendar_advisor_filter_())
 
     ##
     ## Calendar - Data
     ##
-    @render.data_frame
-    def calendar_df():
-        df = calendar.get()
-        data = df.copy()
+    ## The grid only receives the current page: the rows are filtered and sorted on the server (see grid.py)
+    calendar_grid = grid.Pager()
+    calendar_page_number = reactive.Value(0)
+    calendar_columns = reactive.Value(None)
+
+    @reactive.calc
+    def calendar_query():
+        ## Filters of the selects plus the sort and the column filters of the grid header
+        return (
+            input.table_year_select_(), input.table_advisor_select_(), input.table_type_select_(),
+            grid.sort_key(calendar_df), grid.filter_key(calendar_df),
+        )
 
-        ## Apply filters while preserving original indices
-        if input.table_year_select_() != 'All':
-            data = data[data.end_date.dt.year == int(input.table_year_select_())]
-        if input.table_advisor_select_() != 'All':
-            data = data[data.advisor==input.table_advisor_select_()]
-        if input.table_type_select_() != 'All':
-            data = data[data.type==input.table_type_select_()]
+    @reactive.calc
+    def calendar_page():
+        return calendar_grid.page(calendar_display(), calendar_rows(*calendar_query()), calendar_page_number())
 
-        data['start_date'] = data.start_date.dt.strftime('%d-%m-%Y')#apply(hp.date_prettify)
-        data['end_date'] = data.end_date.dt.strftime('%d-%m-%Y')#.apply(hp.date_prettify)
+    @metrics.effect
+    def _():
+        calendar_columns.set(tuple(calendar_display().columns))
 
+    @metrics.output
+    @render.data_frame
+    def calendar_df():
+        ## Rendered once (re-rendering would reset the sort and filters of the grid), the pages are sent below
+        columns = req(calendar_columns())
+        with reactive.isolate():
+            page = calendar_grid.first(calendar_page, columns)
         return render.DataGrid(
-            data.sort_index(ascending=False),
+            page,
             width='fit-content',
             selection_mode='rows',
             height="300px"
         )
 
+    @metrics.effect
+    async def _():
+        await calendar_grid.show(calendar_df, calendar_page())
+
+    @metrics.output
+    @render.text
+    def calendar_pager():
+        return calendar_grid.describe(calendar_rows(*calendar_query()), calendar_page_number())
+
+    @metrics.effect
+    @reactive.event(calendar_query)
+    def _():
+        calendar_page_number.set(0)
+
+    @metrics.effect
+    @reactive.event(input.calendar_prev_page)
+    def _():
+        calendar_page_number.set(max(calendar_page_number() - 1, 0))
+
+    @metrics.effect
+    @reactive.event(input.calendar_next_page)
+    def _():
+        calendar_page_number.set(min(calendar_page_number() + 1, calendar_grid.pages(calendar_rows(*calendar_query())) - 1))
+
+    @metrics.output
     @render.ui
     def add_calendar_btn():
         return ui.input_action_button(
@@ -352,6 +547,7 @@ def server(input, output, session):
             icon=fa.icon_svg('calendar-plus')
         )
 
+    @metrics.output
     @render.ui
     def delete_calendar_btn():
         return ui.input_action_button(
@@ -361,6 +557,7 @@ def server(input, output, session):
                     class_='btn btn-outline-danger',
                 )
 
+    @metrics.output
     @render.ui
     def edit_calendar_btn():
         return ui.input_action_button(
@@ -370,37 +567,46 @@ def server(input, output, session):
             icon=fa.icon_svg('pen-to-square'),
         )
 
+    ## The filters are rendered once, their choices are updated in place when the advisors, years or types change
+    table_advisors = facet_choices(
+        lambda: calendar_facets()['advisor'],
+        lambda choices, _: ui.update_select('table_advisor_select_', choices=choices, selected=kept(input.table_advisor_select_(), choices))
+    )
+    table_years = facet_choices(
+        lambda: calendar_facets()['year'],
+        lambda choices, _: ui.update_select('table_year_select_', choices=choices, selected=kept(input.table_year_select_(), choices))
+    )
+    table_types = facet_choices(
+        lambda: calendar_facets()['type'],
+        lambda choices, _: ui.update_select('table_type_select_', choices=choices, selected=kept(input.table_type_select_(), choices))
+    )
+
+    @metrics.output
     @render.ui
     def table_advisor_select():
-        data = calendar.get()
-        advisors = [advisor for advisor in data.advisor.unique()]
-        advisors.append('All')
         return ui.input_select(
             id='table_advisor_select_',
             label='Filter by advisor:',
-            choices = advisors,
+            choices = table_advisors(),
             selected='All',
             width='150px'
         )
 
+    @metrics.output
     @render.ui
     def table_year_select():
-        data = calendar.get()
-        years = [yr for yr in data.end_date.dt.year]
-        years.append('All')
         return ui.input_select(
                     id='table_year_select_',
                     label='Filter by year (end):',
-                    choices=years,
+                    choices=table_years(),
                     selected='All',
                     width='150px'
                 )
     
+    @metrics.output
     @render.ui
     def table_type_select():
-        data = calendar.get()
-        types = [type for type in data.type.unique()]
-        types.append('All')
+        types = table_types()
         return ui.input_select(
                     id='table_type_select_',
                     label='Filter by type:',
@@ -409,15 +615,16 @@ def server(input, output, session):
                     width='150px'
                 )
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.add_to_calendar)
     def _():
+        form = hp.calendar_form()
         m = ui.modal(
-            hp.CALENDAR_FORM['advisor'],
-            hp.CALENDAR_FORM['type'],
-            hp.CALENDAR_FORM['start_date'],
-            hp.CALENDAR_FORM['end_date'],
-            hp.CALENDAR_FORM['remarks'],
+            form['advisor'],
+            form['type'],
+            form['start_date'],
+            form['end_date'],
+            form['remarks'],
             ui.div(
                 ui.input_action_button('submit_add_cal', 'Submit', class_='btn btn-primary'),
                 class_='d-flex justify-content-end'
@@ -432,26 +639,104 @@ def server(input, output, session):
         #     print(f'{e}')
         ui.modal_show(m)
 
-    @reactive.effect
+    ## Calendar entry waiting for confirmation because it overlaps other entries: (add or edit, row, base)
+    pending_cal_entry = reactive.Value(None)
+    ## Row being edited and its version when the form was opened: (index, version)
+    editing_cal_row = reactive.Value(None)
+
+    def calendar_entry(index=None):
+        """Calendar row from the form inputs, with the same columns as the calendar and datetime dates."""
+        row = pd.DataFrame([{k: input[f'cal_{k}']() for k in hp.CALENDAR_FIELDS}])
+        ## Make sure that the new dataframe has the same columns as the original one and that the dates are datetime objects
+        row = row.reindex(columns=calendar().columns)
+        row['start_date'] = pd.to_datetime(row.start_date, dayfirst=True, errors='raise', format='mixed')
+        row['end_date'] = pd.to_datetime(row.end_date, dayfirst=True, errors='raise', format='mixed')
+        if index is not None:
+            row.index = [index]
+        return row
+
+    def check_calendar_entry(action, row, base=None):
+        """Return True if the entry can be saved, otherwise tell the user why (invalid dates or double booking)."""
+        entry = row.iloc[0]
+        if entry.end_date < entry.start_date:
+            ui.notification_show('The end date is before the start date, please correct it.', type='error')
+            return False
+        exclude = row.index if action == 'edit' else ()
+        conflicts = hp.INTERVALS.update(calendar()).conflicts(entry.advisor, entry.start_date, entry.end_date, exclude)
+        if not conflicts:
+            return True
+
+        pending_cal_entry.set((action, row, base))
+        m = ui.modal(
+            ui.markdown(f'This entry overlaps {len(conflicts)} other entr{"y" if len(conflicts) == 1 else "ies"} for {entry.advisor}:'),
+            ui.markdown(hp.describe_calendar_rows(calendar().loc[conflicts])),
+            ui.div(
+                ui.input_action_button('cancel_cal_entry', 'Cancel', class_='btn btn-secondary me-2'),
+                ui.input_action_button('confirm_cal_entry', 'Save anyway', class_='btn btn-warning'),
+                class_='d-flex justify-content-end'
+            ),
+            easy_close=False,
+            footer=None,
+            title='Overlapping entries',
+        )
+        ui.modal_show(m)
+        return False
+
+    def save_calendar_entry(action, row, base=None):
+        ## Save the row to the calendar (saved to file in the background) and update the reactive values
+        try:
+            if action == 'add':
+                hp.add_rows('calendar', row, origin=session.id)
+                ui.notification_show(f'New entry for {row.advisor.iloc[0]} added to the calendar and queued for saving, thank you!', type='message')
+            else:
+                hp.update_rows('calendar', row, base, origin=session.id)
+                ui.notification_show(f'Updated entry for {row.advisor.iloc[0]}, queued for saving, thank you!', type='message')
+        except hp.Conflict as e:
+            ui.notification_show(str(e), type='error', duration=10)
+        sync_versions()
+
+    @metrics.effect
     @reactive.event(input.submit_add_cal)
     def _():
-        data = calendar.get()
         try:
-            new_row = pd.DataFrame([{k: input[f'cal_{k}']() for k in hp.CALENDAR_FORM.keys()}])
-            ## Make sure that the new dataframe has the same columns as the original one and that the dates are datetime objects
-            new_row = new_row.reindex(columns=data.columns)
-            new_row['start_date'] = pd.to_datetime(new_row.start_date, dayfirst=True, errors='raise', format='mixed')
-            new_row['end_date'] = pd.to_datetime(new_row.end_date, dayfirst=True, errors='raise', format='mixed')
-            ## Add the new row to the existing dataframe and update the reactive value
-            updated_cal = pd.concat([data, new_row], ignore_index=True)
-            calendar.set(updated_cal)
-            ## Save the calendar to file
-            hp.update_calendar(updated_cal)
-            ui.notification_show(f'New entry for {input.cal_advisor()} added to the calendar, file saved, thank you!', type='message')
+            new_row = calendar_entry()
+            if check_calendar_entry('add', new_row):
+                save_calendar_entry('add', new_row)
+        except Exception as e:
+            ui.notification_show(f'Oops, something went wrong: {str(e)}. Retry!', type='error')
+
+    @metrics.effect
+    @reactive.event(input.confirm_cal_entry)
+    def _():
+        ui.modal_remove()
+        if pending_cal_entry() is None:
+            return
+        action, row, base = pending_cal_entry()
+        pending_cal_entry.set(None)
+        try:
+            save_calendar_entry(action, row, base)
         except Exception as e:
             ui.notification_show(f'Oops, something went wrong: {str(e)}. Retry!', type='error')
 
-    @reactive.effect
+    @metrics.effect
+    @reactive.event(input.cancel_cal_entry)
+    def _():
+        ui.modal_remove()
+        pending_cal_entry.set(None)
+
+    @metrics.effect
+    @reactive.event(input.audit_calendar)
+    def _():
+        overlapping = hp.INTERVALS.update(calendar()).audit()
+        m = ui.modal(
+            ui.markdown(hp.describe_calendar_rows(overlapping) if len(overlapping) else 'No overlapping entries, well done!'),
+            easy_close=True,
+            title=f'{len(overlapping)} overlapping entries',
+            size='l',
+        )
+        ui.modal_show(m)
+
+    @metrics.effect
     @reactive.event(input.delete_from_calendar_)
     def _():
         # Get the index of the selected row(s)
@@ -464,12 +749,16 @@ def server(input, output, session):
         ## Map the selected row indices from the filtered view to the original dataframe indices
         selected_original_indices = filtered_df.iloc[[int(r) for r in selected_rows]].index.tolist()
         # Get the original dataframe and remove the selected rows using their original indices
-        updated_data = calendar.get().drop(selected_original_indices)
-        calendar.set(updated_data)
-        hp.update_calendar(updated_data)
-        ui.notification_show(f'Removing the following row(s): {[id for id in selected_original_indices]}', type='message')
+        try:
+            hp.delete_rows('calendar', selected_original_indices, hp.row_versions(calendar(), selected_original_indices), origin=session.id)
+        except hp.Conflict as e:
+            sync_versions()
+            ui.notification_show(str(e), type='error', duration=10)
+            return
+        sync_versions()
+        ui.notification_show(f'Removing the following row(s), queued for saving: {[id for id in selected_original_indices]}', type='message')
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.edit_row_)
     def _():
         ## Get the indices of the selected rows in the current view (filtered or unfiltered)
@@ -479,12 +768,13 @@ def server(input, output, session):
             ui.notification_show('Please select at least one and only one row for editing', type='error')
             return
         
+        form = hp.calendar_form()
         m = ui.modal(
-            hp.CALENDAR_FORM['advisor'],
-            hp.CALENDAR_FORM['type'],
-            hp.CALENDAR_FORM['start_date'],
-            hp.CALENDAR_FORM['end_date'],
-            hp.CALENDAR_FORM['remarks'],
+            form['advisor'],
+            form['type'],
+            form['start_date'],
+            form['end_date'],
+            form['remarks'],
             ui.div(
                 ui.input_action_button('submit_edit_cal', 'Submit', class_='btn btn-primary'),
                 class_='d-flex justify-content-end'
@@ -499,8 +789,9 @@ def server(input, output, session):
         original_index = filtered_df.iloc[int(selected_rows[0])].name
 
         ## Get the original row data using the mapped index
-        original_df = calendar.get()
+        original_df = calendar()
         row_to_edit = original_df.loc[[original_index]]
+        editing_cal_row.set((original_index, hp.row_versions(original_df, [original_index])[0]))
 
         ui.update_select('cal_advisor', selected=row_to_edit.advisor.iloc[0])
         ui.update_radio_buttons('cal_type', selected=row_to_edit.type.iloc[0])
@@ -510,51 +801,68 @@ def server(input, output, session):
 
         ui.modal_show(m)
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.submit_edit_cal)
     def _():
-        ui.modal_remove()
-        selected_rows = calendar_df.cell_selection()['rows']
-        filtered_df = calendar_df.data_view()
-        original_index = filtered_df.iloc[int(selected_rows[0])].name
-
-        ## Update specific row using the original index
-        updated_row = pd.DataFrame([{k: input[f'cal_{k}']() for k in hp.CALENDAR_FORM.keys()}])
-        original_df = calendar.get()
-        updated_row = updated_row.reindex(columns=original_df.columns)
-        updated_row.index = [original_index]
+        ## The row as it was when the form was opened, the save is rejected if someone else changed it since
+        original_index, version = editing_cal_row()
 
         try:
-            original_df.update(updated_row)
-            calendar.set(original_df)
-            hp.update_calendar(original_df)
-            ui.notification_show(f'Updated entry for {updated_row.advisor.iloc[0]}, thank you!', type='message')   
+            ## Update specific row using the original index
+            updated_row = calendar_entry(original_index)
+            if check_calendar_entry('edit', updated_row, [version]):
+                ui.modal_remove()
+                save_calendar_entry('edit', updated_row, [version])
         except Exception:
+            ui.modal_remove()
             ui.notification_show(f'Oops, something went wrong. Retry!', type='error')
 
     ##
     ## Calendar - Stats
     ##
+    stats_years = facet_choices(
+        lambda: calendar_facets()['year'],
+        lambda choices, _: ui.update_select('select_year_', choices=choices, selected=kept(input.select_year_(), choices, datetime.today().year))
+    )
+
+    @metrics.output
     @render.ui
     def select_year():
-        data = calendar.get()
-        years = [yr for yr in data.end_date.dt.year]
-        years.append('All')
         return ui.input_select(
                     id='select_year_',
                     label='Filter by year:',
-                    choices=years,
+                    choices=stats_years(),
                     selected=datetime.today().year,
                     width='150px'
                 )
 
+    @reactive.calc
+    def occupancy():
+        ## The shared matrix is updated incrementally with the changes to the calendar
+        return hp.OCCUPANCY.update(calendar(), advisor_work_calendars())
+
+    @metrics.output
+    @render_widget
+    def plot_workload_heatmap():
+        return workload_heatmap(str(input.select_year_()), input.workload_freq())
+
+    @metrics.output
+    @render.ui
+    def free_advisors():
+        start, end = input.free_range()
+        if start is None or end is None or end < start:
+            return ui.markdown('Select a valid period.')
+        free = occupancy().free_advisors(start, end)
+        return ui.markdown(', '.join(free) if free else 'Nobody is free during this period.')
+
+    @metrics.output
     @render.data_frame
     def advisor_occupancy_df():
         year = input.select_year_()
-        df = calendar.get()
-        data = hp.pcg_days_by_type(df.copy(), year)
-        data['pcg_busdays'] = (data.pcg_busdays/100).map('{:.2%}'.format)
-        data.columns = ['Advisor', 'Type', '# Days', '%']
+        ## The statistics are shared by all sessions, format a new frame (copy-on-write, see tables.py)
+        data = days_by_type(year)
+        data = data.assign(pcg_busdays=(data.pcg_busdays/100).map('{:.2%}'.format))
+        data = data.set_axis(['Advisor', 'Type', '# Days', '%'], axis=1)
 
         return render.DataTable(
             data.sort_index(ascending=False),
@@ -562,61 +870,43 @@ def server(input, output, session):
             selection_mode='rows'
         )
 
+    @metrics.output
     @render_widget
     def plot_bar_days_bytype():
-        year = input.select_year_()
-        tmp = calendar.get()
-        ## calculate the percentages on a copy of the dataframe so that the original is not changed
-        # data = hp.pcg_days_by_type(tmp.copy(), int(year))
-        data = hp.pcg_days_by_type(tmp.copy(), year)
-
-        fig = px.bar(
-            data_frame = data,
-            x='total_busdays',
-            y='type',
-            color='advisor',
-            color_discrete_map=dict(zip(sorted(advisors.short_name), hp.ADVISOR_PALETTE)),
-            barmode='group',
-            labels={'type': '', 'advisor':'', 'total_busdays': 'Total business days'}
-        )
-        fig.update_layout(legend=dict(y=1.1, orientation='h'))
-
-        return fig
+        return days_by_type_bar(str(input.select_year_()))
 
     ###
     ### Country Allocation ###
     ###
+    @metrics.output
+    @render.ui
+    def map_region_filter():
+        data = countries()
+        return ui.input_checkbox_group(
+                    id='map_region_filter_',
+                    label='Filter by:',
+                    choices=[region for region in data.Continent.unique()],
+                    selected=[region for region in data.Continent.unique()]
+                )
+
+    @metrics.output
     @render_widget
     def plot_allocation_map():
-        filtered_countries = countries[countries.Continent.isin(input.map_region_filter())]
-
-        hover_data = {
-            'ta_focal': False,
-            'ISO 3166 alpha3': False,
-            'Focal TA': filtered_countries.ta_focal,
-        }
-
-        fig = px.choropleth(
-            data_frame=filtered_countries,
-            locations='ISO 3166 alpha3',
-            color='ta_focal',
-            # color_discrete_sequence=hp.ADVISOR_PALETTE,
-            color_discrete_map=dict(zip(sorted(advisors.short_name), hp.ADVISOR_PALETTE)),
-            hover_name='CIA Name',
-            hover_data=hover_data,
-            labels={'ta_focal': 'Focal Point'},
-        )
-        fig.update_geos(fitbounds='locations')
-        fig.update_layout(legend=dict(y=1.1, orientation='h'))
+        ## Only rebuilt when the data changes, the region filter is patched in place (below)
+        return allocation_map(tuple(sorted(countries().Continent.dropna().unique())))
 
-        return fig
-    
+    @metrics.effect
+    def _():
+        widget = plot_allocation_map.widget
+        data = countries()
+        figures.filter_points(widget, set(data.loc[data.Continent.isin(input.map_region_filter_()), 'ISO 3166 alpha3']))
+
+    @metrics.output
     @render.data_frame
     def countries_df():
-        data = countries.copy()
-        data.columns = ['Country', 'ISO', 'Continent', 'TA Focal', 'TA Support']
+        data = countries().set_axis(['Country', 'ISO', 'Continent', 'TA Focal', 'TA Support'], axis=1)
         # data = data.groupby(['TA Focal'])
-        filtered_data = data[data.Continent.isin(input.map_region_filter())].drop(['ISO'], axis=1)
+        filtered_data = data[data.Continent.isin(input.map_region_filter_())].drop(['ISO'], axis=1)
 
         return render.DataTable(
             filtered_data.sort_values(['TA Focal', 'Continent']),
@@ -625,68 +915,29 @@ def server(input, output, session):
         )
 
 
+    @metrics.output
     @render_widget
     def plot_allocation_bar():
-        filtered_countries = countries[countries.Continent.isin(input.map_region_filter())]
-
-        fig = px.bar(
-            data_frame=filtered_countries.groupby('ta_focal').agg('count').reset_index(),
-            x='ta_focal',
-            y='CIA Name',
-            color='ta_focal',
-            # color_discrete_sequence=hp.ADVISOR_PALETTE,
-            color_discrete_map=dict(zip(sorted(advisors.short_name), hp.ADVISOR_PALETTE)),
-            labels={'ta_focal':'','CIA Name':'Number of countries'}
-        )
-
-        fig.update_layout(xaxis={'categoryorder':'total descending'}, showlegend=False)
+        ## Only rebuilt when the data changes, the region filter is patched in place (below)
+        return allocation_bar(tuple(sorted(countries().Continent.dropna().unique())))
 
-        return fig
+    @metrics.effect
+    def _():
+        widget = plot_allocation_bar.widget
+        figures.set_bar_heights(widget, countries_by_focal(tuple(sorted(input.map_region_filter_()))))
 
     ###
     ### Countries Overview ###
     ###
+    @metrics.output
     @render_widget
     def risk_matrix_map():
-        matrix_df = risk_matrix
-        countries_df = countries
-        matrix_df['remarks'] = matrix_df.remarks.fillna('-')
-
-        merged = pd.merge(
-            left=matrix_df,
-            right=countries_df[['CIA Name','ISO 3166 alpha3']],
-            left_on='country',
-            right_on='CIA Name',
-            right_index=False,
-        )
-
-        hover_data = {
-            'country': False,
-            'ISO 3166 alpha3': False,
-            'score': False,
-            'Description': merged.description,
-            'Remarks': merged.remarks,
-        }
-
-        fig = px.choropleth(
-            data_frame=merged,
-            locations='ISO 3166 alpha3',
-            color='score',
-            color_continuous_scale='RdYlGn_r',
-            hover_name='country',
-            hover_data=hover_data,
-            labels={'country': 'Country', 'description': 'Description', 'remarks': 'Remarks'},
-            title="Country classification by WASH/Engineering capacity/risk"
-        )
-        fig.update_geos(fitbounds='locations')
-        fig.update_layout(legend=dict(y=1.1, orientation='h'))
-
-        return fig
+        return risk_matrix_figure()
 
+    @metrics.output
     @render.data_frame
     def risk_matrix_df():
-        data = risk_matrix.copy()
-        data.columns = ['Country', 'Score', 'Description', 'Remarks']
+        data = risk_matrix().set_axis(['Country', 'Score', 'Description', 'Remarks'], axis=1)
         data = data.sort_values(['Score', 'Country'])
         data = data.drop(['Score'], axis=1)
 
@@ -696,9 +947,10 @@ def server(input, output, session):
             height="300px"
         )
 
+    @metrics.output
     @render.ui
     def select_year_start_programmes():
-        data = programmes.copy()
+        data = programmes()
         # data = data.sort_values(data.end_year)
         # years = [yr for yr in data.end_year.unique()]
         
@@ -710,9 +962,10 @@ def server(input, output, session):
                     width='200px'
                 )
 
+    @metrics.output
     @render.ui
     def select_year_end_programmes():
-        data = programmes.copy()
+        data = programmes()
         # data = data.sort_values(data.end_year)
         # years = [yr for yr in data.end_year.unique()]
         
@@ -724,105 +977,89 @@ def server(input, output, session):
                     width='200px'
                 )
 
+    @metrics.output
     @render_widget
     def map_programmes():
         # min_year = input.select_year_start_programmes_()
-        max_year = input.select_year_end_programmes_()
-        df = programmes.copy()
-        # period = f"{min_year} - {max_year}"
-
-        ## Group by country and filter by date (only projects still active)
-        df = df[df.end_year.dt.year >= int(max_year)]
-        # df = df[(df.start_year.dt.year >= int(min_year)) & (df.end_year.dt.year >= int(max_year))]
-        df = df.groupby(['country','sub_sector']).agg({'code':'count'}).reset_index().rename(columns={'code':'no_programmes'})
-        
-
-        merged = pd.merge(
-            left=df,
-            right=countries[['CIA Name','ISO 3166 alpha3']],
-            left_on='country',
-            right_on='CIA Name',
-            right_index=False,
-        )
-
-        fig = px.scatter_geo(
-            data_frame=merged,
-            locations="ISO 3166 alpha3",
-            # color="continent",
-            hover_name="country",
-            size="no_programmes",
-            projection="natural earth",
-            opacity=1,
-            title=f"WASH/Engineering Programmes (active as of {max_year})"
-            # title=f"WASH/Engineering Programmes ({period})"
-        )
-
-        return fig
+        return programmes_map(str(input.select_year_end_programmes_()))
 
+    @metrics.output
     @render_widget
     def plot_programmes():
         # min_year = input.select_year_start_programmes_()
-        max_year = input.select_year_end_programmes_()
-        
-        donor_switch = input.programmes_donor_switch()
-        df = programmes.copy()
-
-        ## Group by country and filter by date (only projects still active)
-        # df = df[(df.start_year.dt.year >= int(min_year)) & (df.end_year.dt.year >= int(max_year))]
-        df = df[df.end_year.dt.year >= int(max_year)]
-        # period = f"{min_year} - {max_year}"
-
-        if not donor_switch:
-            data = df.groupby(['country','sub_sector']).agg({'code':'count'}).reset_index().rename(columns={'code':'no_programmes'})
-            labels = {'country': '', 'no_programmes': 'Total number of programmes', 'sub_sector': 'Sector'}
-            color = 'sub_sector'
-        else:
-            data = df.groupby(['country','donor']).agg({'code':'count'}).reset_index().rename(columns={'code':'no_programmes'})
-            labels = {'country': '', 'no_programmes': 'Total number of programmes', 'donor': 'Donor'}
-            color = 'donor'
-
-        fig = px.bar(
-            data_frame = data,
-            x='country',
-            y='no_programmes',
-            color=color,
-            color_discrete_sequence=px.colors.sequential.Plasma_r,
-            labels=labels,
-            # title=f"Total number of programmes with WASH/Engineering component by country ({period})"
-            title=f"Total number of programmes with WASH/Engineering component by country (active as of {max_year})"
+        return programmes_bar(str(input.select_year_end_programmes_()), bool(input.programmes_donor_switch()))
+
+    ###
+    ### Country Calls ###
+    ###
+    ## The grid only receives the current page: the rows are filtered and sorted on the server (see grid.py)
+    calls_grid = grid.Pager()
+    calls_page_number = reactive.Value(0)
+    calls_columns = reactive.Value(None)
+
+    @reactive.calc
+    def calls_query():
+        ## Filters of the selects plus the sort and the column filters of the grid header
+        return (
+            input.call_year_select_(), input.call_country_select_(),
+            grid.sort_key(calls_df), grid.filter_key(calls_df),
         )
 
-        fig.update_layout(xaxis={'categoryorder':'total descending'})
-        fig.update_xaxes(tickangle=45)
+    @reactive.calc
+    def calls_page():
+        return calls_grid.page(calls_display(), calls_rows(*calls_query()), calls_page_number())
 
-        return fig
+    def calls_hidden():
+        ## The calls are only loaded once their panel is opened (hidden outputs are not rendered)
+        return session.clientdata.output_hidden('calls_df')
 
+    @metrics.effect
+    def _():
+        if calls_hidden():
+            return
+        calls_columns.set(tuple(calls_display().columns))
 
-    ###
-    ### Country Calls ###
-    ###
+    @metrics.output
     @render.data_frame
     def calls_df():
-        df = country_calls.get()
-        data = df.copy()
-        data['date'] = pd.to_datetime(data.date, dayfirst=True)
-
-        ## Apply filters while preserving original indices
-        if input.call_year_select_() != 'All':
-            data = data[data.date.dt.year == int(input.call_year_select_())]
-        if input.call_country_select_() != 'All':
-            data = data[data.country==input.call_country_select_()]
-        
-        data = data.sort_values(by='date', ascending=False)
-        data['date'] = data.date.dt.strftime('%d-%m-%Y')
-
+        ## Rendered once (re-rendering would reset the sort and filters of the grid), the pages are sent below
+        columns = req(calls_columns())
+        with reactive.isolate():
+            page = calls_grid.first(calls_page, columns)
         return render.DataGrid(
-            data,
+            page,
             width='fit-content',
             selection_mode='rows',
             height="300px"
         )
 
+    @metrics.effect
+    async def _():
+        if calls_hidden():
+            return
+        await calls_grid.show(calls_df, calls_page())
+
+    @metrics.output
+    @render.text
+    def calls_pager():
+        return calls_grid.describe(calls_rows(*calls_query()), calls_page_number())
+
+    @metrics.effect
+    @reactive.event(calls_query)
+    def _():
+        calls_page_number.set(0)
+
+    @metrics.effect
+    @reactive.event(input.calls_prev_page)
+    def _():
+        calls_page_number.set(max(calls_page_number() - 1, 0))
+
+    @metrics.effect
+    @reactive.event(input.calls_next_page)
+    def _():
+        calls_page_number.set(min(calls_page_number() + 1, calls_grid.pages(calls_rows(*calls_query())) - 1))
+
+    @metrics.output
     @render.ui
     def add_call_btn():
         return ui.input_action_button(
@@ -832,6 +1069,7 @@ def server(input, output, session):
             icon=fa.icon_svg('calendar-plus')
         )
 
+    @metrics.output
     @render.ui
     def delete_call_btn():
         return ui.input_action_button(
@@ -841,6 +1079,7 @@ def server(input, output, session):
                 class_='btn btn-outline-danger',
             )
 
+    @metrics.output
     @render.ui
     def edit_call_btn():
         return ui.input_action_button(
@@ -850,42 +1089,48 @@ def server(input, output, session):
                 icon=fa.icon_svg('pen-to-square'),
             )
                 
+    call_countries = facet_choices(
+        lambda: calls_facets()['country'],
+        lambda choices, _: ui.update_select('call_country_select_', choices=choices, selected=kept(input.call_country_select_(), choices))
+    )
+    call_years = facet_choices(
+        lambda: calls_facets()['year'],
+        lambda choices, _: ui.update_select('call_year_select_', choices=choices, selected=kept(input.call_year_select_(), choices))
+    )
+
+    @metrics.output
     @render.ui
     def call_country_select():
-        data = country_calls.get()
-        countries = [c for c in data.country.unique()]
-        countries.append('All')
         return ui.input_select(
             id='call_country_select_',
             label='Filter by country:',
-            choices = countries,
+            choices = call_countries(),
             selected='All',
             width='150px'
         )
     
+    @metrics.output
     @render.ui
     def call_year_select():
-        data = country_calls.get()
-        years = [int(yr) for yr in data.date.dt.year.unique()]
-        years.append('All')
         return ui.input_select(
             id='call_year_select_',
             label='Filter by year:',
-            choices = years,
+            choices = call_years(),
             selected='All',
             width='150px'
         )
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.add_call)
     def _():
+        form = hp.call_form()
         m = ui.modal(
-            hp.CALL_FORM['date'],
-            hp.CALL_FORM['country'],
-            hp.CALL_FORM['sal_attendees'],
-            hp.CALL_FORM['country_attendees'],
-            hp.CALL_FORM['category'],
-            hp.CALL_FORM['description'],
+            form['date'],
+            form['country'],
+            form['sal_attendees'],
+            form['country_attendees'],
+            form['category'],
+            form['description'],
             ui.div(
                 ui.input_action_button('submit_add_country_call', 'Submit', class_='btn btn-primary'),
                 class_='d-flex justify-content-end'
@@ -896,29 +1141,27 @@ def server(input, output, session):
         )
         ui.modal_show(m)
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.submit_add_country_call)
     def _():
-        data = country_calls.get()
+        data = country_calls()
         try:
-            new_row = pd.DataFrame([{k: input[f'{k}_call']() for k in hp.CALL_FORM.keys()}])
+            new_row = pd.DataFrame([{k: input[f'{k}_call']() for k in hp.CALL_FIELDS}])
             ## Make sure that the new dataframe has the same columns as the original one and that the dates are datetime objects
             new_row = new_row.reindex(columns=data.columns)
             new_row['date'] = pd.to_datetime(new_row.date, dayfirst=True, errors='raise', format='mixed')
             ## Split multiple names in sal_attendees into comma separated string
             new_row['sal_attendees'] = re.sub("[()']", "", ", ".join(map(str, new_row.sal_attendees))).strip(",")
 
-            ## Add the new row to the existing dataframe and update the reactive value
-            updated_df = pd.concat([data, new_row], ignore_index=True)
-            country_calls.set(updated_df)
-            ## Save the call registry to file
-            hp.update_country_calls(updated_df)
+            ## Add the new row to the call registry (saved to file in the background) and update the reactive value
+            hp.add_rows('country_calls', new_row, origin=session.id)
+            sync_versions()
             # ui.notification_show(f'New entry for country call added to the country calls registry, thank you!', type='message')
-            ui.notification_show(f'New entry for {input.country_call()} added to the country calls registry, thank you!', type='message')   
+            ui.notification_show(f'New entry for {input.country_call()} added to the country calls registry and queued for saving, thank you!', type='message')
         except Exception as e:
             ui.notification_show(f'Oops, something went wrong: {str(e)}. Retry!', type='error')
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.delete_call_)
     def _():
         # Get the index of the selected row(s)
@@ -931,12 +1174,19 @@ def server(input, output, session):
         ## Map the selected row indices from the filtered view to the original dataframe indices
         selected_original_indices = filtered_df.iloc[[int(r) for r in selected_rows]].index.tolist()
         # Get the original dataframe and remove the selected rows using their original indices
-        updated_data = country_calls.get().drop(selected_original_indices)
-        country_calls.set(updated_data)
-        hp.update_country_calls(updated_data)
-        ui.notification_show(f'Removing the following row(s): {[id for id in selected_original_indices]}', type='message')
+        try:
+            hp.delete_rows('country_calls', selected_original_indices, hp.row_versions(country_calls(), selected_original_indices), origin=session.id)
+        except hp.Conflict as e:
+            sync_versions()
+            ui.notification_show(str(e), type='error', duration=10)
+            return
+        sync_versions()
+        ui.notification_show(f'Removing the following row(s), queued for saving: {[id for id in selected_original_indices]}', type='message')
+
+    ## Row being edited and its version when the form was opened: (index, version)
+    editing_call_row = reactive.Value(None)
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.edit_call_row_)
     def _():
         ## Get the indices of the selected rows in the current view (filtered or unfiltered)
@@ -947,13 +1197,14 @@ def server(input, output, session):
             ui.notification_show('Please select at least one and only one row for editing', type='error')
             return
         
+        form = hp.call_form()
         m = ui.modal(
-            hp.CALL_FORM['date'],
-            hp.CALL_FORM['country'],
-            hp.CALL_FORM['sal_attendees'],
-            hp.CALL_FORM['country_attendees'],
-            hp.CALL_FORM['category'],
-            hp.CALL_FORM['description'],
+            form['date'],
+            form['country'],
+            form['sal_attendees'],
+            form['country_attendees'],
+            form['category'],
+            form['description'],
             ui.div(
                 ui.input_action_button('submit_edit_country_call', 'Submit', class_='btn btn-primary'),
                 class_='d-flex justify-content-end'
@@ -968,8 +1219,9 @@ def server(input, output, session):
         original_index = filtered_df.iloc[int(selected_rows[0])].name
 
         ## Get the original row data using the mapped index
-        original_df = country_calls.get()
+        original_df = country_calls()
         row_to_edit = original_df.loc[[original_index]]
+        editing_call_row.set((original_index, hp.row_versions(original_df, [original_index])[0]))
 
         ui.update_date('date_call', value=row_to_edit.date.iloc[0])
         ui.update_select('country_call', selected=row_to_edit.country.iloc[0])
@@ -980,152 +1232,66 @@ def server(input, output, session):
 
         ui.modal_show(m)
 
-    @reactive.effect
+    @metrics.effect
     @reactive.event(input.submit_edit_country_call)
     def _():
         ui.modal_remove()
-        selected_rows = calls_df.cell_selection()['rows']
-        filtered_df = calls_df.data_view()
-        original_index = filtered_df.iloc[int(selected_rows[0])].name
+        ## The row as it was when the form was opened, the save is rejected if someone else changed it since
+        original_index, version = editing_call_row()
 
         ## Update specific row using the original index
-        updated_row = pd.DataFrame([{k: input[f'{k}_call']() for k in hp.CALL_FORM.keys()}])
-        original_df = country_calls.get()
+        updated_row = pd.DataFrame([{k: input[f'{k}_call']() for k in hp.CALL_FIELDS}])
+        original_df = country_calls()
         updated_row = updated_row.reindex(columns=original_df.columns)
         updated_row.index = [original_index]
 
         try:
-            original_df.update(updated_row)
-            country_calls.set(original_df)
-            hp.update_country_calls(original_df)
-            ui.notification_show(f'Updated entry for {updated_row.country.iloc[0]}, thank you!', type='message')   
+            updated_row['date'] = pd.to_datetime(updated_row.date, dayfirst=True, errors='raise', format='mixed')
+            ## Split multiple names in sal_attendees into comma separated string
+            updated_row['sal_attendees'] = re.sub("[()']", "", ", ".join(map(str, updated_row.sal_attendees))).strip(",")
+            hp.update_rows('country_calls', updated_row, [version], origin=session.id)
+            sync_versions()
+            ui.notification_show(f'Updated entry for {updated_row.country.iloc[0]}, queued for saving, thank you!', type='message')
+        except hp.Conflict as e:
+            sync_versions()
+            ui.notification_show(str(e), type='error', duration=10)
         except Exception:
             ui.notification_show(f'Oops, something went wrong. Retry!', type='error')        
 
+    call_stats_years = facet_choices(
+        lambda: calls_facets()['year'],
+        lambda choices, _: ui.update_select(
+            'call_year_select_2_', choices=choices, selected=kept(input.call_year_select_2_(), choices, max(choices[:-1], default='All'))
+        )
+    )
+
+    @metrics.output
     @render.ui
     def call_year_select_2():
-        data = country_calls.get()
-        years = [int(yr) for yr in data.date.dt.year.unique()]
-        selected_year = max(years)
-        years.append('All')
+        years = call_stats_years()
         return ui.input_select(
             id='call_year_select_2_',
             label='Filter by year:',
             choices = years,
-            selected=selected_year,
+            selected=max(years[:-1], default='All'),
             width='150px'
         )
 
+    @metrics.output
     @render_widget
     def plot_bar_calls_bycountry():
-        year = input.call_year_select_2_()
         # min_calls = int(input.min_calls_slider())
-        tmp = country_calls.get()
-        ## group by country and filter by date
-        if year == 'All':
-            df = tmp
-            period = f"{tmp.date.dt.year.min()} - {tmp.date.dt.year.max()}"
-        else:
-            df = tmp[tmp.date.dt.year == int(year)]
-            period = year
-        data = df.groupby(['country']).agg({'sal_attendees':'count'}).reset_index().rename(columns={'sal_attendees':'no_calls'})
-
-        fig = px.bar(
-            # data_frame = data[data.no_calls >= min_calls],
-            data_frame = data,
-            x='country',
-            y='no_calls',
-            # x='no_calls',
-            # y='country',
-            color='no_calls',
-            color_continuous_scale='Blues',
-            labels={'country': '', 'no_calls': 'Total number of calls'},
-            title=f"Total number of calls by country ({period})"
-        )
-
-        # fig.update_layout(yaxis={'categoryorder':'total ascending'})
-        fig.update_layout(xaxis={'categoryorder':'total descending'})
-        fig.update_xaxes(tickangle=45)
-        fig.update_coloraxes(showscale=False)
-
-        return fig
+        return calls_by_country_bar(str(input.call_year_select_2_()))
 
+    @metrics.output
     @render_widget
     def plot_bar_calls_byadvisor():
-        year = input.call_year_select_2_()
-        tmp = country_calls.get()
-        tmp = tmp.copy()
+        return calls_by_advisor_bar(str(input.call_year_select_2_()))
 
-        ## Transform the sal_attendees column into a column of lists 
-        def sal_attendees_to_list(series):
-            return series.split(', ')
-        
-        tmp['sal_attendees'] = tmp.sal_attendees.apply(sal_attendees_to_list)
-        
-        ## group by advisor and filter by date
-        if year == 'All':
-            df = tmp
-            period = f"{tmp.date.dt.year.min()} - {tmp.date.dt.year.max()}"
-        else:
-            df = tmp[tmp.date.dt.year == int(year)]
-            period = year
-
-        df = df.explode('sal_attendees')
-        data = df.groupby(['sal_attendees']).agg({'country':'count'}).reset_index().rename(columns={'country':'no_calls'})
-
-        fig = px.bar(
-            # data_frame = data[data.no_calls >= min_calls],
-            data_frame = data,
-            x='sal_attendees',
-            y='no_calls',
-            # x='no_calls',
-            # y='sal_attendees',
-            color='no_calls',
-            color_continuous_scale='Reds',
-            labels={'sal_attendees': '', 'no_calls': 'Total number of calls'},
-            title=f"Total number of calls by advisor ({period})"
-        )
-
-        # fig.update_layout(yaxis={'categoryorder':'total ascending'})
-        fig.update_layout(xaxis={'categoryorder':'total descending'})
-        fig.update_xaxes(tickangle=45)
-        fig.update_coloraxes(showscale=False)
-
-        return fig
-
-    @render.download(filename='wash_sal_db.xlsx')
-    def download_db_xlsx():
-        from io import BytesIO
-        
-        # Get the spreadsheet
-        file = hp.get_data_file()
-        
-        # Create Excel writer object with BytesIO buffer
-        buffer = BytesIO()
-        writer = pd.ExcelWriter(buffer, engine='openpyxl')
-        
-        # Get all worksheets
-        for worksheet in file.worksheets():
-            # Get values from each worksheet
-            values = worksheet.get_all_values()
-            
-            # Convert to DataFrame
-            if values:  # Check if worksheet is not empty
-                df = pd.DataFrame(values[1:], columns=values[0])
-                
-                # Write each worksheet to the Excel file
-                df.to_excel(writer, 
-                          sheet_name=worksheet.title,
-                          index=False)
-        
-        # Save and get the content
-        writer.close()
-        buffer.seek(0)
-        return buffer.getvalue()
-    
     # @render.download()
     # def download_db_xlsx():
     #     path = os.path.join(os.path.dirname(__file__), 'data', 'database.xlsx')
     #     return path
 
-app = App(app_ui, server)
+## The database export (see export.py) and the metrics (see metrics.py) are served next to the app
+app = Starlette(routes=[*export.ROUTES, *metrics.ROUTES, Mount('/', app=App(app_ui, server))])
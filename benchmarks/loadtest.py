@@ -0,0 +1,401 @@
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import urllib.request
+from datetime import date, datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+import websockets
+
+import grid
+
+### Load test of the dashboard ###
+## Starts the app on a local sqlite copy of synthetic tables (see synthetic.py, nothing goes to the network)
+## and drives N simulated sessions over the Shiny websocket protocol, for increasing N. Each session behaves
+## like a user: it switches panels, moves the date slider, changes the filters, and adds and deletes calendar
+## entries, with a random think time between two actions.
+##
+##   python -m benchmarks.loadtest                              # 1, 5, 10 and 20 sessions on 10k rows
+##   python -m benchmarks.loadtest --sessions 1 10 50 --duration 60 --rows 100k
+##   python -m benchmarks.loadtest --url http://localhost:8000  # an app already running
+##
+## The render latency of an output is the time from sending the input change to the output being recalculated
+## (the server's 'recalculated' message), the latency of an action the time until the new values are received.
+## Results (p50, p95, p99 by output and action, throughput) are printed and saved as JSON in benchmarks/results/.
+
+app_dir = Path(__file__).parent.parent
+RESULTS_PATH = Path(__file__).parent / 'results'
+
+DEFAULT_SESSIONS = [1, 5, 10, 20]
+## Seconds each concurrency level runs, and mean think time of the users between two actions
+DURATION = 30
+THINK_TIME = 2.0
+## Seconds over which the sessions of a level connect
+RAMP_UP = 2.0
+## Seconds to wait for the answer to an action
+TIMEOUT = 60
+## Seconds without messages after the values after which an action is over
+SETTLE = 0.1
+PORT = 8790
+
+## Outputs of each panel, the ones of the other panels are hidden (not rendered until shown)
+PANELS = {
+    'Calendar': [
+        'calendar_advisor_filter', 'calendar_date_range', 'plot_calendar', 'add_calendar_btn', 'delete_calendar_btn',
+        'edit_calendar_btn', 'table_advisor_select', 'table_year_select', 'table_type_select', 'calendar_df',
+        'calendar_pager', 'select_year', 'advisor_occupancy_df', 'plot_bar_days_bytype', 'plot_workload_heatmap',
+        'free_advisors',
+    ],
+    'Country Allocation': ['map_region_filter', 'plot_allocation_map', 'plot_allocation_bar', 'countries_df'],
+    'Countries Overview': ['risk_matrix_map', 'risk_matrix_df', 'select_year_end_programmes', 'map_programmes', 'plot_programmes'],
+    'Country Calls': [
+        'add_call_btn', 'delete_call_btn', 'edit_call_btn', 'call_country_select', 'call_year_select', 'calls_df',
+        'calls_pager', 'call_year_select_2', 'plot_bar_calls_bycountry', 'plot_bar_calls_byadvisor',
+    ],
+}
+## Chance that the next action of a user is a switch to another panel
+SWITCH_PANEL = 0.15
+
+
+def percentiles(values):
+    values = np.asarray(values) * 1000
+    return {
+        'count': len(values),
+        'p50': float(np.percentile(values, 50)),
+        'p95': float(np.percentile(values, 95)),
+        'p99': float(np.percentile(values, 99)),
+    }
+
+
+## DATA AND APP ##
+
+def seed_store(path, rows, seed):
+    """Write the synthetic tables in a sqlite store, as the app reads them with WASH_STORAGE=sqlite."""
+    import storage
+    from benchmarks import synthetic
+    backend = storage.SQLiteBackend(path)
+    for name, data in synthetic.tables(rows, seed).items():
+        backend.write_table(name, data)
+
+def start_app(tmp, rows, seed, port):
+    """Start the app on a seeded store in tmp. Returns the process, once it answers."""
+    store = Path(tmp) / 'wash.db'
+    seed_store(store, rows, seed)
+    env = dict(os.environ)
+    env.pop('WASH_SHARED_DIR', None)
+    env.update({
+        'WASH_STORAGE': 'sqlite',
+        'WASH_STORAGE_PATH': str(store),
+        'WASH_SNAPSHOT': '0',
+        'WASH_JOURNAL_PATH': str(Path(tmp) / 'journal.jsonl'),
+        'WASH_EXPORT_PATH': str(Path(tmp) / 'exports'),
+    })
+    log = open(Path(tmp) / 'app.log', 'w')
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'uvicorn', 'app:app', '--port', str(port), '--log-level', 'warning'],
+        cwd=app_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+    )
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            break
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1)
+            return process
+        except OSError:
+            time.sleep(0.5)
+    process.kill()
+    raise RuntimeError(f'The app did not start, see its log:\n{(Path(tmp) / "app.log").read_text()[-2000:]}')
+
+
+## SESSIONS ##
+
+class Session:
+    """One simulated user: a websocket connection to the app and the inputs a browser would send."""
+
+    def __init__(self, url, stats, rng, years, advisors, regions):
+        self.url = url
+        self.stats = stats
+        self.rng = rng
+        self.years, self.advisors, self.regions = years, advisors, regions
+        self.panel = 'Calendar'
+        self.clicks = {}
+        self.messages = asyncio.Queue()
+        self.ws = None
+        self.start, self.end = date.today() - timedelta(weeks=2), date.today() + timedelta(weeks=6)
+
+    def _hidden(self, panel):
+        return {
+            f'.clientdata_output_{output}_hidden': name != panel
+            for name, outputs in PANELS.items() for output in outputs
+        }
+
+    def _date_range(self):
+        return {'calendar_date_range_:shiny.date': [self.start.isoformat(), self.end.isoformat()]}
+
+    def _click(self, button):
+        self.clicks[button] = self.clicks.get(button, 0) + 1
+        return {f'{button}:shiny.action': self.clicks[button]}
+
+    async def _read(self):
+        try:
+            async for raw in self.ws:
+                self.messages.put_nowait((time.perf_counter(), raw))
+        except websockets.ConnectionClosed:
+            pass
+
+    async def connect(self):
+        self.ws = await websockets.connect(self.url, max_size=None)
+        self._reader = asyncio.create_task(self._read())
+        data = self._hidden(self.panel)
+        data.update(self._date_range())
+        data.update({
+            'calendar_advisor_filter_': self.advisors, 'table_year_select_': 'All', 'table_advisor_select_': 'All',
+            'table_type_select_': 'All', 'select_year_': str(date.today().year), 'workload_freq': 'W',
+            'free_range:shiny.date': [date.today().isoformat(), (date.today() + timedelta(days=4)).isoformat()],
+            'map_region_filter_': self.regions, 'select_year_end_programmes_': str(date.today().year),
+            'programmes_donor_switch': False, 'call_country_select_': 'All', 'call_year_select_': 'All',
+            'call_year_select_2_': 'All',
+            'calendar_df_column_sort': [], 'calendar_df_column_filter': [],
+            'calls_df_column_sort': [], 'calls_df_column_filter': [],
+        })
+        return await self.send('session.start', data, method='init')
+
+    async def close(self):
+        await self.ws.close()
+        await self._reader
+
+    async def send(self, action, data, method='update'):
+        """Send the input changes and wait for the new values. Returns the messages received meanwhile."""
+        ## Messages not caused by this session (e.g. another session changed a table) are not counted
+        while not self.messages.empty():
+            self.messages.get_nowait()
+        start = time.perf_counter()
+        await self.ws.send(json.dumps({'method': method, 'data': data}))
+        received = []
+        busy = done = None
+        while True:
+            try:
+                ## Once the values are received, the messages sent right after them (e.g. patches of the figures)
+                ## still belong to the action
+                timestamp, raw = await asyncio.wait_for(self.messages.get(), TIMEOUT if done is None else SETTLE)
+            except asyncio.TimeoutError:
+                break
+            message = json.loads(raw)
+            received.append(raw)
+            self.stats.received(len(raw))
+            recalculating = message.get('recalculating', {})
+            if recalculating.get('status') == 'recalculated':
+                self.stats.render(recalculating['name'], timestamp - start)
+            for output in message.get('errors', {}):
+                self.stats.error(output)
+            ## The server is busy while it runs the effects and outputs, then flushes the values
+            ## (the app also flushes on its own, e.g. when it polls the table versions)
+            busy = message.get('busy', busy)
+            if done is None and 'values' in message and busy != 'busy':
+                done = timestamp
+        if done is None:
+            self.stats.error(action)
+        else:
+            self.stats.action(action, done - start)
+        return received
+
+    ## Actions of the users
+
+    def actions(self):
+        """(name, inputs) of the actions available on the current panel."""
+        rng = self.rng
+        if self.panel == 'Calendar':
+            step = timedelta(days=14 * rng.choice([-4, -2, -1, 1, 2, 4]))
+            advisors = [a for a in self.advisors if rng.random() < 0.8] or self.advisors[:1]
+            return [
+                ('calendar.slider', lambda: self._move_slider(step)),
+                ('calendar.advisor_filter', lambda: {'calendar_advisor_filter_': advisors}),
+                ('calendar.table_year', lambda: {'table_year_select_': rng.choice(['All', *self.years])}),
+                ('calendar.table_advisor', lambda: {'table_advisor_select_': rng.choice(['All', *self.advisors])}),
+                ('calendar.stats_year', lambda: {'select_year_': rng.choice(self.years)}),
+                ('calendar.workload_freq', lambda: {'workload_freq': rng.choice(['W', 'M'])}),
+                ('calendar.next_page', lambda: self._click('calendar_next_page')),
+                ('calendar.add_delete', None),
+            ]
+        if self.panel == 'Country Allocation':
+            regions = [r for r in self.regions if rng.random() < 0.7] or self.regions[:1]
+            return [('allocation.regions', lambda: {'map_region_filter_': regions})]
+        if self.panel == 'Countries Overview':
+            return [
+                ('programmes.year', lambda: {'select_year_end_programmes_': rng.choice(self.years)}),
+                ('programmes.donor_switch', lambda: {'programmes_donor_switch': rng.random() < 0.5}),
+            ]
+        return [
+            ('calls.table_year', lambda: {'call_year_select_': rng.choice(['All', *self.years])}),
+            ('calls.chart_year', lambda: {'call_year_select_2_': rng.choice(['All', *self.years])}),
+            ('calls.next_page', lambda: self._click('calls_next_page')),
+        ]
+
+    def _move_slider(self, step):
+        self.start, self.end = self.start + step, self.end + step
+        return self._date_range()
+
+    async def switch_panel(self):
+        self.panel = self.rng.choice([panel for panel in PANELS if panel != self.panel])
+        await self.send(f'nav.{self.panel}', self._hidden(self.panel))
+
+    async def add_and_delete(self):
+        """Add an entry to the calendar (confirming it if it overlaps others), then delete the newest entry."""
+        await self.send('calendar.open_form', self._click('add_to_calendar'))
+        day = date.today() + timedelta(days=self.rng.randrange(365))
+        form = {
+            'cal_advisor': self.rng.choice(self.advisors), 'cal_type': 'Mission', 'cal_remarks': 'load test',
+            'cal_start_date:shiny.date': day.isoformat(), 'cal_end_date:shiny.date': (day + timedelta(days=2)).isoformat(),
+        }
+        received = await self.send('calendar.add', {**form, **self._click('submit_add_cal')})
+        if any('confirm_cal_entry' in raw for raw in received):
+            await self.send('calendar.confirm', self._click('confirm_cal_entry'))
+        ## Newest entries come first in the grid
+        await self.send('calendar.show_all', {'table_year_select_': 'All', 'table_advisor_select_': 'All', 'table_type_select_': 'All'})
+        await self.send('calendar.select_row', {
+            'calendar_df_cell_selection': {'type': 'row', 'rows': [0]}, 'calendar_df_data_view_rows': list(range(grid.PAGE_SIZE)),
+        })
+        await self.send('calendar.delete', self._click('delete_from_calendar_'))
+
+    async def run(self, until, think_time):
+        await self.connect()
+        while time.monotonic() < until:
+            await asyncio.sleep(self.rng.expovariate(1 / think_time))
+            if self.rng.random() < SWITCH_PANEL:
+                await self.switch_panel()
+                continue
+            name, inputs = self.rng.choice(self.actions())
+            if inputs is None:
+                await self.add_and_delete()
+            else:
+                await self.send(name, inputs())
+        await self.close()
+
+
+class Stats:
+    """Latencies and counters of the sessions of one concurrency level."""
+
+    def __init__(self):
+        self.renders = {}
+        self.actions = {}
+        self.errors = {}
+        self.bytes = 0
+
+    def render(self, output, seconds):
+        self.renders.setdefault(output, []).append(seconds)
+
+    def action(self, name, seconds):
+        self.actions.setdefault(name, []).append(seconds)
+
+    def error(self, name):
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    def received(self, size):
+        self.bytes += size
+
+    def report(self, sessions, seconds):
+        actions = sum(len(v) for v in self.actions.values())
+        return {
+            'sessions': sessions,
+            'seconds': seconds,
+            'actions_per_second': actions / seconds,
+            'renders_per_second': sum(len(v) for v in self.renders.values()) / seconds,
+            'mib_per_second': self.bytes / seconds / 2 ** 20,
+            'outputs': {name: percentiles(v) for name, v in sorted(self.renders.items())},
+            'actions': {name: percentiles(v) for name, v in sorted(self.actions.items())},
+            'errors': self.errors,
+        }
+
+
+async def run_level(url, sessions, duration, think_time, seed, data):
+    """Run the sessions concurrently for duration seconds. Returns the report of the level."""
+    stats = Stats()
+    start = time.monotonic()
+    until = start + RAMP_UP + duration
+
+    async def user(number):
+        await asyncio.sleep(RAMP_UP * number / sessions)
+        session = Session(url, stats, random.Random(seed * 1000 + number), **data)
+        try:
+            await session.run(until, think_time)
+        except (OSError, websockets.WebSocketException) as e:
+            print(f'Session {number} failed: {str(e)}')
+            stats.error('session')
+
+    await asyncio.gather(*(user(number) for number in range(sessions)))
+    return stats.report(sessions, time.monotonic() - start)
+
+
+def print_report(report):
+    print(f'\n{report["sessions"]} sessions: {report["actions_per_second"]:.1f} actions/s, '
+          f'{report["renders_per_second"]:.1f} renders/s, {report["mib_per_second"]:.2f} MiB/s')
+    print(f'  {"":<34} {"count":>6} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+    for kind in ('outputs', 'actions'):
+        for name, result in report[kind].items():
+            print(f'  {name:<34} {result["count"]:6d} {result["p50"]:9.1f} {result["p95"]:9.1f} {result["p99"]:9.1f}')
+    if report['errors']:
+        print(f'  errors: {report["errors"]}')
+
+
+def main():
+    from benchmarks import synthetic
+
+    parser = argparse.ArgumentParser(description='Load test of the dashboard with simulated concurrent sessions.')
+    parser.add_argument('--sessions', nargs='+', type=int, default=DEFAULT_SESSIONS, help='concurrency levels')
+    parser.add_argument('--duration', type=float, default=DURATION, help='seconds of each level')
+    parser.add_argument('--think', type=float, default=THINK_TIME, help='mean seconds between two actions of a user')
+    parser.add_argument('--rows', default='10k', choices=list(synthetic.SIZES), help='rows of the synthetic tables')
+    parser.add_argument('--seed', type=int, default=synthetic.SEED)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--url', help='test the app running at this URL instead of starting one (e.g. http://localhost:8000)')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/loadtest-<date>.json)')
+    args = parser.parse_args()
+
+    first_year = synthetic.FIRST_DAY.year
+    data = {
+        'years': [str(year) for year in range(first_year, first_year + synthetic.DAYS // 365)],
+        'advisors': list(synthetic.ADVISORS),
+        'regions': list(synthetic.CONTINENTS),
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        process = None
+        if args.url is None:
+            print(f'Starting the app on {args.rows} rows...')
+            process = start_app(tmp, synthetic.SIZES[args.rows], args.seed, args.port)
+        url = (args.url or f'http://127.0.0.1:{args.port}').replace('http', 'ws', 1).rstrip('/') + '/websocket/'
+        try:
+            ## One session first, so that the tables are loaded and the first views cached
+            asyncio.run(run_level(url, 1, 0, 0.1, args.seed, data))
+            reports = []
+            for sessions in args.sessions:
+                reports.append(asyncio.run(run_level(url, sessions, args.duration, args.think, args.seed, data)))
+                print_report(reports[-1])
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+
+    result = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'rows': args.rows if args.url is None else None,
+        'duration': args.duration,
+        'think_time': args.think,
+        'levels': reports,
+    }
+    if args.output is None:
+        RESULTS_PATH.mkdir(parents=True, exist_ok=True)
+        args.output = RESULTS_PATH / f'loadtest-{datetime.now():%Y%m%d-%H%M%S}.json'
+    Path(args.output).write_text(json.dumps(result, indent=1))
+    print(f'\nResults saved in {args.output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import os
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+from datetime import datetime
+from pathlib import Path
+
+### Benchmark suite ###
+## Times the loading of the tables (reading the worksheets, parsing, categoricals), the derived tables behind
+## the renderers (row selection, group-bys, pcg_days_by_type) and the construction of the figures, on synthetic
+## tables (see synthetic.py) read from an in-memory stand-in for the spreadsheet: nothing goes to the network.
+## Each size runs in its own process, so that its peak memory is measured alone and no cache carries over.
+##
+##   python -m benchmarks.run                      # 1k, 10k and 100k rows, results in benchmarks/results/
+##   python -m benchmarks.run --sizes 1M --repeat 3
+##   python -m benchmarks.run --compare before.json after.json
+##
+## Every function is called once before being timed, then timed repeat times: the cached functions are called
+## without their cache (func.__wrapped__), the cached tables they read (e.g. the row index) being warm.
+
+app_dir = Path(__file__).parent.parent
+RESULTS_PATH = Path(__file__).parent / 'results'
+DEFAULT_SIZES = ['1k', '10k', '100k']
+REPEAT = 5
+## Year selected in the filters
+YEAR = '2024'
+
+
+def measure(func, repeat, setup=tuple):
+    """Seconds taken by func(*setup()) in each of repeat runs, after a first untimed run (garbage collection off, as timeit)."""
+    func(*setup())
+    runs = []
+    for _ in range(repeat):
+        args = setup()
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            func(*args)
+            runs.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return {'min': min(runs), 'median': statistics.median(runs), 'runs': runs}
+
+
+## ONE SIZE (child process) ##
+
+def run_size(label, repeat, seed):
+    """Results of the suite for one size, in the current process (see main)."""
+    sys.path.insert(0, str(app_dir))
+    from benchmarks import synthetic
+
+    rows = synthetic.SIZES[label]
+    backend = synthetic.MemoryBackend(synthetic.tables(rows, seed))
+
+    import lookup
+    import occupancy
+    import helpers as hp
+    hp.BACKEND = hp.TABLES.backend = hp.WRITER.backend = backend
+
+    results = {}
+    def bench(name, func, setup=tuple):
+        results[name] = measure(func, repeat, setup)
+        print(f'  {label:>5} {name:<40} {results[name]["median"] * 1000:10.2f} ms', flush=True)
+
+    ## Loading: the import path of each table, then whole groups through the registry
+    for name in synthetic.storage.TABLES:
+        bench(f'read.{name}', backend.read_table, lambda: (name,))
+        raw = backend.read_table(name)
+        parse = hp.TABLES.parsers[name]
+        bench(f'parse.{name}', parse, lambda: (raw.copy(),))
+        parsed = parse(raw.copy())
+        bench(f'prepare.{name}', hp.prepare_table, lambda: (name, parsed))
+    for group in hp.TABLES.groups:
+        bench(f'load.{"+".join(group)}', hp.TABLES.load, lambda: (group,))
+    for name in hp.TABLES.names:
+        hp.TABLES.get(name)
+
+    ## Derived tables behind the renderers
+    for name in lookup.CATEGORICAL_COLUMNS:
+        bench(f'row_index.{name}', hp.ROW_INDEX[name].__wrapped__)
+        bench(f'facets.{name}', hp.FACETS[name].__wrapped__)
+    calendar = hp.TABLES.get('calendar')
+    calendars = hp.advisor_work_calendars()
+    bench('advisor_work_calendars', hp.advisor_work_calendars.__wrapped__)
+    bench('pcg_days_by_type.year', hp.pcg_days_by_type, lambda: (calendar, YEAR, calendars))
+    bench('pcg_days_by_type.all', hp.pcg_days_by_type, lambda: (calendar, 'All', calendars))
+    bench('occupancy', lambda: occupancy.Occupancy().update(calendar, calendars))
+    bench('calendar_display', hp.calendar_display.__wrapped__)
+    bench('calendar_rows.all', hp.calendar_rows.__wrapped__, lambda: ('All', 'All', 'All'))
+    bench('calendar_rows.filtered', hp.calendar_rows.__wrapped__, lambda: (YEAR, synthetic.ADVISORS[0], synthetic.TYPES[0]))
+    ## Sorted by start date and filtered on the remarks in the grid header
+    bench('calendar_rows.grid', hp.calendar_rows.__wrapped__, lambda: (YEAR, 'All', 'All', ((2, False),), ((4, 'visit'),)))
+    bench('calls_display', hp.calls_display.__wrapped__)
+    bench('calls_rows.all', hp.calls_rows.__wrapped__, lambda: ('All', 'All'))
+    bench('calls_rows.filtered', hp.calls_rows.__wrapped__, lambda: (YEAR, synthetic.country_names(rows)[0]))
+    bench('calls_by.country', hp.calls_by.__wrapped__, lambda: (YEAR, 'country'))
+    bench('calls_by.advisor', hp.calls_by.__wrapped__, lambda: (YEAR, 'advisor'))
+    bench('active_programmes.sub_sector', hp.active_programmes.__wrapped__, lambda: (YEAR, 'sub_sector'))
+    bench('active_programmes.donor', hp.active_programmes.__wrapped__, lambda: (YEAR, 'donor'))
+    bench('countries_by_focal', hp.countries_by_focal.__wrapped__, lambda: (tuple(synthetic.CONTINENTS[:3]),))
+
+    ## Figures as a new session shows them, built and serialized as on a cache miss
+    ## (imported once the tables are loaded: the prerendering of the default views is not started)
+    import figures
+    for figure, args in figures.default_views():
+        bench(f'figure.{figure.__name__}', lambda: figure.__wrapped__(*args).to_json())
+
+    return {
+        'rows': rows,
+        'peak_rss_mib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'results': results,
+    }
+
+
+## SUITE ##
+
+def _git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=app_dir, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def _environment(tmp):
+    """Environment of the child processes: offline, nothing written outside tmp."""
+    env = dict(os.environ)
+    env.pop('WASH_SHARED_DIR', None)
+    env.update({
+        'WASH_STORAGE': 'sheets',
+        'WASH_SNAPSHOT': '0',
+        'WASH_JOURNAL_PATH': str(Path(tmp) / 'journal.jsonl'),
+        'WASH_EXPORT_PATH': str(Path(tmp) / 'exports'),
+        ## No background check of the remote during the run
+        'WASH_REFRESH_INTERVAL': str(24 * 3600),
+        'WASH_FLUSH_DELAY': str(24 * 3600),
+        'PYTHONPATH': os.pathsep.join(filter(None, [str(app_dir), env.get('PYTHONPATH')])),
+    })
+    return env
+
+def run(sizes, repeat=REPEAT, seed=None, output=None):
+    """Run the suite for each size in its own process and save the results as JSON. Returns the path."""
+    from benchmarks import synthetic
+    seed = synthetic.SEED if seed is None else seed
+    report = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'revision': _git_revision(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': repeat,
+        'seed': seed,
+        'sizes': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp:
+        for label in sizes:
+            result = Path(tmp) / f'{label}.json'
+            subprocess.run(
+                [sys.executable, '-m', 'benchmarks.run', '--child', label, str(result), '--repeat', str(repeat), '--seed', str(seed)],
+                cwd=app_dir, env=_environment(tmp), check=True,
+            )
+            report['sizes'][label] = json.loads(result.read_text())
+
+    if output is None:
+        RESULTS_PATH.mkdir(parents=True, exist_ok=True)
+        output = RESULTS_PATH / f'{datetime.now():%Y%m%d-%H%M%S}{"-" + report["revision"] if report["revision"] else ""}.json'
+    Path(output).write_text(json.dumps(report, indent=1))
+    print(f'Results saved in {output}')
+    return output
+
+
+def compare(before, after):
+    """Print the median times of two result files side by side."""
+    before, after = (json.loads(Path(path).read_text()) for path in (before, after))
+    print(f'{"":>5} {"benchmark":<40} {"before ms":>10} {"after ms":>10} {"ratio":>7}')
+    for label, size in after['sizes'].items():
+        previous = before['sizes'].get(label, {}).get('results', {})
+        for name, result in size['results'].items():
+            if name not in previous:
+                continue
+            old, new = previous[name]['median'], result['median']
+            print(f'{label:>5} {name:<40} {old * 1000:10.2f} {new * 1000:10.2f} {new / old if old else float("nan"):7.2f}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the dashboard on synthetic tables.')
+    parser.add_argument('--sizes', nargs='+', default=DEFAULT_SIZES, help='sizes to run: 1k, 10k, 100k, 1M')
+    parser.add_argument('--repeat', type=int, default=REPEAT, help='timed runs of each benchmark')
+    parser.add_argument('--seed', type=int, default=None, help='seed of the synthetic tables')
+    parser.add_argument('--output', help='result file (default: benchmarks/results/<date>-<revision>.json)')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two result files')
+    parser.add_argument('--child', nargs=2, metavar=('SIZE', 'RESULT'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    elif args.child:
+        label, result = args.child
+        Path(result).write_text(json.dumps(run_size(label, args.repeat, args.seed)))
+    else:
+        from benchmarks import synthetic
+        unknown = [label for label in args.sizes if label not in synthetic.SIZES]
+        if unknown:
+            parser.error(f'unknown sizes {", ".join(unknown)} (expected {", ".join(synthetic.SIZES)})')
+        run(args.sizes, args.repeat, args.seed, args.output)
+
+
+if __name__ == '__main__':
+    main()
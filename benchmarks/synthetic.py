@@ -0,0 +1,148 @@
+import itertools
+
+import numpy as np
+import pandas as pd
+
+import storage
+
+### Synthetic tables for the benchmarks ###
+## Seeded generators of the dashboard tables at any number of rows, and an in-memory stand-in for the
+## spreadsheet: the tables are kept as cell values, as the Sheets API returns them (dates as dd-mm-yyyy strings,
+## empty cells as ''), and read back through storage.values_to_dataframe like the Sheets backend does.
+
+SEED = 0
+## Sizes of the benchmark suite, by label
+SIZES = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+
+ADVISORS = ['AB', 'CD', 'EF', 'GH', 'IJ']
+TYPES = ['Mission', 'Leave', 'Sick', 'Training', 'Public holiday', 'Other', 'Office', 'Remote', 'Away']
+CONTINENTS = ['Africa', 'Americas', 'Asia', 'Europe', 'Oceania']
+SUB_SECTORS = ['WASH', 'Shelter', 'Engineering', 'Health']
+DONORS = ['ECHO', 'BHA', 'FCDO', 'UNICEF', 'Private']
+## Dates of the calendar and of the calls (the sheet format)
+FIRST_DAY = pd.Timestamp('2019-01-01')
+DAYS = 8 * 365
+DATE_FORMAT = '%d-%m-%Y'
+
+
+def _dates(rng, n, offset=None):
+    days = rng.integers(0, DAYS, n) if offset is None else offset
+    return FIRST_DAY + pd.to_timedelta(days, unit='D')
+
+def country_names(n):
+    return [f'Country {i:0{len(str(n))}d}' for i in range(n)]
+
+def _iso_codes(n):
+    ## Three letter codes, unique up to 26**3 countries
+    letters = np.array(list('ABCDEFGHIJKLMNOPQRSTUVWXYZ'))
+    i = np.arange(n) % 26 ** 3
+    return np.char.add(np.char.add(letters[i // 676], letters[i // 26 % 26]), letters[i % 26]).tolist()
+
+
+## GENERATORS ##
+
+def advisors():
+    return pd.DataFrame({'short_name': ADVISORS})
+
+def types():
+    return pd.DataFrame({'type': TYPES})
+
+def wash_list():
+    return pd.DataFrame({'name': ['wash']})
+
+def countries(n, rng):
+    return pd.DataFrame({
+        'CIA Name': country_names(n),
+        'ISO 3166 alpha3': _iso_codes(n),
+        'Continent': rng.choice(CONTINENTS, n),
+        'ta_focal': rng.choice(ADVISORS, n),
+        'ta_support': rng.choice(ADVISORS, n),
+    })
+
+def risk_matrix(n, rng, names):
+    return pd.DataFrame({
+        'country': rng.choice(names, n),
+        'score': rng.integers(1, 5, n),
+        'description': rng.choice(['Low capacity', 'Medium capacity', 'High capacity'], n),
+        'remarks': rng.choice(['', 'To be reviewed', 'Updated'], n),
+    })
+
+def programmes(n, rng, names):
+    start = rng.integers(2015, 2025, n)
+    return pd.DataFrame({
+        'code': [f'P{i:07d}' for i in range(n)],
+        'country': rng.choice(names, n),
+        'sub_sector': rng.choice(SUB_SECTORS, n),
+        'donor': rng.choice(DONORS, n),
+        'start_year': start,
+        'end_year': start + rng.integers(0, 5, n),
+    })
+
+def calendar(n, rng, names):
+    start = rng.integers(0, DAYS, n)
+    return pd.DataFrame({
+        'advisor': rng.choice(ADVISORS, n),
+        'type': rng.choice(TYPES, n),
+        'start_date': _dates(rng, n, start).strftime(DATE_FORMAT),
+        'end_date': _dates(rng, n, start + rng.integers(0, 15, n)).strftime(DATE_FORMAT),
+        'remarks': rng.choice(['', 'Field visit', *names[:10]], n),
+    })
+
+def country_calls(n, rng, names):
+    ## One to three advisors per call
+    attendees = [', '.join(combo) for k in (1, 2, 3) for combo in itertools.permutations(ADVISORS, k)]
+    return pd.DataFrame({
+        'date': _dates(rng, n).strftime(DATE_FORMAT),
+        'country': rng.choice(names, n),
+        'sal_attendees': rng.choice(attendees, n),
+        'country_attendees': rng.choice(['WASH coordinator', 'Country director', ''], n),
+        'category': rng.choice(['scheduled', 'ad hoc'], n),
+        'description': rng.choice(['Monthly call', 'Programme review', 'Emergency response'], n),
+    })
+
+
+def tables(n, seed=SEED):
+    """All the tables of the dashboard as the spreadsheet holds them, calendar, country_calls, programmes, countries and risk_matrix with n rows."""
+    rng = np.random.default_rng(seed)
+    data = {'advisors': advisors(), 'types': types(), 'wash_list': wash_list(), 'countries': countries(n, rng)}
+    names = data['countries']['CIA Name'].tolist()
+    data['risk_matrix'] = risk_matrix(n, rng, names)
+    data['programmes'] = programmes(n, rng, names)
+    data['calendar'] = calendar(n, rng, names)
+    data['country_calls'] = country_calls(n, rng, names)
+    return {name: data[name] for name in storage.TABLES}
+
+
+## SPREADSHEET STAND-IN ##
+
+def to_values(data):
+    """Cell values of a worksheet holding the table: header row, dates as dd-mm-yyyy, missing values as ''."""
+    data = data.assign(**{
+        col: data[col].dt.strftime(DATE_FORMAT) for col in data.columns if pd.api.types.is_datetime64_any_dtype(data[col])
+    })
+    data = data.astype(object).where(data.notna(), '')
+    return [[str(col) for col in data.columns], *data.to_numpy().tolist()]
+
+
+class MemoryBackend(storage.StorageBackend):
+    """Worksheets held in memory as cell values, read like SheetsBackend reads the API responses."""
+
+    name = 'memory'
+
+    def __init__(self, tables):
+        self.values = {name: to_values(data) for name, data in tables.items()}
+        self.writes = 0
+
+    def read_table(self, name):
+        return storage.values_to_dataframe(self.values[name])
+
+    def read_tables(self, names):
+        ## One batch request for the Sheets backend
+        return {name: self.read_table(name) for name in names}
+
+    def write_table(self, name, data):
+        self.values[name] = to_values(data)
+        self.writes += 1
+
+    def remote_version(self):
+        return self.writes
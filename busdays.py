@@ -0,0 +1,95 @@
+import numpy as np
+import pandas as pd
+
+## Public holidays are taken from the holidays package when it is installed (pip install holidays)
+try:
+    import holidays as public_holidays
+except ImportError:
+    public_holidays = None
+
+### Business-day counting for the calendar events ###
+## Every advisor can have their own working week (e.g. Sun-Thu in the Middle East) and the public holidays
+## of their duty country. Counts are computed with np.busday_count on whole columns, one call per calendar.
+
+DEFAULT_WEEKMASK = 'Mon Tue Wed Thu Fri'
+
+
+def country_holidays(country, years):
+    """Public holidays of the country (name of the holidays package, ISO alpha-2 or alpha-3 code)."""
+    if public_holidays is None or not isinstance(country, str) or not country:
+        return []
+    try:
+        return sorted(public_holidays.country_holidays(country, years=list(years)))
+    except NotImplementedError:
+        print(f'No public holidays known for {country}')
+        return []
+
+
+def advisor_calendars(advisors, years, country_codes=None):
+    """
+    Business-day calendar of each advisor, from the optional weekmask and duty_country columns of the advisors table.
+
+    country_codes maps country names to the codes understood by the holidays package.
+    Returns a dict short_name -> np.busdaycalendar.
+    """
+    country_codes = country_codes or {}
+    calendars = {}
+    holidays_by_country = {}
+    for advisor in advisors.itertuples(index=False):
+        weekmask = getattr(advisor, 'weekmask', None)
+        if not isinstance(weekmask, str) or not weekmask.strip():
+            weekmask = DEFAULT_WEEKMASK
+        country = getattr(advisor, 'duty_country', None)
+        country = country_codes.get(country, country)
+        if country not in holidays_by_country:
+            holidays_by_country[country] = country_holidays(country, years)
+        calendars[advisor.short_name] = np.busdaycalendar(weekmask=weekmask, holidays=holidays_by_country[country])
+    return calendars
+
+
+def count_busdays(start, end, keys=None, calendars=None):
+    """
+    Business days from start to end (both included) of each event.
+
+    start and end are datetime Series, keys (e.g. the advisor of each event) selects the calendar used for
+    each event, events without a calendar use the default Mon-Fri week. Events with missing dates count 0.
+    """
+    start = start.to_numpy(dtype='datetime64[D]')
+    end = end.to_numpy(dtype='datetime64[D]') + np.timedelta64(1, 'D')
+    valid = ~(np.isnat(start) | np.isnat(end)) & (end > start)
+    counts = np.zeros(len(start), dtype=np.int64)
+    if keys is None or not calendars:
+        counts[valid] = np.busday_count(start[valid], end[valid])
+        return counts
+
+    ## One code per event (the categorical codes if keys is categorical, see lookup.py)
+    codes, values = pd.factorize(keys if isinstance(keys, (pd.Series, pd.Index, np.ndarray)) else np.asarray(keys))
+    default = np.busdaycalendar()
+    for code in np.unique(codes[valid]):
+        mask = valid & (codes == code)
+        calendar = calendars.get(values[code], default) if code >= 0 else default
+        counts[mask] = np.busday_count(start[mask], end[mask], busdaycal=calendar)
+    return counts
+
+
+def clip_to_period(data, period_start, period_end):
+    """Events overlapping the period, with their dates clipped to it (period_end included)."""
+    clipped = data[(data.start_date <= period_end) & (data.end_date >= period_start)]
+    return clipped.assign(
+        start_date=clipped.start_date.clip(lower=period_start),
+        end_date=clipped.end_date.clip(upper=period_end),
+    )
+
+
+def period_busdays(period_start, period_end, keys, calendars=None):
+    """Business days in the period for each key (e.g. each advisor), according to their calendar."""
+    keys = pd.Series(keys)
+    return pd.Series(
+        count_busdays(
+            pd.Series(pd.Timestamp(period_start), index=keys.index),
+            pd.Series(pd.Timestamp(period_end), index=keys.index),
+            keys.to_numpy(),
+            calendars
+        ),
+        index=keys.to_numpy()
+    )
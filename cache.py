@@ -0,0 +1,150 @@
+import json
+import functools
+import threading
+from collections import OrderedDict
+
+import plotly.graph_objects as go
+
+### Memoization of the derived tables ###
+## Statistics computed from the tables (e.g. days by type for a year) are cached by (table versions, parameters)
+## and shared by all the outputs and all the sessions of the process. A table change bumps its version,
+## so stale entries are never hit and simply age out of the LRU.
+## Figures are cached as their JSON serialization, in a cache bounded by size rather than by number of entries.
+
+MAX_ENTRIES = 64
+## Total size of the cached figures (bytes of JSON)
+MAX_FIGURE_BYTES = 64 * 1024 * 1024
+
+
+class LRUCache:
+    """
+    Thread-safe mapping dropping the least recently used entries when it holds more than maxsize entries
+    or, if maxbytes is given, more than maxbytes (as measured by sizeof).
+    """
+
+    def __init__(self, maxsize=MAX_ENTRIES, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+            return default
+
+    def put(self, key, value):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = value
+            if self.maxbytes is not None:
+                self.nbytes += self.sizeof(value)
+            while len(self._entries) > 1 and (
+                len(self._entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes)
+            ):
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        value = self._entries.pop(key)
+        if self.maxbytes is not None:
+            self.nbytes -= self.sizeof(value)
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+
+_MISSING = object()
+
+## Every memoized function, for monitoring (see metrics.py)
+MEMOIZED = []
+
+
+def memoize(registry, tables, maxsize=MAX_ENTRIES):
+    """
+    Cache the results of a function computed from tables of the registry (see tables.TableRegistry).
+
+    The key is the version of each table plus the (hashable) arguments. Results are shared: callers must not modify them.
+    """
+    def decorator(func):
+        lru = LRUCache(maxsize)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            versions = tuple(registry.version(name) for name in tables)
+            key = (versions, args)
+            result = lru.get(key, _MISSING)
+            if result is _MISSING:
+                result = func(*args)
+                ## Do not store a result computed while one of the tables changed
+                if tuple(registry.version(name) for name in tables) == versions:
+                    lru.put(key, result)
+            return result
+
+        wrapper.cache = lru
+        wrapper.tables = list(tables)
+        MEMOIZED.append(wrapper)
+        return wrapper
+    return decorator
+
+
+def memoize_figure(registry, tables, maxsize=MAX_ENTRIES, maxbytes=MAX_FIGURE_BYTES):
+    """
+    Cache the Plotly figures built by a function from tables of the registry, like memoize.
+
+    The figures are stored as JSON and every call returns a new FigureWidget (each session owns its widget),
+    built without validation since the JSON comes from a valid figure. The function may return None (nothing to plot).
+    wrapper.warm(*args) builds and stores the figure if it is not cached yet, e.g. to prerender the default views.
+    The widgets carry the size of their JSON as _json_bytes.
+    """
+    def decorator(func):
+        lru = LRUCache(maxsize, maxbytes)
+
+        def cached_json(*args):
+            versions = tuple(registry.version(name) for name in tables)
+            key = (versions, args)
+            result = lru.get(key, _MISSING)
+            if result is _MISSING:
+                fig = func(*args)
+                result = None if fig is None else fig.to_json()
+                if tuple(registry.version(name) for name in tables) == versions:
+                    lru.put(key, result or '')
+            return result or None
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            result = cached_json(*args)
+            if result is None:
+                return None
+            widget = go.FigureWidget(json.loads(result), _validate=False)
+            widget._json_bytes = len(result)
+            return widget
+
+        def warm(*args):
+            key = (tuple(registry.version(name) for name in tables), args)
+            if key not in lru:
+                cached_json(*args)
+
+        wrapper.cache = lru
+        wrapper.tables = list(tables)
+        wrapper.warm = warm
+        MEMOIZED.append(wrapper)
+        return wrapper
+    return decorator
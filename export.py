@@ -0,0 +1,174 @@
+import os
+import zipfile
+import hashlib
+import threading
+from io import TextIOWrapper
+from pathlib import Path
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import FileResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+import cache
+import helpers as hp
+
+### Export of the database ###
+## The tables already loaded by the dashboard are written as an Excel workbook, a zip of Parquet files
+## or a zip of CSV files, with their types (dates stay dates). The files are written chunk by chunk
+## (openpyxl write-only mode, zip entries written as streams) and stored on disk under the fingerprint
+## of the data: they are written once per data version and served with the fingerprint as ETag.
+
+app_dir = Path(__file__).parent
+
+EXPORT_PATH = Path(os.getenv('WASH_EXPORT_PATH', app_dir / 'data' / 'exports'))
+FILE_NAME = 'wash_sal_db'
+## Rows converted and written at a time
+CHUNK_ROWS = 5000
+## Older exports kept in each format: a client that got the previous ETag may still be downloading it
+KEEP_PREVIOUS = 1
+
+## format: (file suffix, media type)
+FORMATS = {
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'),
+    'parquet': ('.parquet.zip', 'application/zip'),
+    'csv': ('.csv.zip', 'application/zip'),
+}
+
+_lock = threading.Lock()
+
+
+def _tables():
+    """The tables of the registry (loading them if needed), in the order of the registry."""
+    tables = {name: hp.TABLES.get(name) for name in hp.TABLES.names}
+    return {name: data for name, data in tables.items() if data is not None}
+
+
+@cache.memoize(hp.TABLES, hp.TABLES.names, maxsize=2)
+def fingerprint():
+    """Hash of the content of all the tables, the same in every worker and after a restart."""
+    digest = hashlib.sha1()
+    for name, data in _tables().items():
+        digest.update(name.encode())
+        digest.update(repr(list(data.columns)).encode())
+        digest.update(pd.util.hash_pandas_object(data.astype(object), index=False).to_numpy().tobytes())
+    return digest.hexdigest()[:20]
+
+
+def _chunks(data):
+    """The table as chunks of python values (missing values as None)."""
+    for start in range(0, len(data), CHUNK_ROWS):
+        chunk = data.iloc[start:start + CHUNK_ROWS].astype(object)
+        yield chunk.where(chunk.notna(), None)
+
+
+## WRITERS ##
+
+def write_xlsx(tables, path):
+    """One worksheet per table, written row by row."""
+    workbook = Workbook(write_only=True)
+    for name, data in tables.items():
+        sheet = workbook.create_sheet(title=name[:31])
+        sheet.append([str(col) for col in data.columns])
+        dates = [pd.api.types.is_datetime64_any_dtype(dtype) for dtype in data.dtypes]
+        for chunk in _chunks(data):
+            for row in chunk.itertuples(index=False):
+                cells = []
+                for value, is_date in zip(row, dates):
+                    if is_date and value is not None:
+                        value = WriteOnlyCell(sheet, value=value.to_pydatetime())
+                        value.number_format = 'yyyy-mm-dd'
+                    cells.append(value)
+                sheet.append(cells)
+    workbook.save(path)
+
+
+def _arrow_table(data):
+    try:
+        return pa.Table.from_pandas(data, preserve_index=False)
+    except (pa.ArrowInvalid, pa.ArrowTypeError):
+        ## e.g. a column mixing numbers and text: export the text columns as strings
+        text = data.select_dtypes(include=['object']).columns
+        return pa.Table.from_pandas(data.astype({col: 'string' for col in text}), preserve_index=False)
+
+
+def write_parquet(tables, path):
+    """One Parquet file per table in a zip (stored, Parquet is already compressed)."""
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, data in tables.items():
+            table = _arrow_table(data)
+            with archive.open(f'{name}.parquet', 'w', force_zip64=True) as entry:
+                with pq.ParquetWriter(entry, table.schema) as writer:
+                    for batch in table.to_batches(max_chunksize=CHUNK_ROWS):
+                        writer.write_batch(batch)
+
+
+def write_csv(tables, path):
+    """One CSV file per table in a zip, dates as YYYY-MM-DD."""
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in tables.items():
+            with archive.open(f'{name}.csv', 'w', force_zip64=True) as entry:
+                with TextIOWrapper(entry, encoding='utf-8', newline='') as text:
+                    for start in range(0, max(len(data), 1), CHUNK_ROWS):
+                        data.iloc[start:start + CHUNK_ROWS].to_csv(text, index=False, header=start == 0, date_format='%Y-%m-%d')
+
+
+WRITERS = {'xlsx': write_xlsx, 'parquet': write_parquet, 'csv': write_csv}
+
+
+def export(fmt):
+    """Path and ETag of the export of the current tables in the format, written if it does not exist yet."""
+    suffix = FORMATS[fmt][0]
+    etag = f'{fingerprint()}-{fmt}'
+    path = EXPORT_PATH / f'{FILE_NAME}.{etag}{suffix}'
+    if path.exists():
+        return path, etag
+    with _lock:
+        if not path.exists():
+            EXPORT_PATH.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(f'.{path.name}.tmp')
+            WRITERS[fmt](_tables(), tmp)
+            os.replace(tmp, path)
+            _remove_old(fmt, path)
+    return path, etag
+
+
+def _remove_old(fmt, current):
+    """Remove the exports in the format older than the current one, except the KEEP_PREVIOUS newest."""
+    older = []
+    for path in EXPORT_PATH.glob(f'{FILE_NAME}.*-{fmt}{FORMATS[fmt][0]}'):
+        try:
+            if path != current:
+                older.append((path.stat().st_mtime, path))
+        except FileNotFoundError:
+            ## Removed by another worker in the meantime
+            pass
+    for _, path in sorted(older, reverse=True)[KEEP_PREVIOUS:]:
+        path.unlink(missing_ok=True)
+
+
+## ROUTE ##
+
+async def download(request):
+    """GET export/<format>: the export file, or 304 if the client has the current version."""
+    fmt = request.path_params['fmt']
+    if fmt not in FORMATS:
+        return PlainTextResponse(f'Unknown format, use one of {", ".join(FORMATS)}', status_code=404)
+    try:
+        path, etag = await run_in_threadpool(export, fmt)
+    except Exception as e:
+        print(f'Oops, something went wrong while exporting the database as {fmt}.\nException: {str(e)}')
+        return PlainTextResponse('Could not export the database, please retry.', status_code=500)
+
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': 'no-cache'}
+    if request.headers.get('if-none-match') == headers['ETag']:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=FORMATS[fmt][1], filename=f'{FILE_NAME}{FORMATS[fmt][0]}', headers=headers)
+
+
+## Mounted next to the Shiny app (see app.py)
+ROUTES = [Route('/export/{fmt}', download)]
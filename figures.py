@@ -0,0 +1,444 @@
+import time
+import threading
+from datetime import datetime, timedelta, date
+
+import pandas as pd
+import plotly.express as px
+import plotly.io as pio
+pio.templates.default = "ggplot2"
+
+import cache
+import helpers as hp
+
+### Figures of the dashboard ###
+## Each figure is a function of the tables and of normalized (hashable) input values, cached by data version
+## and inputs and shared by all sessions (see cache.memoize_figure). The views a new session shows first are
+## prerendered in the background whenever a table changes, so that the first paint is a cache hit.
+
+## Seconds to wait after a change before prerendering (a reload replaces several tables in a row)
+PRERENDER_DELAY = 0.5
+## Events loaded before and after the range shown by the calendar timeline, to pan without rebuilding it
+CALENDAR_MARGIN = pd.DateOffset(weeks=8)
+
+
+## CALENDAR ##
+
+@cache.memoize_figure(hp.TABLES, ['calendar', 'types'])
+def calendar_timeline(advisors, start, end, today):
+    """Timeline of the calendar entries of the advisors overlapping start - end (dates or None for everything)."""
+    data = hp.TABLES.get('calendar')
+    filtered_calendar = data.iloc[hp.ROW_INDEX['calendar']().select(advisor=advisors)]
+    if filtered_calendar.empty:
+        return None
+    if start and end:
+        ## Only the events of the window are sent to the browser (see calendar_window), it may be empty
+        filtered_calendar = filtered_calendar[filtered_calendar.index.isin(hp.INTERVALS.update(data).overlapping(start, end))]
+    ## If remarks is nan it creates an error when plotting (cannot create JSON object from nan)
+    ## TO DO this is a temporary workaround, find another way to fix this!
+    filtered_calendar = filtered_calendar.assign(remarks=filtered_calendar.remarks.fillna(' '))
+
+    ## Ensure the dataframe is valid
+    if filtered_calendar[['start_date', 'end_date']].isna().any().any():
+        return None  # Return an empty plot or suitable default
+
+    ## Transform date range into a datetime object to be used in the range_x of px.timeline
+    range_x_start = datetime(start.year, start.month, start.day) if start else None
+    range_x_end = datetime(end.year, end.month, end.day) if end else None
+
+    ## eEnsure that single days events are represented with a visible width
+    single_day_mask = filtered_calendar.start_date == filtered_calendar.end_date
+    filtered_calendar.loc[single_day_mask, 'end_date'] = filtered_calendar.end_date + timedelta(hours=11, minutes=59)
+
+    hover_data={
+        'start_date':False,
+        'end_date':False,
+        'advisor':False,
+        'type':False,
+        'from':filtered_calendar.start_date.apply(hp.date_prettify),
+        'to':filtered_calendar.end_date.apply(hp.date_prettify)
+    }
+
+    fig = px.timeline(
+        data_frame=filtered_calendar,
+        x_start='start_date',
+        x_end='end_date',
+        y='advisor',
+        color='type',
+        color_discrete_map=dict(zip(hp.TABLES.get('types').type, hp.TYPE_PALETTE)),
+        hover_name='type',
+        hover_data=hover_data,
+        text='remarks',
+        range_x=[range_x_start, range_x_end] if range_x_start and range_x_end else None,
+        labels={'type':'', 'advisor':''}
+    )
+    fig.update_xaxes(
+        tickformat='%d-%b', dtick=86400000.0*7,
+        rangeslider_visible=False,
+    )
+    fig.update_traces(textposition='inside')
+    fig.add_vline(x=today, line_dash='dot', line_width=3, opacity=1, line_color='black')
+
+    return fig
+
+@cache.memoize_figure(hp.TABLES, ['calendar', 'advisors', 'countries'])
+def workload_heatmap(year, freq):
+    """Share of busy business days by advisor and week or month of the year (or of all years)."""
+    occ = hp.OCCUPANCY.update(hp.TABLES.get('calendar'), hp.advisor_work_calendars())
+    if not occ.advisors:
+        return None
+    if year == 'All':
+        start, end = occ.days[0], occ.days[-1]
+    else:
+        start, end = f'{year}-01-01', f'{year}-12-31'
+    data = occ.workload(start, end, freq)
+
+    fig = px.imshow(
+        data,
+        color_continuous_scale='Reds',
+        zmin=0,
+        zmax=1,
+        aspect='auto',
+        labels={'x': '', 'y': '', 'color': 'Busy'}
+    )
+    fig.update_coloraxes(colorbar_tickformat='.0%')
+    fig.update_traces(hovertemplate='%{y} - %{x|%d-%b-%Y}: %{z:.0%}<extra></extra>')
+    return fig
+
+@cache.memoize_figure(hp.TABLES, ['calendar', 'advisors', 'countries'])
+def days_by_type_bar(year):
+    data = hp.days_by_type(year)
+
+    fig = px.bar(
+        data_frame = data,
+        x='total_busdays',
+        y='type',
+        color='advisor',
+        color_discrete_map=dict(zip(sorted(hp.TABLES.get('advisors').short_name), hp.ADVISOR_PALETTE)),
+        barmode='group',
+        labels={'type': '', 'advisor':'', 'total_busdays': 'Total business days'}
+    )
+    fig.update_layout(legend=dict(y=1.1, orientation='h'))
+
+    return fig
+
+
+## COUNTRY ALLOCATION ##
+
+@cache.memoize_figure(hp.TABLES, ['countries', 'advisors'])
+def allocation_map(regions):
+    data = hp.TABLES.get('countries')
+    filtered_countries = data.iloc[hp.ROW_INDEX['countries']().select(Continent=regions)]
+
+    hover_data = {
+        'ta_focal': False,
+        'ISO 3166 alpha3': False,
+        'Focal TA': filtered_countries.ta_focal,
+    }
+
+    fig = px.choropleth(
+        data_frame=filtered_countries,
+        locations='ISO 3166 alpha3',
+        color='ta_focal',
+        color_discrete_map=dict(zip(sorted(hp.TABLES.get('advisors').short_name), hp.ADVISOR_PALETTE)),
+        hover_name='CIA Name',
+        hover_data=hover_data,
+        labels={'ta_focal': 'Focal Point'},
+    )
+    fig.update_geos(fitbounds='locations')
+    fig.update_layout(legend=dict(y=1.1, orientation='h'))
+
+    return fig
+
+@cache.memoize_figure(hp.TABLES, ['countries', 'advisors'])
+def allocation_bar(regions):
+    data = hp.TABLES.get('countries')
+    filtered_countries = data.iloc[hp.ROW_INDEX['countries']().select(Continent=regions)]
+
+    fig = px.bar(
+        data_frame=filtered_countries.groupby('ta_focal', observed=True).agg('count').reset_index(),
+        x='ta_focal',
+        y='CIA Name',
+        color='ta_focal',
+        color_discrete_map=dict(zip(sorted(hp.TABLES.get('advisors').short_name), hp.ADVISOR_PALETTE)),
+        labels={'ta_focal':'','CIA Name':'Number of countries'}
+    )
+
+    fig.update_layout(xaxis={'categoryorder':'total descending'}, showlegend=False)
+
+    return fig
+
+
+## COUNTRIES OVERVIEW ##
+
+@cache.memoize_figure(hp.TABLES, ['risk_matrix', 'countries'])
+def risk_matrix_map():
+    matrix_df = hp.TABLES.get('risk_matrix')
+    countries_df = hp.TABLES.get('countries')
+    matrix_df = matrix_df.assign(remarks=matrix_df.remarks.fillna('-'))
+
+    merged = pd.merge(
+        left=matrix_df,
+        right=countries_df[['CIA Name','ISO 3166 alpha3']],
+        left_on='country',
+        right_on='CIA Name',
+        right_index=False,
+    )
+
+    hover_data = {
+        'country': False,
+        'ISO 3166 alpha3': False,
+        'score': False,
+        'Description': merged.description,
+        'Remarks': merged.remarks,
+    }
+
+    fig = px.choropleth(
+        data_frame=merged,
+        locations='ISO 3166 alpha3',
+        color='score',
+        color_continuous_scale='RdYlGn_r',
+        hover_name='country',
+        hover_data=hover_data,
+        labels={'country': 'Country', 'description': 'Description', 'remarks': 'Remarks'},
+        title="Country classification by WASH/Engineering capacity/risk"
+    )
+    fig.update_geos(fitbounds='locations')
+    fig.update_layout(legend=dict(y=1.1, orientation='h'))
+
+    return fig
+
+@cache.memoize_figure(hp.TABLES, ['programmes', 'countries'])
+def programmes_map(max_year):
+    ## Group by country and filter by date (only projects still active)
+    df = hp.active_programmes(max_year, 'sub_sector')
+
+    merged = pd.merge(
+        left=df,
+        right=hp.TABLES.get('countries')[['CIA Name','ISO 3166 alpha3']],
+        left_on='country',
+        right_on='CIA Name',
+        right_index=False,
+    )
+
+    fig = px.scatter_geo(
+        data_frame=merged,
+        locations="ISO 3166 alpha3",
+        hover_name="country",
+        size="no_programmes",
+        projection="natural earth",
+        opacity=1,
+        title=f"WASH/Engineering Programmes (active as of {max_year})"
+    )
+
+    return fig
+
+@cache.memoize_figure(hp.TABLES, ['programmes'])
+def programmes_bar(max_year, donor_switch):
+    ## Group by country and filter by date (only projects still active)
+    if not donor_switch:
+        data = hp.active_programmes(max_year, 'sub_sector')
+        labels = {'country': '', 'no_programmes': 'Total number of programmes', 'sub_sector': 'Sector'}
+        color = 'sub_sector'
+    else:
+        data = hp.active_programmes(max_year, 'donor')
+        labels = {'country': '', 'no_programmes': 'Total number of programmes', 'donor': 'Donor'}
+        color = 'donor'
+
+    fig = px.bar(
+        data_frame = data,
+        x='country',
+        y='no_programmes',
+        color=color,
+        color_discrete_sequence=px.colors.sequential.Plasma_r,
+        labels=labels,
+        title=f"Total number of programmes with WASH/Engineering component by country (active as of {max_year})"
+    )
+
+    fig.update_layout(xaxis={'categoryorder':'total descending'})
+    fig.update_xaxes(tickangle=45)
+
+    return fig
+
+
+## COUNTRY CALLS ##
+
+@cache.memoize_figure(hp.TABLES, ['country_calls'])
+def calls_by_country_bar(year):
+    ## group by country and filter by date
+    data, period = hp.calls_by(year, 'country')
+
+    fig = px.bar(
+        data_frame = data,
+        x='country',
+        y='no_calls',
+        color='no_calls',
+        color_continuous_scale='Blues',
+        labels={'country': '', 'no_calls': 'Total number of calls'},
+        title=f"Total number of calls by country ({period})"
+    )
+
+    fig.update_layout(xaxis={'categoryorder':'total descending'})
+    fig.update_xaxes(tickangle=45)
+    fig.update_coloraxes(showscale=False)
+
+    return fig
+
+@cache.memoize_figure(hp.TABLES, ['country_calls'])
+def calls_by_advisor_bar(year):
+    ## group by advisor and filter by date
+    data, period = hp.calls_by(year, 'advisor')
+
+    fig = px.bar(
+        data_frame = data,
+        x='sal_attendees',
+        y='no_calls',
+        color='no_calls',
+        color_continuous_scale='Reds',
+        labels={'sal_attendees': '', 'no_calls': 'Total number of calls'},
+        title=f"Total number of calls by advisor ({period})"
+    )
+
+    fig.update_layout(xaxis={'categoryorder':'total descending'})
+    fig.update_xaxes(tickangle=45)
+    fig.update_coloraxes(showscale=False)
+
+    return fig
+
+
+## IN-PLACE UPDATES ##
+## Inputs that only change which part of a figure is shown (date range, filters) are applied to the
+## FigureWidget of the session with relayout / restyle patches, the figure is only rebuilt when the data changes.
+## The patches go through plotly_relayout / plotly_restyle: the cached figures are built without validation
+## and setting their properties directly would not be sent to the browser.
+
+## Trace properties with one value per point
+POINT_PROPS = ['locations', 'z', 'customdata', 'hovertext', 'text', 'ids']
+
+def set_x_range(widget, start, end):
+    """Zoom the x axis on start - end."""
+    widget.plotly_relayout({'xaxis.range': [pd.Timestamp(start).isoformat(), pd.Timestamp(end).isoformat()]})
+
+def show_categories(widget, selected):
+    """Show only the selected categories of the y axis (e.g. the advisors of the timeline), keeping their order."""
+    order = []
+    for trace in widget.data:
+        for value in trace.y if trace.y is not None else ():
+            if value not in order:
+                order.append(value)
+    shown = [value for value in order if value in selected]
+    hidden = [value for value in order if value not in selected]
+    if not hidden:
+        widget.plotly_relayout({'yaxis.categoryorder': 'trace', 'yaxis.autorange': True})
+    else:
+        ## The hidden categories are put after the shown ones, outside of the axis range
+        widget.plotly_relayout({
+            'yaxis.categoryorder': 'array',
+            'yaxis.categoryarray': shown + hidden,
+            'yaxis.range': [-0.5, len(shown) - 0.5],
+        })
+
+def filter_points(widget, keep, key='locations'):
+    """Show only the points whose key (e.g. the ISO code of a map location) is in keep."""
+    ## The complete traces are kept on the widget, to filter again from them on the next change
+    full = getattr(widget, '_full_traces', None)
+    if full is None:
+        full = widget._full_traces = [trace.to_plotly_json() for trace in widget.data]
+    for index, props in enumerate(full):
+        points = props.get(key)
+        if points is None:
+            continue
+        mask = [point in keep for point in points]
+        widget.plotly_restyle({
+            prop: [[value for value, shown in zip(values, mask) if shown]]
+            for prop, values in props.items()
+            if prop in POINT_PROPS and len(values) == len(points)
+        }, trace_indexes=[index])
+
+def set_bar_heights(widget, heights):
+    """Set the bar of each single-bar trace (named by its category) to its height in heights, hiding the empty ones."""
+    values = [heights.get(trace.name, 0) for trace in widget.data]
+    widget.plotly_restyle({
+        'y': [[value] for value in values],
+        'visible': [bool(value) for value in values],
+    }, trace_indexes=list(range(len(values))))
+
+
+## DEFAULT VIEWS ##
+
+def calendar_window(start, end, window=None):
+    """
+    Dates of the events to plot in the timeline for showing start - end: the current window if it covers
+    the range, otherwise the range plus CALENDAR_MARGIN on both sides, extended to whole months so that
+    the sessions share the same windows (and cached figures).
+    """
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+    if window is not None and pd.Timestamp(window[0]) <= start and end <= pd.Timestamp(window[1]):
+        return window
+    return (
+        (start - CALENDAR_MARGIN).to_period('M').start_time.date(),
+        (end + CALENDAR_MARGIN).to_period('M').end_time.date(),
+    )
+
+def default_calendar_range(first_date, today=None):
+    """Dates shown by the calendar timeline of a new session, on the 14-day steps of the date slider starting at first_date."""
+    today = today or date.today()
+    first = pd.Timestamp(first_date).date()
+    def snap(day):
+        return first + timedelta(days=14 * round((day - first).days / 14))
+    return snap(today - timedelta(weeks=2)), snap(today + timedelta(weeks=6))
+
+def default_views():
+    """(figure, arguments) of the figures as a new session first shows them, for the loaded tables only."""
+    today = date.today()
+    year = str(today.year)
+    views = []
+    if all(hp.TABLES.is_loaded(name) for name in ['calendar', 'types']):
+        calendar = hp.TABLES.get('calendar')
+        if calendar.start_date.notna().any():
+            advisors = tuple(sorted(calendar.advisor.dropna().unique()))
+            window = calendar_window(*default_calendar_range(calendar.start_date.min(), today))
+            views.append((calendar_timeline, (advisors, *window, today)))
+    if all(hp.TABLES.is_loaded(name) for name in ['calendar', 'advisors', 'countries']):
+        views += [(workload_heatmap, (year, 'W')), (days_by_type_bar, (year,))]
+    if all(hp.TABLES.is_loaded(name) for name in ['countries', 'advisors']):
+        regions = tuple(sorted(hp.TABLES.get('countries').Continent.dropna().unique()))
+        views += [(allocation_map, (regions,)), (allocation_bar, (regions,))]
+    if all(hp.TABLES.is_loaded(name) for name in ['risk_matrix', 'countries']):
+        views.append((risk_matrix_map, ()))
+    if all(hp.TABLES.is_loaded(name) for name in ['programmes', 'countries']):
+        views += [(programmes_map, (year,)), (programmes_bar, (year, False))]
+    if hp.TABLES.is_loaded('country_calls'):
+        calls = hp.TABLES.get('country_calls')
+        last_year = str(int(calls.date.dt.year.max())) if calls.date.notna().any() else 'All'
+        views += [(calls_by_country_bar, (last_year,)), (calls_by_advisor_bar, (last_year,))]
+    return views
+
+
+class Prerenderer:
+    """Background thread building the default views after the tables changed."""
+
+    def __init__(self, delay=PRERENDER_DELAY):
+        self.delay = delay
+        self._wake = threading.Event()
+        self._thread = None
+
+    def schedule(self, names=None):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='figure-prerender', daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            time.sleep(self.delay)
+            self._wake.clear()
+            for figure, args in default_views():
+                try:
+                    figure.warm(*args)
+                except Exception as e:
+                    print(f'Could not prerender {figure.__name__}: {str(e)}')
+
+
+PRERENDERER = Prerenderer()
+hp.TABLES.on_change(PRERENDERER.schedule)
@@ -0,0 +1,194 @@
+import os
+import time
+import random
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from gspread.exceptions import APIError
+from gspread.http_client import HTTPClient
+
+### Gateway to the Google Sheets API ###
+## All the requests of the process to the Sheets and Drive APIs go through one authorized HTTP session
+## (connections reused, access token refreshed when it expires). Requests are paced by token buckets sized
+## on the per-minute read and write quotas, retried with exponential backoff on 429 and 5xx responses (writes
+## only when the quota was exceeded), and identical reads made at the same time (e.g. several sessions opening the dashboard) are sent once.
+
+## Requests per minute allowed by the quotas of the service account (Sheets default: 60 reads, 60 writes)
+READS_PER_MINUTE = int(os.getenv('WASH_SHEETS_READS_PER_MINUTE', 60))
+WRITES_PER_MINUTE = int(os.getenv('WASH_SHEETS_WRITES_PER_MINUTE', 60))
+## Attempts after the first one, and longest wait between two attempts (seconds)
+MAX_RETRIES = 5
+MAX_BACKOFF = 64
+## Responses worth retrying: timeout, quota exceeded, server errors
+RETRY_STATUS = {408, 429, 500, 502, 503, 504}
+## Writes are only retried when the API guarantees they were not applied (quota exceeded): a batch_update deleting
+## rows by position or appending rows must not run twice. Other failed writes fail the save, which is retried as
+## a full rewrite of the table (see storage.SheetsBackend.write_table)
+WRITE_RETRY_STATUS = {429}
+## Connections kept open to the API
+POOL_SIZE = 8
+
+
+class TokenBucket:
+    """Allows rate_per_minute calls per minute on average and bursts of up to burst calls."""
+
+    def __init__(self, rate_per_minute, burst=None):
+        self.rate = rate_per_minute / 60
+        self.capacity = burst or max(1, rate_per_minute // 4)
+        self.tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Take a token, waiting for one if needed. Returns the seconds waited."""
+        waited = 0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Calls with the same key made while one is running wait for it and get its result (or its exception)."""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        """Return (result, whether it was shared with a call already running)."""
+        with self._lock:
+            call = self._calls.get(key)
+            shared = call is not None
+            if not shared:
+                call = self._calls[key] = _Call()
+        if shared:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = func()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+def _retryable(error, method='GET'):
+    read = method.upper() == 'GET'
+    if isinstance(error, (requests.ConnectionError, requests.Timeout)):
+        return read
+    if error.code in (RETRY_STATUS if read else WRITE_RETRY_STATUS):
+        return True
+    ## Drive answers 403 when its rate limit is exceeded
+    reasons = {e.get('reason') for e in error.error.get('errors', [])} if isinstance(error.error, dict) else set()
+    return error.code == 403 and bool(reasons & {'rateLimitExceeded', 'userRateLimitExceeded'})
+
+
+def _retry_after(error):
+    response = getattr(error, 'response', None)
+    try:
+        return float(response.headers['Retry-After'])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+def _key(value):
+    ## Hashable form of the request parameters
+    if isinstance(value, dict):
+        return tuple(sorted((k, _key(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_key(v) for v in value)
+    return value
+
+
+class Gateway:
+    """Paces, retries and merges the requests of the process to the API (see GatewayHTTPClient)."""
+
+    def __init__(self, reads_per_minute=READS_PER_MINUTE, writes_per_minute=WRITES_PER_MINUTE, max_retries=MAX_RETRIES):
+        self.reads = TokenBucket(reads_per_minute)
+        self.writes = TokenBucket(writes_per_minute)
+        self.max_retries = max_retries
+        self.single_flight = SingleFlight()
+        ## Counters, e.g. for monitoring
+        self.requests = 0
+        self.retries = 0
+        self.merged = 0
+        self.waited = 0.0
+        self._listeners = []
+
+    def on_response(self, callback):
+        """Call callback(method, url, params, status, seconds) after every attempt (status: HTTP code or exception name)."""
+        self._listeners.append(callback)
+
+    def _notify(self, method, url, params, status, seconds):
+        for callback in self._listeners:
+            try:
+                callback(method, url, params, status, seconds)
+            except Exception as e:
+                print(f'Something went wrong while recording a Sheets API request: {str(e)}')
+
+    def request(self, method, url, params, send):
+        """Send the request with send(), reads (GET) being merged with the identical ones in flight."""
+        if method.upper() != 'GET':
+            return self._send(self.writes, send, (method, url, params))
+        response, shared = self.single_flight.do((url, _key(params)), lambda: self._send(self.reads, send, (method, url, params)))
+        if shared:
+            self.merged += 1
+        return response
+
+    def _send(self, bucket, send, call):
+        for attempt in range(self.max_retries + 1):
+            self.waited += bucket.acquire()
+            self.requests += 1
+            start = time.monotonic()
+            try:
+                response = send()
+                self._notify(*call, getattr(response, 'status_code', 200), time.monotonic() - start)
+                return response
+            except (APIError, requests.ConnectionError, requests.Timeout) as e:
+                self._notify(*call, getattr(e, 'code', type(e).__name__), time.monotonic() - start)
+                if attempt == self.max_retries or not _retryable(e, call[0]):
+                    raise
+                ## Exponential backoff with jitter, unless the API says how long to wait
+                delay = _retry_after(e) or min(MAX_BACKOFF, 2 ** attempt) * random.uniform(0.5, 1)
+                code = getattr(e, 'code', type(e).__name__)
+                print(f'Sheets API request failed ({code}), retrying in {delay:.1f}s ({attempt + 1}/{self.max_retries})')
+                self.retries += 1
+                time.sleep(delay)
+
+
+## Shared by all the clients of the process
+GATEWAY = Gateway()
+
+
+class GatewayHTTPClient(HTTPClient):
+    """gspread HTTP client sending every request through GATEWAY, on a pooled authorized session."""
+
+    def __init__(self, auth, session=None):
+        super().__init__(auth, session)
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE)
+        self.session.mount('https://', adapter)
+
+    def request(self, method, endpoint, params=None, **kwargs):
+        return GATEWAY.request(method, endpoint, params, lambda: super(GatewayHTTPClient, self).request(method, endpoint, params=params, **kwargs))
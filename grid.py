@@ -0,0 +1,119 @@
+import numpy as np
+import pandas as pd
+from shiny.types import SilentException
+
+### Server-side paging of the data grids ###
+## The grids only receive one page of rows. The tables are formatted for display once per version,
+## and the rows are filtered and sorted on the server, including the sort and the column filters
+## set in the grid header, so that paging goes through the whole table.
+## When a new page shows the same rows as the previous one (e.g. after an edit) only the changed cells are sent.
+
+PAGE_SIZE = 100
+## Dates are shown as ISO strings: the grid sorts a page in the same order as the server
+DATE_FORMAT = '%Y-%m-%d'
+
+
+def display_frame(data, date_columns):
+    """Copy of the table with the dates formatted for the grid."""
+    return data.assign(**{column: data[column].dt.strftime(DATE_FORMAT) for column in date_columns})
+
+
+def ordered_rows(data, rows, by=None, ascending=True):
+    """The positions rows of data, sorted by the column by (default: by the index)."""
+    rows = data.assign(_position=np.arange(len(data))).iloc[rows]
+    rows = rows.sort_index(ascending=ascending, kind='stable') if by is None else rows.sort_values(by, ascending=ascending, kind='stable')
+    return rows._position.to_numpy()
+
+
+## Sort and filters of the grid header, as hashable keys for the memoized helpers
+
+def sort_key(renderer):
+    """((column number, descending), ...) of the grid, empty until the grid reports it."""
+    try:
+        return tuple((int(sort['col']), bool(sort['desc'])) for sort in renderer.sort())
+    except SilentException:
+        return ()
+
+def filter_key(renderer):
+    """((column number, text or (min, max)), ...) of the grid, empty until the grid reports it."""
+    try:
+        return tuple(
+            (int(f['col']), f['value'] if isinstance(f['value'], str) else tuple(f['value']))
+            for f in renderer.filter()
+        )
+    except SilentException:
+        return ()
+
+
+def select_rows(display, rows, sort=(), filters=()):
+    """The positions rows of display passing the column filters, sorted by the sort columns (see sort_key / filter_key)."""
+    rows = np.asarray(rows)
+    data = display.iloc[rows]
+    keep = np.ones(len(data), dtype=bool)
+    for column, value in filters:
+        values = data.iloc[:, column]
+        if isinstance(value, str):
+            keep &= values.astype(object).fillna('').astype(str).str.contains(value, case=False, regex=False).to_numpy()
+        else:
+            low, high = value
+            if low is not None:
+                keep &= (values >= low).to_numpy()
+            if high is not None:
+                keep &= (values <= high).to_numpy()
+    rows, data = rows[keep], data[keep]
+    if sort:
+        order = data.reset_index(drop=True).sort_values(
+            [data.columns[column] for column, _ in sort],
+            ascending=[not desc for _, desc in sort],
+            kind='stable',
+        ).index.to_numpy()
+        rows = rows[order]
+    return rows
+
+
+class Pager:
+    """The page shown by a grid of a session, sent to the browser as a whole or as changed cells."""
+
+    def __init__(self, size=PAGE_SIZE):
+        self.size = size
+        self.shown = None
+
+    def pages(self, rows):
+        return max(1, -(-len(rows) // self.size))
+
+    def page(self, display, rows, number):
+        """Rows of display on the page number (clipped to the last page)."""
+        start = min(number, self.pages(rows) - 1) * self.size
+        return display.iloc[rows[start:start + self.size]]
+
+    def describe(self, rows, number):
+        """'first - last of total' rows on the page number."""
+        start = min(number, self.pages(rows) - 1) * self.size
+        return f'{min(start + 1, len(rows))} - {min(start + self.size, len(rows))} of {len(rows)}'
+
+    def first(self, page, columns):
+        """The page to render the grid with: page() or, if it cannot be computed yet (e.g. the filters are not rendered), no rows."""
+        try:
+            self.shown = page()
+        except SilentException:
+            self.shown = pd.DataFrame(columns=list(columns))
+        return self.shown
+
+    async def show(self, renderer, page):
+        """Send the page to the rendered grid: only the changed cells if it has the same rows as the shown one."""
+        shown = self.shown
+        if shown is None:
+            ## Not rendered yet, the grid will be rendered with the current page
+            return
+        self.shown = page
+        if shown.index.equals(page.index) and shown.columns.equals(page.columns):
+            ## As objects: categoricals with different categories cannot be compared
+            shown, compared = shown.astype(object), page.astype(object)
+            changed = ((shown != compared) & ~(shown.isna() & compared.isna())).to_numpy()
+            for row, col in zip(*np.nonzero(changed)):
+                value = page.iat[row, col]
+                value = None if pd.isna(value) else value.item() if hasattr(value, 'item') else value
+                await renderer.update_cell_value(value, row=int(row), col=int(col))
+        else:
+            await renderer.update_data(page)
+            await renderer.update_cell_selection(None)
@@ -1,14 +1,27 @@
 from shiny import ui, reactive
 import pandas as pd
-import numpy as np
 from datetime import datetime, timedelta
 from pathlib import Path
 import os
+import atexit
+import functools
 
 import gspread
-from gspread_dataframe import set_with_dataframe, get_as_dataframe
 from google.oauth2.service_account import Credentials
 
+import storage
+import gateway
+import journal
+import tables
+import snapshot
+import shared
+import busdays
+import occupancy
+import intervals
+import cache
+import grid
+import lookup
+
 # from crud_helpers import CRUDHelper
 
 ### Colour palettes
@@ -39,7 +52,7 @@ def initialize_gspread():
                 scopes=scope
             )
             # Authenticate and create client
-            return gspread.authorize(credentials)
+            return gspread.authorize(credentials, http_client=gateway.GatewayHTTPClient)
         except FileNotFoundError:
             credentials = {
                 "type": "service_account",
@@ -55,7 +68,7 @@ def initialize_gspread():
                 "universe_domain": "googleapis.com"
             }
             # Authenticate from dictionary
-            return gspread.service_account_from_dict(credentials)
+            return gspread.service_account_from_dict(credentials, http_client=gateway.GatewayHTTPClient)
 
     credentials = {
             "type": "service_account",
@@ -71,207 +84,358 @@ def initialize_gspread():
             "universe_domain": "googleapis.com"
         }
     # Authenticate from dictionary
-    return gspread.service_account_from_dict(credentials)
+    return gspread.service_account_from_dict(credentials, http_client=gateway.GatewayHTTPClient)
+
+@functools.lru_cache(maxsize=1)
+def gspread_client():
+    """The client of the process, authorized once (its session refreshes the access token, see gateway.py)."""
+    return initialize_gspread()
 
 def get_data_file():
-    gs_client = initialize_gspread()
-    return gs_client.open_by_key(GS_FILE_ID)
-
-DATA_FILE = get_data_file()
-
-advisors = get_as_dataframe(DATA_FILE.worksheet('advisors'))
-countries = get_as_dataframe(DATA_FILE.worksheet('countries'))
-types = get_as_dataframe(DATA_FILE.worksheet('types')).type.to_list()
-risk_matrix = get_as_dataframe(DATA_FILE.worksheet('risk_matrix'))
-programmes = get_as_dataframe(DATA_FILE.worksheet('programmes'))
-programmes['start_year'] = pd.to_datetime(programmes.start_year, format="%Y", errors='coerce')
-programmes['end_year'] = pd.to_datetime(programmes.end_year, format="%Y", errors='coerce')
-programmes = programmes.sort_values(by=['end_year', 'start_year'])
-
-def import_calendar():
-    calendar = DATA_FILE.worksheet('calendar')
-    try:
-        data = get_as_dataframe(calendar)
-        ## Convert dates to datetime
-        data['start_date'] = pd.to_datetime(data.start_date, dayfirst=True, errors='raise', format='mixed')#format='%d-%b-%Y')
-        data['end_date'] = pd.to_datetime(data.end_date, dayfirst=True, errors='raise', format='mixed')#format='%d-%b-%Y')
-        return data
-    except Exception as e:
-        print(f'Oops, something went wrong while trying to import the calendar db.\nException: {str(e)}')
-        return None
-
-def update_calendar(data):
-    calendar = DATA_FILE.worksheet('calendar')
-    try:
-        calendar.clear()
-        set_with_dataframe(calendar, data)
-        print(f'Successfully saved to file')
-    except Exception as e:
-        print(f'Something went wrong: {str(e)}')
-    
-    ## Format datetime columns in Google Sheets
-    # Identify datetime columns
-    datetime_columns = data.select_dtypes(include=['datetime64[ns]']).columns    
-    datetime_cols_indices = [data.columns.get_loc(col) + 1 for col in datetime_columns]
-    for col_index in datetime_cols_indices:
-        calendar.format(f'{chr(64 + col_index)}2:{chr(64 + col_index)}{len(data) + 1}', {
-            "numberFormat": {
-                "type": "DATE_TIME",
-                "pattern": "dd-mm-yyyy"
-            }
-        })
-        
-def import_country_calls():
-    country_calls = DATA_FILE.worksheet('country_calls')
-    try:
-        data = get_as_dataframe(country_calls)
-        ## Convert dates to datetime
-        data['date'] = pd.to_datetime(data.date, dayfirst=True, errors='raise', format='mixed')
-        return data
-    except Exception as e:
-        print(f'Oops, something went wrong while trying to import the calls db.\nException: {str(e)}')
-        return None
-
-def update_country_calls(data):
-    country_calls = DATA_FILE.worksheet('country_calls')
-    try:
-        country_calls.clear()
-        set_with_dataframe(country_calls, data)
-        print(f'Successfully saved to file')
-    except Exception as e:
-        print(f'Something went wrong: {str(e)}')
-    
-    ## Format datetime columns in Google Sheets
-    # Identify datetime columns
-    datetime_columns = data.select_dtypes(include=['datetime64[ns]']).columns    
-    datetime_cols_indices = [data.columns.get_loc(col) + 1 for col in datetime_columns]
-    for col_index in datetime_cols_indices:
-        country_calls.format(f'{chr(64 + col_index)}2:{chr(64 + col_index)}{len(data) + 1}', {
-            "numberFormat": {
-                "type": "DATE_TIME",
-                "pattern": "dd-mm-yyyy"
-            }
-        })
-
-def import_wash_list():
-    wash_list = DATA_FILE.worksheet('wash_list')
-    try:
-        ## import from excel
-        data = get_as_dataframe(wash_list)
-        return data
-    except Exception as e:
-        print(f'Oops, something went wrong while trying to import the wash_list db.\nException: {str(e)}')
-        return None
+    return gspread_client().open_by_key(GS_FILE_ID)
+
+## Storage backend (Google Sheets by default, see storage.py)
+BACKEND = storage.get_backend(open_data_file=get_data_file)
+
+## Parsing of the raw tables as read from the storage backend
+
+def parse_programmes(data):
+    data['start_year'] = pd.to_datetime(data.start_year, format="%Y", errors='coerce')
+    data['end_year'] = pd.to_datetime(data.end_year, format="%Y", errors='coerce')
+    return data.sort_values(by=['end_year', 'start_year'])
+
+def parse_calendar(data):
+    ## Convert dates to datetime
+    data['start_date'] = pd.to_datetime(data.start_date, dayfirst=True, errors='raise', format='mixed')#format='%d-%b-%Y')
+    data['end_date'] = pd.to_datetime(data.end_date, dayfirst=True, errors='raise', format='mixed')#format='%d-%b-%Y')
+    return data
+
+def parse_country_calls(data):
+    ## Convert dates to datetime
+    data['date'] = pd.to_datetime(data.date, dayfirst=True, errors='raise', format='mixed')
+    return data
+
+def as_is(data):
+    return data
+
+def track_changes(name, data):
+    ## Tables edited from the dashboard: remember them as stored and replay the unsaved changes
+    if name in ('calendar', 'country_calls'):
+        BACKEND.mark_persisted(name, data)
+        return WRITER.track(name, data)
+    return data
+
+def prepare_table(name, data):
+    ## Filter columns as categoricals (see lookup.py)
+    return track_changes(name, lookup.to_categorical(name, data))
+
+## Tables shared by the worker processes when WASH_SHARED_DIR is set (see shared.py)
+STORE = shared.SharedStore() if shared.SHARED_DIR else None
+
+## Tables are loaded on first access, nothing is downloaded when the app starts (see tables.py)
+TABLES = tables.TableRegistry(
+    BACKEND,
+    parsers={
+        'advisors': as_is,
+        'countries': as_is,
+        'types': as_is,
+        'risk_matrix': as_is,
+        'programmes': parse_programmes,
+        'calendar': parse_calendar,
+        'wash_list': as_is,
+        'country_calls': parse_country_calls,
+    },
+    ## Tables fetched together (one request), roughly one group per panel
+    groups=[
+        ['calendar', 'advisors', 'types'],
+        ['countries', 'risk_matrix', 'programmes'],
+        ['country_calls'],
+    ],
+    ## Seconds between two checks for changes made directly in the spreadsheet
+    refresh_interval=float(os.getenv('WASH_REFRESH_INTERVAL', 60)),
+    on_load=prepare_table,
+    ## Parsed tables kept on disk so that a restart does not wait for the download (WASH_SNAPSHOT=0 to disable)
+    snapshot=snapshot.Snapshot() if os.getenv('WASH_SNAPSHOT', '1') != '0' else None,
+    shared=STORE,
+)
+
+## Changes made from the dashboard are journaled locally and saved in the background (see journal.py)
+if STORE is None:
+    WRITER = journal.WriteBehind(journal.Journal(), BACKEND, TABLES, save_context=TABLES.own_write)
+else:
+    ## One journal for all the workers, saved by the loader
+    WRITER = journal.WriteBehind(
+        journal.Journal(STORE.journal_path, lock=STORE.lock), BACKEND, TABLES,
+        save_context=TABLES.own_write, lock=STORE.lock, is_writer=TABLES.is_loader
+    )
+    TABLES.on_change(lambda names: WRITER.schedule())
+    TABLES.on_loader(WRITER.schedule)
+## Save the last changes before the process exits
+atexit.register(WRITER.flush)
+
+## Raised by update_rows / delete_rows when someone else changed the rows in the meantime
+Conflict = journal.Conflict
+
+def row_versions(data, index):
+    """Versions of the rows as read by the user, to pass as base to update_rows / delete_rows."""
+    return journal.row_versions(data, index)
+
+def add_rows(table, new_rows, origin=None):
+    """Append rows to a table, with new index labels (origin: the session making the change). Returns the updated table, saved in the background."""
+    return WRITER.insert(table, new_rows, origin)
+
+def update_rows(table, rows, base=None, origin=None):
+    """Update the rows with the same index labels (base: their versions when read, see row_versions). Returns the updated table, saved in the background."""
+    return WRITER.submit(journal.upsert(table, rows, base, origin))
+
+def delete_rows(table, index, base=None, origin=None):
+    """Delete the rows with the given index labels (base: as in update_rows). Returns the updated table, saved in the background."""
+    return WRITER.submit(journal.delete(table, index, base, origin))
 
 ## CALENDAR FUNCTIONS ##
 
-def pcg_days_by_type(data, year):
-    def total_busdays(data):
-        ## calculate the number of business days between two dates
-        return len(pd.bdate_range(data.start_date, data.end_date))
-    
-    data['total_busdays'] = data.apply(total_busdays, axis=1)
-    ## Count how many days each advisor spent during the year by type 
+def work_calendars(advisors, countries, years):
+    """Working week and public holidays of each advisor for the given years (see busdays.py)."""
+    country_codes = dict(zip(countries['CIA Name'], countries['ISO 3166 alpha3']))
+    return busdays.advisor_calendars(advisors, years, country_codes)
+
+## Advisor x day occupancy of the calendar, shared by all sessions (see occupancy.py)
+OCCUPANCY = occupancy.Occupancy()
+
+## Interval index of the calendar events, to detect double bookings (see intervals.py)
+INTERVALS = intervals.IntervalIndex()
+
+def describe_calendar_rows(data):
+    """One markdown bullet per calendar row, e.g. to list conflicting entries."""
+    return '\n'.join(
+        f'- **{row.advisor}** {row.type}: {date_prettify(row.start_date)} to {date_prettify(row.end_date)}'
+        + ('' if pd.isna(row.remarks) or not row.remarks else f' ({row.remarks})')
+        for row in data.itertuples()
+    )
+
+def pcg_days_by_type(data, year, calendars=None):
+    """
+    Business days spent by each advisor by type, and their share of the working days of the year (or of all years).
+
+    Events crossing the start or the end of the year only count their days within the year.
+    calendars (see work_calendars) gives the working week and public holidays of each advisor.
+    The input table is not modified.
+    """
+    if data.empty:
+        return pd.DataFrame(columns=['advisor', 'type', 'total_busdays', 'pcg_busdays'])
+    ## Count how many days each advisor spent during the year by type
     if year != 'All':
         year = int(year)
-        data = data[data.end_date.dt.year == year]
-        yr_busdays = np.busday_count(str(year), str(year+1))
+        period_start, period_end = pd.Timestamp(year, 1, 1), pd.Timestamp(year, 12, 31)
+        data = busdays.clip_to_period(data, period_start, period_end)
     else:
-        yr_busdays = np.busday_count(str(min(data.start_date.dt.year)), str(max(data.end_date.dt.year)))
-    # data_grouped = data[data.end_date.dt.year == int(year)].groupby(['advisor', 'type']).agg({'total_busdays':'sum'}).reset_index()
-    data_grouped = data.groupby(['advisor', 'type']).agg({'total_busdays':'sum'}).reset_index()
-    
-    data_grouped['pcg_busdays'] = (data_grouped.total_busdays / yr_busdays)*100
+        period_start = pd.Timestamp(data.start_date.min().year, 1, 1)
+        period_end = pd.Timestamp(data.end_date.max().year, 12, 31)
+    data = data.assign(total_busdays=busdays.count_busdays(data.start_date, data.end_date, data.advisor, calendars))
+    data_grouped = data.groupby(['advisor', 'type'], observed=True).agg({'total_busdays':'sum'}).reset_index()
+
+    ## Working days of the period in the calendar of each advisor
+    yr_busdays = busdays.period_busdays(period_start, period_end, data_grouped.advisor, calendars)
+    data_grouped['pcg_busdays'] = (data_grouped.total_busdays / yr_busdays.to_numpy())*100
 
     return data_grouped
 
+## Derived tables, computed once per version of their tables and shared by all outputs and sessions (see cache.py)
+
+def _row_index(name):
+    @cache.memoize(TABLES, [name], maxsize=2)
+    def row_index():
+        return lookup.RowIndex(TABLES.get(name), lookup.CATEGORICAL_COLUMNS[name], lookup.YEAR_COLUMNS.get(name))
+    return row_index
+
+## Positions of the rows of each advisor, type, country, continent and year (see lookup.py): ROW_INDEX[name]()
+ROW_INDEX = {name: _row_index(name) for name in lookup.CATEGORICAL_COLUMNS}
+
+def _facets(name):
+    @cache.memoize(TABLES, [name], maxsize=2)
+    def facets():
+        return ROW_INDEX[name]().facets()
+    return facets
+
+## Choices of the filter controls: FACETS[name]() -> {column or 'year': (distinct sorted values, ...)}
+FACETS = {name: _facets(name) for name in lookup.CATEGORICAL_COLUMNS}
+
+def _selected(value):
+    ## Condition of a filter select, 'All' is no condition
+    return None if value == 'All' else [value]
+
+@cache.memoize(TABLES, ['advisors', 'countries', 'calendar'])
+def advisor_work_calendars():
+    """Working calendars of the advisors, for all the years of the calendar."""
+    data = TABLES.get('calendar')
+    years = pd.concat([data.start_date, data.end_date]).dt.year.dropna()
+    years = range(int(years.min()), int(years.max()) + 1) if len(years) else []
+    return work_calendars(TABLES.get('advisors'), TABLES.get('countries'), years)
+
+@cache.memoize(TABLES, ['calendar', 'advisors', 'countries'])
+def days_by_type(year):
+    """pcg_days_by_type of the calendar for the year."""
+    return pcg_days_by_type(TABLES.get('calendar'), year, advisor_work_calendars())
+
+@cache.memoize(TABLES, ['programmes'])
+def active_programmes(max_year, by):
+    """Number of programmes still active in max_year, by country and by sub_sector or donor."""
+    df = TABLES.get('programmes')
+    df = df[df.end_year.dt.year >= int(max_year)]
+    return df.groupby(['country', by], observed=True).agg({'code':'count'}).reset_index().rename(columns={'code':'no_programmes'})
+
+@cache.memoize(TABLES, ['countries'])
+def countries_by_focal(regions):
+    """Number of countries of each focal point in the regions."""
+    data = TABLES.get('countries')
+    rows = ROW_INDEX['countries']().select(Continent=regions)
+    return data.iloc[rows].groupby('ta_focal', observed=True)['CIA Name'].count().to_dict()
+
+@cache.memoize(TABLES, ['country_calls'])
+def calls_by(year, by):
+    """Number of calls in the year (or 'All') by country or by advisor, and the period as text."""
+    tmp = TABLES.get('country_calls')
+    index = ROW_INDEX['country_calls']()
+    if year == 'All':
+        df = tmp
+        years = index.values('year')
+        period = f"{years[0]} - {years[-1]}" if years else ''
+    else:
+        df = tmp.iloc[index.select(year=[int(year)])]
+        period = year
+
+    if by == 'country':
+        data = df.groupby(['country'], observed=True).agg({'sal_attendees':'count'}).reset_index().rename(columns={'sal_attendees':'no_calls'})
+    else:
+        ## One row per advisor attending the call
+        df = df.assign(sal_attendees=df.sal_attendees.str.split(', ')).explode('sal_attendees')
+        data = df.groupby(['sal_attendees']).agg({'country':'count'}).reset_index().rename(columns={'country':'no_calls'})
+    return data, period
+
+@cache.memoize(TABLES, ['calendar'])
+def calendar_display():
+    """The calendar as shown in its grid."""
+    return grid.display_frame(TABLES.get('calendar'), ['start_date', 'end_date'])
+
+@cache.memoize(TABLES, ['calendar'])
+def calendar_rows(year, advisor, type_, sort=(), filters=()):
+    """Positions in calendar_display() of the rows shown by the grid, newest entries first unless sorted in the grid."""
+    data = TABLES.get('calendar')
+    rows = ROW_INDEX['calendar']().select(
+        year=None if year == 'All' else [int(year)], advisor=_selected(advisor), type=_selected(type_)
+    )
+    return grid.select_rows(calendar_display(), grid.ordered_rows(data, rows, ascending=False), sort, filters)
+
+@cache.memoize(TABLES, ['country_calls'])
+def calls_display():
+    """The country calls as shown in their grid."""
+    return grid.display_frame(TABLES.get('country_calls'), ['date'])
+
+@cache.memoize(TABLES, ['country_calls'])
+def calls_rows(year, country, sort=(), filters=()):
+    """Positions in calls_display() of the rows shown by the grid, latest calls first unless sorted in the grid."""
+    data = TABLES.get('country_calls')
+    rows = ROW_INDEX['country_calls']().select(year=None if year == 'All' else [int(year)], country=_selected(country))
+    return grid.select_rows(calls_display(), grid.ordered_rows(data, rows, by='date', ascending=False), sort, filters)
+
 ### UI FUNCTIONS ###
 
 def date_prettify(series):
     return series.strftime('%d-%b-%Y')#f'{series:%d-%b-%Y}'
 
-CALENDAR_FORM = {
-    'advisor': ui.input_select(
-        id='cal_advisor',
-        label='',
-        ## Create a dictionary with keys = advisor name
-        choices={k:k for k in advisors.short_name.sort_values()}
-    ),
-    'type': ui.input_radio_buttons(
-        id='cal_type',
-        label='',
-        choices=types
-    ),
-    'start_date': ui.input_date(
-        id='cal_start_date',
-        label='From:',
-        value=datetime.today(),
-        format='dd-mm-yyyy',
-        min='2024-01-01',
-        max=datetime.today() + timedelta(weeks=52)
-    ),
-    'end_date': ui.input_date(
-        id='cal_end_date',
-        label='To:',
-        value=datetime.today(),
-        format='dd-mm-yyyy',
-        min='2024-01-01',
-        max=datetime.today() + timedelta(weeks=52)
-    ),
-    'remarks': ui.input_text(
-        id='cal_remarks',
-        label='Description',
-        placeholder='e.g. country name'
-    )
-}
-
-
-countries_list = countries['CIA Name'].to_list()
-countries_list.append('Hanaano')
-
-CALL_FORM = {
-    'date': ui.input_date(
-        id='date_call',
-        label='Date:',
-        value=datetime.today(),
-        format='dd-mm-yyyy',
-        min='2024-01-01',
-        # max=datetime.today() + timedelta(weeks=52)
-    ),
-    'country': ui.input_select(
-        id='country_call',
-        label='',
-        ## create a dictionary with keys = country names
-        # choices={k:k for k in countries['CIA Name'].sort_values()}
-        choices={k:k for k in sorted(countries_list)}
-    ),
-    'sal_attendees': ui.input_select(
-        id='sal_attendees_call',
-        label='SAL Attendee(s) (use Ctrl for multiselect)',
-        choices={k:k for k in sorted(advisors.short_name.unique())},#[k for k in sorted(advisors.short_name.unique())],
-        multiple=True
-    ),
-    # 'sal_attendees': ui.input_text(
-    #     id='sal_attendees_call',
-    #     label='SAL TA',
-    #     placeholder='comma separated names'
-    # ),
-    'country_attendees': ui.input_text(
-        id='country_attendees_call',
-        label='Country Attendee(s)',
-        placeholder='comma separated names'
-    ),
-    'category': ui.input_radio_buttons(
-        id='category_call',
-        label='',
-        choices=['scheduled', 'special support', 'training', 'other'],
-        selected='scheduled'
-    ),
-    'description': ui.input_text_area(
-        id='description_call',
-        label='Description',
-        placeholder='e.g., monthly catch-up',
-        width='400px',
-        height='200px'
-    )
-}
+CALENDAR_FIELDS = ['advisor', 'type', 'start_date', 'end_date', 'remarks']
+
+def calendar_form():
+    """Inputs of the calendar entry form (built when the form is shown, so that choices are up to date)."""
+    advisors = TABLES.get('advisors')
+    types = TABLES.get('types').type.to_list()
+    return {
+        'advisor': ui.input_select(
+            id='cal_advisor',
+            label='',
+            ## Create a dictionary with keys = advisor name
+            choices={k:k for k in advisors.short_name.sort_values()}
+        ),
+        'type': ui.input_radio_buttons(
+            id='cal_type',
+            label='',
+            choices=types
+        ),
+        'start_date': ui.input_date(
+            id='cal_start_date',
+            label='From:',
+            value=datetime.today(),
+            format='dd-mm-yyyy',
+            min='2024-01-01',
+            max=datetime.today() + timedelta(weeks=52)
+        ),
+        'end_date': ui.input_date(
+            id='cal_end_date',
+            label='To:',
+            value=datetime.today(),
+            format='dd-mm-yyyy',
+            min='2024-01-01',
+            max=datetime.today() + timedelta(weeks=52)
+        ),
+        'remarks': ui.input_text(
+            id='cal_remarks',
+            label='Description',
+            placeholder='e.g. country name'
+        )
+    }
+
+
+CALL_FIELDS = ['date', 'country', 'sal_attendees', 'country_attendees', 'category', 'description']
+
+def call_form():
+    """Inputs of the country call form (built when the form is shown, so that choices are up to date)."""
+    advisors = TABLES.get('advisors')
+    countries_list = TABLES.get('countries')['CIA Name'].to_list()
+    countries_list.append('Hanaano')
+
+    return {
+        'date': ui.input_date(
+            id='date_call',
+            label='Date:',
+            value=datetime.today(),
+            format='dd-mm-yyyy',
+            min='2024-01-01',
+            # max=datetime.today() + timedelta(weeks=52)
+        ),
+        'country': ui.input_select(
+            id='country_call',
+            label='',
+            ## create a dictionary with keys = country names
+            # choices={k:k for k in countries['CIA Name'].sort_values()}
+            choices={k:k for k in sorted(countries_list)}
+        ),
+        'sal_attendees': ui.input_select(
+            id='sal_attendees_call',
+            label='SAL Attendee(s) (use Ctrl for multiselect)',
+            choices={k:k for k in sorted(advisors.short_name.unique())},#[k for k in sorted(advisors.short_name.unique())],
+            multiple=True
+        ),
+        # 'sal_attendees': ui.input_text(
+        #     id='sal_attendees_call',
+        #     label='SAL TA',
+        #     placeholder='comma separated names'
+        # ),
+        'country_attendees': ui.input_text(
+            id='country_attendees_call',
+            label='Country Attendee(s)',
+            placeholder='comma separated names'
+        ),
+        'category': ui.input_radio_buttons(
+            id='category_call',
+            label='',
+            choices=['scheduled', 'special support', 'training', 'other'],
+            selected='scheduled'
+        ),
+        'description': ui.input_text_area(
+            id='description_call',
+            label='Description',
+            placeholder='e.g., monthly catch-up',
+            width='400px',
+            height='200px'
+        )
+    }
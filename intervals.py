@@ -0,0 +1,70 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+### Interval index of the calendar events, to detect double bookings ###
+## For each advisor the events are sorted by start date, together with the running maximum of their end dates.
+## An event [start, end] can only overlap the events starting on or before its end (one binary search on the starts)
+## and after the first event whose running maximum end reaches its start (one binary search on the running maximum).
+
+
+class IntervalIndex:
+    """Sorted start / end arrays of the calendar events of each advisor."""
+
+    def __init__(self):
+        self.data = None
+        self._advisors = {}
+        self._lock = threading.Lock()
+
+    def update(self, data):
+        """Rebuild the index if the calendar table changed. Returns self."""
+        with self._lock:
+            if data is not self.data:
+                self._build(data)
+                self.data = data
+        return self
+
+    def _build(self, data):
+        events = data.dropna(subset=['advisor', 'start_date', 'end_date']).sort_values(['advisor', 'start_date'], kind='stable')
+        self._advisors = {}
+        for advisor, group in events.groupby('advisor', sort=False, observed=True):
+            ends = group.end_date.to_numpy()
+            self._advisors[advisor] = (
+                group.start_date.to_numpy(),
+                ends,
+                np.maximum.accumulate(ends),
+                group.index.to_numpy(),
+            )
+
+    def conflicts(self, advisor, start, end, exclude=()):
+        """Index labels of the events of the advisor overlapping start - end (both included), except the excluded labels."""
+        if advisor not in self._advisors:
+            return []
+        starts, ends, max_ends, labels = self._advisors[advisor]
+        start, end = np.datetime64(pd.Timestamp(start)), np.datetime64(pd.Timestamp(end))
+        last = np.searchsorted(starts, end, side='right')
+        first = np.searchsorted(max_ends, start, side='left')
+        candidates = np.arange(first, last)
+        overlapping = labels[candidates[ends[candidates] >= start]]
+        return [label for label in overlapping if label not in set(exclude)]
+
+    def overlapping(self, start, end):
+        """Index labels of the events of all the advisors overlapping start - end (both included)."""
+        return [label for advisor in self._advisors for label in self.conflicts(advisor, start, end)]
+
+    def audit(self):
+        """
+        All the events overlapping another event of the same advisor, sorted by advisor and start date.
+
+        Vectorized: an event overlaps an earlier one if it starts before the latest end of the earlier events,
+        and a later one if it ends after the start of the next event.
+        """
+        data = self.data
+        if data is None or data.empty:
+            return data
+        events = data.dropna(subset=['advisor', 'start_date', 'end_date']).sort_values(['advisor', 'start_date'], kind='stable')
+        by_advisor = events.groupby('advisor', sort=False, observed=True)
+        previous_end = by_advisor.end_date.cummax().groupby(events.advisor, observed=True).shift()
+        next_start = by_advisor.start_date.shift(-1)
+        return events[(events.start_date <= previous_end) | (events.end_date >= next_start)]
@@ -0,0 +1,416 @@
+import os
+import json
+import time
+import contextlib
+import threading
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+### Write-behind journal for calendar and call mutations ###
+## Every mutation is first appended to a local journal file (durable), then applied to the in-memory tables.
+## A background thread waits for a short quiet period, saves each touched table once and commits the journal.
+## Entries that were not committed (crash, network down) are replayed on the next start.
+## Edits and deletes carry the version of the rows they were based on (a hash of their content): concurrent changes
+## to different rows are all applied, a change to rows that someone else changed in the meantime is rejected.
+
+app_dir = Path(__file__).parent
+
+JOURNAL_PATH = Path(os.getenv('WASH_JOURNAL_PATH', app_dir / 'data' / 'journal.jsonl'))
+## Seconds to wait for more mutations before saving (coalesces e.g. a week of leave entered row by row)
+FLUSH_DELAY = float(os.getenv('WASH_FLUSH_DELAY', 2))
+## Longest wait between two attempts when saving keeps failing
+MAX_RETRY_DELAY = 300
+
+
+## MUTATIONS ##
+
+def _encode(value):
+    if value is None or (np.isscalar(value) and pd.isna(value)):
+        return None
+    if isinstance(value, (pd.Timestamp, date, np.datetime64)):
+        return {'$date': pd.Timestamp(value).isoformat()}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    return value
+
+def _decode(value):
+    if isinstance(value, dict) and '$date' in value:
+        return pd.Timestamp(value['$date'])
+    return value
+
+class Conflict(Exception):
+    """A mutation based on rows that were changed or deleted by someone else since they were read."""
+
+    def __init__(self, table, labels):
+        self.table = table
+        self.labels = list(labels)
+        super().__init__(
+            f'{len(self.labels)} row(s) of {table} were changed or deleted by someone else since you opened them, '
+            f'please check the table and retry.'
+        )
+
+def row_versions(data, index):
+    """Version (hash of the content) of the rows with the given index labels, None for the missing ones."""
+    present = [label for label in index if label in data.index]
+    ## As objects, so that a row has the same version whatever the dtypes of the table (e.g. categoricals)
+    hashes = pd.util.hash_pandas_object(data.loc[present].astype(object), index=False)
+    versions = dict(zip(present, (int(h) for h in hashes)))
+    return [versions.get(label) for label in index]
+
+def upsert(table, rows, base=None, origin=None):
+    """
+    Mutation adding or updating rows, identified by their index labels.
+
+    base: versions of the rows the change was made on (see row_versions), None to overwrite them whatever they are.
+    origin: who made the change (e.g. the session id), told if the change is rejected when replayed.
+    """
+    entry = {
+        'table': table,
+        'op': 'upsert',
+        'columns': [str(col) for col in rows.columns],
+        'index': [_encode(i) for i in rows.index],
+        'rows': [[_encode(v) for v in row] for row in rows.itertuples(index=False)],
+    }
+    if base is not None:
+        entry['base'] = list(base)
+    if origin is not None:
+        entry['origin'] = origin
+    return entry
+
+def delete(table, index, base=None, origin=None):
+    """Mutation removing the rows with the given index labels (base, origin: as in upsert)."""
+    entry = {'table': table, 'op': 'delete', 'index': [_encode(i) for i in index]}
+    if base is not None:
+        entry['base'] = list(base)
+    if origin is not None:
+        entry['origin'] = origin
+    return entry
+
+def conflicts(data, entry):
+    """Index labels of the rows the mutation was based on that were changed or deleted since (see upsert)."""
+    base = entry.get('base')
+    if not base:
+        return []
+    current = row_versions(data, entry['index'])
+    changed = [(label, now) for label, seen, now in zip(entry['index'], base, current) if seen is not None and seen != now]
+    if entry['op'] == 'delete':
+        ## Rows deleted in the meantime are gone anyway
+        return [label for label, now in changed if now is not None]
+    ## Rows that already hold the new values (e.g. an entry replayed after a crash) are not conflicts
+    present = [label for label, now in changed if now is not None]
+    applied = dict(zip(present, row_versions(apply_mutation(data.loc[present], entry), present)))
+    return [label for label, now in changed if now is None or applied[label] != now]
+
+def apply_mutation(data, entry):
+    """
+    Return a new table with the mutation applied.
+
+    Mutations are idempotent (rows are matched by index label), so replaying an entry that was
+    already saved does not duplicate rows.
+    """
+    if entry['op'] == 'delete':
+        return data.drop(index=entry['index'], errors='ignore')
+
+    rows = pd.DataFrame(
+        [[_decode(v) for v in row] for row in entry['rows']],
+        index=entry['index'],
+        columns=entry['columns']
+    )
+    ## Keep the datetime columns as datetime
+    for col in data.select_dtypes(include=['datetime64[ns]']).columns:
+        if col in rows:
+            rows[col] = pd.to_datetime(rows[col])
+
+    ## Categorical columns get their values as plain objects, and new categories when converted back
+    categorical = [col for col in data.columns if isinstance(data[col].dtype, pd.CategoricalDtype)]
+
+    existing = rows.index.isin(data.index)
+    updated = data.astype({col: object for col in categorical})
+    if existing.any():
+        ## Same semantics as DataFrame.update: missing values do not overwrite existing ones
+        updated.update(rows[existing])
+    if (~existing).any():
+        updated = pd.concat([updated, rows[~existing].reindex(columns=data.columns)])
+    return updated.astype({col: 'category' for col in categorical})
+
+
+## JOURNAL FILE ##
+
+class Journal:
+    """Append-only journal file. Each entry gets its byte offset in the file as sequence number."""
+
+    def __init__(self, path=JOURNAL_PATH, lock=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        ## e.g. the lock of a journal shared by several processes (see shared.py)
+        self._lock = lock or threading.Lock()
+        ## Notices for the sessions (e.g. a save that failed), next to the journal so that every worker reads them
+        self.notices_path = self.path.with_name(f'{self.path.stem}.notices.jsonl')
+
+    def _append_line(self, record, path=None):
+        with open(path or self.path, 'ab') as f:
+            seq = f.tell()
+            f.write((json.dumps(record) + '\n').encode())
+            f.flush()
+            os.fsync(f.fileno())
+        return seq
+
+    def append(self, entry):
+        with self._lock:
+            return self._append_line(entry)
+
+    def notice(self, record):
+        """Append a notice for the sessions, e.g. {'kind': 'failed', 'error': ...} (see notices)."""
+        with self._lock:
+            self._append_line(dict(record, time=time.time()), self.notices_path)
+
+    def notices(self, offset=None):
+        """Notices appended after the byte offset (None: the end of the file), and the offset of the next ones."""
+        try:
+            with open(self.notices_path, 'rb') as f:
+                if offset is None:
+                    return [], f.seek(0, os.SEEK_END)
+                f.seek(offset)
+                lines = f.readlines()
+        except FileNotFoundError:
+            return [], 0
+        ## A line being written is read on the next call
+        complete = lines if not lines or lines[-1].endswith(b'\n') else lines[:-1]
+        return [json.loads(line) for line in complete], offset + sum(len(line) for line in complete)
+
+    def _read(self):
+        entries, committed, saved = [], -1, {}
+        if not self.path.exists():
+            return entries, committed, saved
+        with open(self.path, 'rb') as f:
+            seq = 0
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    ## A torn last line after a crash: the mutation never reached the user as saved
+                    break
+                if 'commit' in record or 'labels' in record:
+                    committed = max(committed, record.get('commit', -1))
+                    saved.update(record.get('labels', {}))
+                else:
+                    entries.append(dict(record, seq=seq))
+                seq += len(line)
+        return entries, committed, saved
+
+    def _pending(self):
+        entries, committed, saved = self._read()
+        return _relabel([e for e in entries if e['seq'] > committed], saved)
+
+    def pending(self):
+        """Entries that have not been saved to the storage backend yet, in order."""
+        with self._lock:
+            return self._pending()
+
+    def commit(self, seq, labels):
+        """
+        Mark all entries up to seq as saved. The file is compacted once nothing is pending.
+
+        labels maps each saved table to its index labels in saved order: a reloaded table is numbered
+        by position, so the entries still pending (or journaled later) are relabeled accordingly when replayed.
+        The labels of a table are kept until it is reloaded (see rebase), the in-memory table keeps its labels until then.
+        """
+        labels = {name: _saved_labels(index) for name, index in labels.items()}
+        with self._lock:
+            entries, _, saved = self._read()
+            if all(e['seq'] <= seq for e in entries):
+                saved.update(labels)
+                self._rewrite([], saved)
+            else:
+                self._append_line({'commit': seq, 'labels': labels})
+
+    def rebase(self, table, skip=()):
+        """
+        Relabel the pending entries of the table for the table as loaded now, dropping the sequence numbers skip.
+        The entries of the other tables are kept as they are, with the labels of their last save.
+        """
+        with self._lock:
+            entries, committed, saved = self._read()
+            pending = [e for e in entries if e['seq'] > committed and e['seq'] not in skip]
+            if saved.get(table) is None and not skip and not any(e['table'] == table for e in pending):
+                return
+            pending = _relabel(pending, {table: saved.pop(table, None)})
+            self._rewrite(pending, saved)
+
+    def _rewrite(self, entries, saved):
+        ## Atomic: a crash leaves either the old or the new journal
+        records = [{'labels': {k: v for k, v in saved.items() if v is not None}}] if any(v is not None for v in saved.values()) else []
+        records += [{k: v for k, v in entry.items() if k != 'seq'} for entry in entries]
+        tmp = self.path.with_suffix('.tmp')
+        with open(tmp, 'wb') as f:
+            for record in records:
+                f.write((json.dumps(record) + '\n').encode())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def _saved_labels(index):
+    ## None when the labels are the positions already (nothing to relabel)
+    index = list(index)
+    return None if index == list(range(len(index))) else [_encode(i) for i in index]
+
+def _relabel(entries, saved):
+    """Translate index labels to the positions the rows have once the saved tables are reloaded."""
+    positions = {table: {label: pos for pos, label in enumerate(labels)} for table, labels in saved.items() if labels is not None}
+    relabeled = []
+    for entry in entries:
+        table_positions = positions.get(entry['table'])
+        if table_positions is None:
+            relabeled.append(entry)
+            continue
+        index = []
+        for label in entry['index']:
+            ## Rows appended after the save come after the saved ones
+            index.append(table_positions.setdefault(label, len(table_positions)))
+        relabeled.append(dict(entry, index=index))
+    return relabeled
+
+
+## WRITE-BEHIND ##
+
+class WriteBehind:
+    """Keeps the latest state of the mutable tables and saves them to the backend in the background."""
+
+    def __init__(self, journal, backend, tables=None, delay=FLUSH_DELAY, save_context=None, lock=None, is_writer=None):
+        self.journal = journal
+        self.backend = backend
+        self.delay = delay
+        ## Any mapping of table name -> table, e.g. the tables.TableRegistry of the app
+        self.tables = {} if tables is None else tables
+        ## Context manager wrapping each save, e.g. TableRegistry.own_write
+        self.save_context = save_context or contextlib.nullcontext
+        ## Lock of the mutations (reentrant), e.g. shared by the worker processes (see shared.py)
+        self._lock = lock or threading.RLock()
+        ## Whether this process saves the journal to the backend (with workers, only the loader does)
+        self.is_writer = is_writer or (lambda: True)
+        self._wake = threading.Event()
+        self._next_labels = {}
+        self._thread = None
+        ## Message of the last save if it failed, None once saved
+        self.error = None
+
+    def track(self, name, data):
+        """Register a freshly loaded table and replay the journal entries that were not saved yet."""
+        with self._lock:
+            pending = [e for e in self.journal.pending() if e['table'] == name]
+            dropped = []
+            for entry in pending:
+                ## The table may have been changed by someone else (e.g. reloaded before saving)
+                conflicting = conflicts(data, entry)
+                if conflicting:
+                    print(f'Dropping an unsaved change to {name}: rows {conflicting} were changed by someone else')
+                    ## The change was acknowledged to its author: tell them it was not saved (see notices)
+                    self.journal.notice({
+                        'kind': 'rejected', 'tables': [name], 'op': entry['op'], 'labels': conflicting,
+                        'origin': entry.get('origin'),
+                    })
+                    dropped.append(entry['seq'])
+                    continue
+                data = apply_mutation(data, entry)
+            ## From now on the pending entries use the labels of the table as loaded, numbered by position
+            self.journal.rebase(name, skip=set(dropped))
+            self._next_labels.pop(name, None)
+            self.tables[name] = data
+        if len(pending) > len(dropped):
+            print(f'Replaying {len(pending) - len(dropped)} unsaved change(s) to {name}')
+            self.schedule()
+        return data
+
+    def submit(self, entry):
+        """
+        Journal a mutation, apply it to the in-memory table and schedule the save. Returns the new table.
+
+        Raises Conflict, without applying anything, if the rows it was based on changed in the meantime.
+        """
+        with self._lock:
+            data = self.tables[entry['table']]
+            conflicting = conflicts(data, entry)
+            if conflicting:
+                raise Conflict(entry['table'], conflicting)
+            self.journal.append(entry)
+            if len(data):
+                self._next_labels[entry['table']] = max(self._next_labels.get(entry['table'], 0), data.index.max() + 1)
+            data = apply_mutation(data, entry)
+            self.tables[entry['table']] = data
+        self.schedule()
+        return data
+
+    def insert(self, name, rows, origin=None):
+        """Submit new rows, labeled after the last row of the table when they are applied. Returns the new table."""
+        with self._lock:
+            data = self.tables[name]
+            ## Labels of deleted rows are not reused, a stale view cannot point at a new row
+            start = max(data.index.max() + 1 if len(data) else 0, self._next_labels.get(name, 0))
+            return self.submit(upsert(name, rows.set_axis(pd.RangeIndex(start, start + len(rows))), origin=origin))
+
+    def schedule(self):
+        """Save the pending mutations in the background, after the quiet period."""
+        if not self.is_writer():
+            ## Saved by the writer process, which sees the changes in the shared store (see shared.py)
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _run(self):
+        retry_delay = self.delay
+        while True:
+            self._wake.wait()
+            ## Coalesce: wait for the burst of mutations to end before saving
+            time.sleep(self.delay)
+            self._wake.clear()
+            if self.flush():
+                retry_delay = self.delay
+            else:
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                self._wake.set()
+
+    def flush(self):
+        """Save every table with pending mutations (one write per table). Returns False if something failed."""
+        if not self.is_writer():
+            return True
+        if not self.journal.pending():
+            self._saved([])
+            return True
+        names = set()
+        try:
+            saved = {}
+            with self.save_context():
+                ## Read the entries inside the save context, which may reload the tables and rebase the journal
+                entries = self.journal.pending()
+                names = {e['table'] for e in entries}
+                for name in names:
+                    with self._lock:
+                        data = self.tables[name]
+                    self.backend.write_table(name, data)
+                    saved[name] = data.index.tolist()
+            if entries:
+                self.journal.commit(max(e['seq'] for e in entries), saved)
+                print(f'Successfully saved {len(entries)} change(s) to {", ".join(sorted(names))}')
+            self._saved(sorted(names))
+            return True
+        except Exception as e:
+            print(f'Something went wrong while saving {", ".join(sorted(names))}, will retry: {str(e)}')
+            if self.error is None:
+                ## The requests were already retried (see gateway.py): tell the sessions once, until it is saved
+                self.journal.notice({'kind': 'failed', 'tables': sorted(names), 'error': str(e)})
+            self.error = str(e)
+            return False
+
+    def _saved(self, names):
+        if self.error is not None:
+            self.error = None
+            self.journal.notice({'kind': 'saved', 'tables': names})
@@ -0,0 +1,93 @@
+import numpy as np
+
+### Categorical columns and row indices of the tables ###
+## The columns the dashboard filters and groups on are stored as categoricals (one small integer code
+## per row instead of a python string). For each version of a table the positions of the rows of every
+## value of these columns, and of every year of its date column, are computed once (see helpers.ROW_INDEX):
+## a filter is then a dictionary lookup plus an intersection of sorted positions, instead of a scan of the column.
+
+CATEGORICAL_COLUMNS = {
+    'calendar': ['advisor', 'type'],
+    'country_calls': ['country', 'category'],
+    'countries': ['Continent', 'ta_focal'],
+    'programmes': ['country', 'sub_sector', 'donor'],
+}
+## Date column of the table whose year is indexed
+YEAR_COLUMNS = {
+    'calendar': 'end_date',
+    'country_calls': 'date',
+}
+
+NO_ROWS = np.array([], dtype=np.int64)
+
+
+def to_categorical(name, data):
+    """The table with its filter columns (CATEGORICAL_COLUMNS) as categoricals."""
+    columns = [column for column in CATEGORICAL_COLUMNS.get(name, ()) if column in data and data[column].dtype != 'category']
+    return data.astype({column: 'category' for column in columns}) if columns else data
+
+
+def _positions_by_code(codes, values):
+    """{value: sorted positions of the rows with its code}, codes being positions in values (-1: missing)."""
+    order = np.argsort(codes, kind='stable')
+    bounds = np.searchsorted(codes[order], np.arange(len(values) + 1))
+    return {
+        value: order[bounds[i]:bounds[i + 1]]
+        for i, value in enumerate(values) if bounds[i + 1] > bounds[i]
+    }
+
+
+class RowIndex:
+    """Positions of the rows of a table for each value of its categorical columns and each year ('year')."""
+
+    def __init__(self, data, columns=(), year_column=None):
+        self.length = len(data)
+        self._positions = {}
+        for column in columns:
+            if column not in data:
+                continue
+            values = data[column].astype('category')
+            self._positions[column] = _positions_by_code(values.cat.codes.to_numpy(), list(values.cat.categories))
+        if year_column is not None and year_column in data:
+            years = data[year_column].dt.year
+            known = years.dropna().astype(int)
+            values = sorted(known.unique())
+            codes = np.full(self.length, -1, dtype=np.int64)
+            codes[years.notna().to_numpy()] = np.searchsorted(values, known.to_numpy())
+            self._positions['year'] = _positions_by_code(codes, values)
+
+    def values(self, column):
+        """The values of the column present in the table."""
+        return list(self._positions[column])
+
+    def facets(self):
+        """{column: (distinct values present in the table, sorted), ...}, as python values."""
+        return {
+            column: tuple(value.item() if hasattr(value, 'item') else value for value in positions)
+            for column, positions in self._positions.items()
+        }
+
+    def lookup(self, column, values):
+        """Sorted positions of the rows whose column is one of the values."""
+        index = self._positions[column]
+        found = [index[value] for value in values if value in index]
+        if not found:
+            return NO_ROWS
+        return found[0] if len(found) == 1 else np.sort(np.concatenate(found))
+
+    def select(self, **conditions):
+        """Sorted positions of the rows meeting all the conditions column=values (None: no condition)."""
+        rows = None
+        for column, values in conditions.items():
+            if values is None:
+                continue
+            found = self.lookup(column, values)
+            rows = found if rows is None else np.intersect1d(rows, found, assume_unique=True)
+        return np.arange(self.length) if rows is None else rows
+
+    def counts(self, column, rows=None):
+        """Number of rows (among the positions rows) for each value of the column."""
+        index = self._positions[column]
+        if rows is None:
+            return {value: len(positions) for value, positions in index.items()}
+        return {value: len(np.intersect1d(positions, rows, assume_unique=True)) for value, positions in index.items()}
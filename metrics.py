@@ -0,0 +1,307 @@
+import re
+import json
+import time
+import inspect
+import functools
+import threading
+from pathlib import Path
+from urllib.parse import urlparse, unquote
+
+from shiny import reactive
+from shiny.types import SilentException
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import PlainTextResponse
+from starlette.routing import Route
+
+import cache
+import gateway
+import helpers as hp
+
+### Metrics of the dashboard, in the Prometheus text format ###
+## GET /metrics (mounted next to the Shiny app, see app.py) returns the counters of the process:
+## renders of every output and runs of every effect of the sessions (count, duration, payload bytes, errors),
+## requests to the Sheets API by worksheet and operation with their latency, hits and misses of the caches,
+## and the version and size of each table. With several workers each one answers for itself.
+
+## Upper bounds of the duration buckets (seconds)
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=()):
+    pairs = [*zip(names, values), *extra]
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic count by label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, value=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _labels(self.labels, key), value) for key, value in sorted(self._values.items())]
+
+
+class Histogram:
+    """Distribution of observed values (e.g. durations) by label values, in cumulative buckets."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DURATION_BUCKETS):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total, count = self._values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', _labels(self.labels, key, [('le', bound)]), bucket))
+                samples.append((f'{self.name}_bucket', _labels(self.labels, key, [('le', '+Inf')]), count))
+                samples.append((f'{self.name}_sum', _labels(self.labels, key), total))
+                samples.append((f'{self.name}_count', _labels(self.labels, key), count))
+        return samples
+
+
+class Gauge:
+    """Current values, read when the metrics are collected: collect() -> {label values: value}."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels, collect):
+        self.name, self.help, self.labels = name, help, tuple(labels)
+        self.collect = collect
+
+    def samples(self):
+        return [(self.name, _labels(self.labels, key), value) for key, value in sorted(self.collect().items())]
+
+
+class CollectedCounter(Gauge):
+    """Monotonic count kept elsewhere (e.g. by the gateway), read when the metrics are collected."""
+
+    kind = 'counter'
+
+
+REGISTRY = []
+
+def _register(metric):
+    REGISTRY.append(metric)
+    return metric
+
+
+def exposition():
+    """All the metrics in the Prometheus text format."""
+    lines = []
+    for metric in REGISTRY:
+        try:
+            samples = metric.samples()
+        except Exception as e:
+            print(f'Could not collect the metric {metric.name}: {str(e)}')
+            continue
+        lines += [f'# HELP {metric.name} {metric.help}', f'# TYPE {metric.name} {metric.kind}']
+        lines += [f'{name}{labels} {float(value):g}' for name, labels, value in samples]
+    return '\n'.join(lines) + '\n'
+
+
+## OUTPUTS AND EFFECTS ##
+
+RENDERS = _register(Counter('wash_output_renders_total', 'Renders of the outputs.', ['output']))
+RENDER_SECONDS = _register(Histogram('wash_output_render_seconds', 'Time spent rendering the outputs.', ['output']))
+RENDER_BYTES = _register(Counter('wash_output_payload_bytes_total', 'Bytes of JSON sent by the outputs (figures included).', ['output']))
+RENDER_ERRORS = _register(Counter('wash_output_errors_total', 'Renders of the outputs that failed.', ['output']))
+EFFECT_RUNS = _register(Counter('wash_effect_runs_total', 'Runs of the effects of the sessions.', ['effect']))
+EFFECT_SECONDS = _register(Histogram('wash_effect_seconds', 'Time spent running the effects.', ['effect']))
+EFFECT_ERRORS = _register(Counter('wash_effect_errors_total', 'Runs of the effects that failed.', ['effect']))
+
+
+def _payload_bytes(renderer, value):
+    size = len(json.dumps(value, default=str)) if value is not None else 0
+    ## Widgets send their state apart from the value, the figures know the size of their JSON (see cache.memoize_figure)
+    if value is not None and hasattr(renderer, 'widget'):
+        try:
+            with reactive.isolate():
+                size += getattr(renderer.widget, '_json_bytes', 0)
+        except SilentException:
+            pass
+    return size
+
+
+def output(renderer):
+    """Record the renders of the output (put above @render.xx / @render_widget): count, duration, bytes and errors."""
+    render = renderer.render
+
+    @functools.wraps(render)
+    async def timed_render():
+        start = time.perf_counter()
+        try:
+            value = await render()
+        except SilentException:
+            raise
+        except Exception:
+            RENDER_ERRORS.inc(renderer.output_id)
+            raise
+        finally:
+            RENDER_SECONDS.observe(time.perf_counter() - start, renderer.output_id)
+            RENDERS.inc(renderer.output_id)
+        RENDER_BYTES.inc(renderer.output_id, value=_payload_bytes(renderer, value))
+        return value
+
+    renderer.render = timed_render
+    return renderer
+
+
+def _effect_name(fn):
+    ## Effects are usually anonymous (def _), they are named by their place in the code
+    source = inspect.unwrap(fn)
+    if source.__name__ != '_':
+        return source.__name__
+    return f'{Path(source.__code__.co_filename).name}:{source.__code__.co_firstlineno}'
+
+
+def effect(fn):
+    """reactive.effect recording the runs of the effect: count, duration and errors. Runs stopped by req() are not counted."""
+    name = _effect_name(fn)
+
+    def record(start, failed=False):
+        EFFECT_RUNS.inc(name)
+        EFFECT_SECONDS.observe(time.perf_counter() - start, name)
+        if failed:
+            EFFECT_ERRORS.inc(name)
+
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def timed():
+            start = time.perf_counter()
+            try:
+                result = await fn()
+            except SilentException:
+                raise
+            except Exception:
+                record(start, failed=True)
+                raise
+            record(start)
+            return result
+    else:
+        @functools.wraps(fn)
+        def timed():
+            start = time.perf_counter()
+            try:
+                result = fn()
+            except SilentException:
+                raise
+            except Exception:
+                record(start, failed=True)
+                raise
+            record(start)
+            return result
+
+    return reactive.effect(timed)
+
+
+## SHEETS API ##
+
+SHEETS_REQUESTS = _register(Counter(
+    'wash_sheets_requests_total', 'Requests sent to the Sheets and Drive APIs (retries included).', ['worksheet', 'operation', 'status']
+))
+SHEETS_SECONDS = _register(Histogram(
+    'wash_sheets_request_seconds', 'Latency of the requests to the Sheets and Drive APIs.', ['worksheet', 'operation']
+))
+
+## Sheet name of an A1 range: 'name'!A1:B2, 'name' or name!A1
+_SHEET_NAME = re.compile(r"^'((?:[^']|'')*)'|^([^!:']+)")
+
+def _sheet_name(a1_range):
+    match = _SHEET_NAME.match(a1_range)
+    if not match:
+        return ''
+    return match.group(1).replace("''", "'") if match.group(1) is not None else match.group(2)
+
+def sheets_call(method, url, params):
+    """(worksheet(s), operation) of a request to the API, e.g. ('calendar', 'values.clear')."""
+    path = unquote(urlparse(url).path)
+    if '/drive/' in path:
+        return '', f'drive.{method.lower()}'
+    rest = re.sub(r'^.*/spreadsheets/[^/:]+', '', path)
+    ranges = (params or {}).get('ranges') or []
+    ranges = [ranges] if isinstance(ranges, str) else ranges
+    if rest.startswith('/values/'):
+        a1_range = rest[len('/values/'):]
+        ## The action follows the range: values/'calendar':clear
+        action = a1_range.rsplit(':', 1)[1] if re.search(r':[a-zA-Z]+$', a1_range) else {'GET': 'get', 'PUT': 'update'}.get(method.upper(), method.lower())
+        return _sheet_name(a1_range), f'values.{action}'
+    if rest.startswith('/values:'):
+        return ','.join(_sheet_name(r) for r in ranges), f'values.{rest[len("/values:"):]}'
+    if rest.startswith(':'):
+        return '', rest[1:]
+    return '', 'metadata' if method.upper() == 'GET' else method.lower()
+
+def record_sheets_call(method, url, params, status, seconds):
+    worksheet, operation = sheets_call(method, url, params)
+    SHEETS_REQUESTS.inc(worksheet, operation, status)
+    SHEETS_SECONDS.observe(seconds, worksheet, operation)
+
+gateway.GATEWAY.on_response(record_sheets_call)
+
+_register(CollectedCounter('wash_sheets_retries_total', 'Requests to the API retried after a failure.', [], lambda: {(): gateway.GATEWAY.retries}))
+_register(CollectedCounter('wash_sheets_merged_total', 'Reads answered by an identical read already in flight.', [], lambda: {(): gateway.GATEWAY.merged}))
+_register(CollectedCounter('wash_sheets_throttled_seconds_total', 'Time spent waiting for the API quotas.', [], lambda: {(): gateway.GATEWAY.waited}))
+
+
+## CACHES AND TABLES ##
+
+def _caches(attribute):
+    return {
+        (func.__name__, ','.join(func.tables)): getattr(func.cache, attribute)
+        for func in cache.MEMOIZED
+    }
+
+def _loaded_tables(value):
+    return {(name,): value(hp.TABLES.get(name)) for name in hp.TABLES.names if hp.TABLES.is_loaded(name)}
+
+_register(CollectedCounter('wash_cache_hits_total', 'Hits of the memoized derived tables and figures.', ['function', 'tables'], lambda: _caches('hits')))
+_register(CollectedCounter('wash_cache_misses_total', 'Misses of the memoized derived tables and figures.', ['function', 'tables'], lambda: _caches('misses')))
+_register(Gauge('wash_cache_bytes', 'Bytes of JSON held by the figure caches.', ['function', 'tables'], lambda: {
+    key: value for key, value in _caches('nbytes').items() if value
+}))
+_register(Gauge('wash_table_version', 'Version of each table in this process.', ['table'], lambda: {
+    (name,): hp.TABLES.version(name) for name in hp.TABLES.names
+}))
+_register(Gauge('wash_table_rows', 'Rows of each loaded table.', ['table'], lambda: _loaded_tables(len)))
+_register(Gauge('wash_table_bytes', 'Memory used by each loaded table.', ['table'], lambda: _loaded_tables(
+    lambda data: data.memory_usage(index=True, deep=False).sum()
+)))
+_register(Gauge('wash_journal_pending_changes', 'Changes made from the dashboard not saved to the storage yet.', [], lambda: {
+    (): len(hp.WRITER.journal.pending())
+}))
+
+
+## ROUTE ##
+
+async def metrics(request):
+    """GET metrics: the metrics of this process."""
+    return PlainTextResponse(await run_in_threadpool(exposition), media_type='text/plain; version=0.0.4')
+
+## Mounted next to the Shiny app (see app.py)
+ROUTES = [Route('/metrics', metrics)]
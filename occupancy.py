@@ -0,0 +1,183 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+### Advisor x day occupancy matrix ###
+## Built once from the calendar table and then updated incrementally: a new version of the calendar is compared
+## with the previous one by index label and only the added, edited and deleted events are applied.
+## Prefix sums of the busy business days answer availability questions with one subtraction per advisor.
+
+FREE = -1
+## Above this many changed events the matrix is simply rebuilt
+MAX_INCREMENTAL_CHANGES = 200
+EVENT_COLUMNS = ['advisor', 'type', 'start_date', 'end_date']
+
+
+def _calendar_key(calendars):
+    """Comparable content of the advisors' np.busdaycalendar objects."""
+    return tuple(sorted(
+        (name, cal.weekmask.tobytes(), cal.holidays.tobytes()) for name, cal in (calendars or {}).items()
+    ))
+
+
+class Occupancy:
+    """
+    Occupancy of each advisor on each day.
+
+    codes: advisors x days array with the type code of the event on that day (FREE if none)
+    counts: number of events on that day
+    busy_cum / busdays_cum: prefix sums along the days of the busy business days and of the business days
+    """
+
+    def __init__(self):
+        self.data = None
+        self.advisors, self.types = [], []
+        self.days = np.array([], dtype='datetime64[D]')
+        self._calendar_key = None
+        self._lock = threading.Lock()
+
+    def update(self, data, calendars=None):
+        """Bring the matrix up to date with the calendar table. Returns self."""
+        with self._lock:
+            key = _calendar_key(calendars)
+            if data is self.data and key == self._calendar_key:
+                return self
+            if self.data is None or key != self._calendar_key or not self._apply_changes(data):
+                self._build(data, calendars)
+            self.data = data
+            self._calendar_key = key
+        return self
+
+    ## Building
+
+    def _events(self, data):
+        """Positions (advisor row, first day, last day) and type codes of the valid events."""
+        data = data.dropna(subset=EVENT_COLUMNS)
+        data = data[data.end_date >= data.start_date]
+        rows = data.advisor.map(self._row).to_numpy(dtype=np.int64)
+        codes = data.type.map(self._code).to_numpy(dtype=np.int64)
+        first = self._position(data.start_date)
+        last = self._position(data.end_date)
+        return rows, first, last, codes
+
+    def _position(self, dates):
+        return (dates.to_numpy(dtype='datetime64[D]') - self.days[0]).astype(np.int64)
+
+    def _build(self, data, calendars):
+        calendars = calendars or {}
+        events = data.dropna(subset=EVENT_COLUMNS)
+        self.advisors = sorted(set(events.advisor) | set(calendars))
+        self.types = sorted(set(events.type))
+        self._row = {advisor: i for i, advisor in enumerate(self.advisors)}
+        self._code = {type_: i for i, type_ in enumerate(self.types)}
+
+        ## Whole years, plus the next one so that new events rarely fall outside the matrix
+        years = pd.concat([events.start_date, events.end_date]).dt.year
+        first_year = int(years.min()) if len(years) else pd.Timestamp.today().year
+        last_year = int(years.max()) + 1 if len(years) else first_year + 1
+        self.days = np.arange(f'{first_year}-01-01', f'{last_year + 1}-01-01', dtype='datetime64[D]')
+
+        default = np.busdaycalendar()
+        self.busdays = np.vstack([
+            np.is_busday(self.days, busdaycal=calendars.get(advisor, default)) for advisor in self.advisors
+        ]) if self.advisors else np.zeros((0, len(self.days)), dtype=bool)
+
+        rows, first, last, codes = self._events(data)
+        ## Event counts from a difference array: +1 on the first day, -1 after the last day
+        diff = np.zeros((len(self.advisors), len(self.days) + 1), dtype=np.int32)
+        np.add.at(diff, (rows, first), 1)
+        np.add.at(diff, (rows, last + 1), -1)
+        self.counts = np.cumsum(diff[:, :-1], axis=1)
+
+        self.codes = np.full((len(self.advisors), len(self.days)), FREE, dtype=np.int16)
+        for row, start, stop, code in zip(rows, first, last + 1, codes):
+            self.codes[row, start:stop] = code
+
+        self.busy_cum = np.zeros((len(self.advisors), len(self.days) + 1), dtype=np.int32)
+        self.busdays_cum = np.zeros_like(self.busy_cum)
+        np.cumsum((self.counts > 0) & self.busdays, axis=1, out=self.busy_cum[:, 1:])
+        np.cumsum(self.busdays, axis=1, out=self.busdays_cum[:, 1:])
+
+    ## Incremental updates
+
+    def _apply_changes(self, data):
+        """Apply the differences between the previous calendar and the new one. Returns False if a rebuild is needed."""
+        previous = self.data
+        if not (previous.index.is_unique and data.index.is_unique):
+            return False
+        common = previous.index.intersection(data.index)
+        ## As objects: categoricals with different categories cannot be compared
+        before = previous.loc[common, EVENT_COLUMNS].astype(object)
+        after = data.loc[common, EVENT_COLUMNS].astype(object)
+        edited = common[~((before == after) | (before.isna() & after.isna())).all(axis=1).to_numpy()]
+        removed = previous.loc[previous.index.difference(data.index).union(edited)]
+        added = data.loc[data.index.difference(previous.index).union(edited)]
+        if len(removed) + len(added) > MAX_INCREMENTAL_CHANGES:
+            return False
+
+        ## New advisors, new types or dates outside the matrix need a rebuild
+        valid = added.dropna(subset=EVENT_COLUMNS)
+        if not (valid.advisor.isin(self._row).all() and valid.type.isin(self._code).all()):
+            return False
+        if len(valid) and (valid.start_date.min() < self.days[0] or valid.end_date.max() > self.days[-1]):
+            return False
+
+        touched = {}
+        for sign, events in ((-1, removed), (1, added)):
+            rows, first, last, _ = self._events(events)
+            for row, start, stop in zip(rows, first, last + 1):
+                self.counts[row, start:stop] += sign
+                touched.setdefault(row, []).append((start, stop))
+
+        for row, spans in touched.items():
+            self._repaint(data, row, spans)
+            start = min(start for start, _ in spans)
+            busy = (self.counts[row, start:] > 0) & self.busdays[row, start:]
+            self.busy_cum[row, start + 1:] = self.busy_cum[row, start] + np.cumsum(busy)
+        return True
+
+    def _repaint(self, data, row, spans):
+        """Recompute the type codes of the advisor on the given day spans from the events of the new calendar."""
+        for start, stop in spans:
+            self.codes[row, start:stop] = FREE
+        events = data[data.advisor == self.advisors[row]]
+        rows, first, last, codes = self._events(events)
+        for event_start, event_stop, code in zip(first, last + 1, codes):
+            for start, stop in spans:
+                lo, hi = max(start, event_start), min(stop, event_stop)
+                if lo < hi:
+                    self.codes[row, lo:hi] = code
+
+    ## Queries
+
+    def _span(self, start, end):
+        """Positions in the prefix sums of the days from start to end (included), clipped to the matrix."""
+        start = np.datetime64(pd.Timestamp(start).date(), 'D')
+        end = np.datetime64(pd.Timestamp(end).date(), 'D') + 1
+        first, last = (np.array([start, end]) - self.days[0]).astype(np.int64).clip(0, len(self.days))
+        return first, last
+
+    def busy_days(self, start, end):
+        """Busy business days of each advisor from start to end (included), as an array in the order of self.advisors."""
+        first, last = self._span(start, end)
+        return self.busy_cum[:, last] - self.busy_cum[:, first]
+
+    def free_advisors(self, start, end):
+        """Advisors without any event on the business days from start to end (included)."""
+        busy = self.busy_days(start, end)
+        return [advisor for advisor, days in zip(self.advisors, busy) if days == 0]
+
+    def workload(self, start, end, freq='W'):
+        """Share of the business days with an event, per advisor (rows) and per week or month (columns)."""
+        periods = pd.period_range(start, end, freq=freq)
+        bounds = np.array(
+            [p.start_time.date() for p in periods] + [(periods[-1].end_time + pd.Timedelta(days=1)).date()],
+            dtype='datetime64[D]'
+        )
+        positions = (bounds - self.days[0]).astype(np.int64).clip(0, len(self.days))
+        busy = np.diff(self.busy_cum[:, positions], axis=1)
+        busdays = np.diff(self.busdays_cum[:, positions], axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            share = np.where(busdays > 0, busy / busdays, np.nan)
+        return pd.DataFrame(share, index=self.advisors, columns=[p.start_time for p in periods])
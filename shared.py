@@ -0,0 +1,128 @@
+import os
+import json
+import fcntl
+import threading
+from pathlib import Path
+
+import pyarrow as pa
+
+### Tables shared by the worker processes of a deployment ###
+## With several workers (e.g. uvicorn --workers 4) set WASH_SHARED_DIR to a directory shared by the workers,
+## ideally in memory (/dev/shm/wash). Each version of a table is published there once as an Arrow IPC file,
+## listed in a manifest.json {table: version}, and the workers memory-map it: the numeric, date and categorical
+## columns without missing values stay in the one shared copy, while text (object) columns and columns with missing
+## values are converted into each worker's memory. Every change publishes the whole table as a new file.
+## The workers poll the manifest (one stat) and take the new versions, so their views never drift apart.
+## Changes are written by one worker at a time (write.lock): it takes the latest version, checks and journals
+## the change in the shared journal and publishes the new version. One worker, the loader (the one holding
+## loader.lock, taken over by another worker if it exits), checks the storage for remote changes and saves
+## the journal, so the number of API calls does not grow with the number of workers.
+
+SHARED_DIR = os.getenv('WASH_SHARED_DIR')
+## Seconds between two checks of the manifest for versions published by the other workers
+POLL_INTERVAL = float(os.getenv('WASH_SHARED_POLL_INTERVAL', 0.5))
+
+
+class SharedLock:
+    """Lock held by one thread of one process at a time (flock of a file), reentrant within the thread."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._fd = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        self._depth += 1
+        return self
+
+    def __exit__(self, *exc):
+        self._depth -= 1
+        if self._depth == 0:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+        self._thread_lock.release()
+
+
+class SharedStore:
+    """Directory of <table>.<version>.arrow files plus a manifest.json with the latest version of each table."""
+
+    def __init__(self, path=SHARED_DIR, poll_interval=POLL_INTERVAL):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.poll_interval = poll_interval
+        ## Serializes the loads and the changes of all the workers
+        self.lock = SharedLock(self.path / 'write.lock')
+        self._loader_fd = None
+        self._manifest = {}
+        self._manifest_stat = None
+
+    @property
+    def journal_path(self):
+        return self.path / 'journal.jsonl'
+
+    def _manifest_path(self):
+        return self.path / 'manifest.json'
+
+    def manifest(self):
+        """Latest published version of each table, read again only when the file changed."""
+        try:
+            stat = os.stat(self._manifest_path())
+        except FileNotFoundError:
+            return {}
+        key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if key != self._manifest_stat:
+            try:
+                self._manifest = json.loads(self._manifest_path().read_text())
+            except ValueError:
+                return self._manifest
+            self._manifest_stat = key
+        return self._manifest
+
+    def _table_path(self, name, version):
+        return self.path / f'{name}.{version}.arrow'
+
+    def load(self, name, version):
+        """Memory-map the published version of the table (text columns and columns with missing values are copied)."""
+        with pa.memory_map(str(self._table_path(name, version))) as source:
+            return pa.ipc.open_file(source).read_all().to_pandas(split_blocks=True)
+
+    def publish(self, name, data):
+        """Publish the table as its next version. Returns the version, None if it cannot be stored as Arrow."""
+        try:
+            table = pa.Table.from_pandas(data, preserve_index=True)
+        except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+            print(f'Could not share {name} with the other workers: {str(e)}')
+            return None
+        with self.lock:
+            manifest = dict(self.manifest())
+            version = manifest.get(name, 0) + 1
+            tmp = self.path / f'.{name}.arrow.tmp'
+            with pa.OSFile(str(tmp), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp, self._table_path(name, version))
+            manifest[name] = version
+            tmp = self.path / '.manifest.json.tmp'
+            tmp.write_text(json.dumps(manifest))
+            os.replace(tmp, self._manifest_path())
+            ## Keep the previous version for the workers reading it right now, the mapped files stay valid once deleted
+            self._table_path(name, version - 2).unlink(missing_ok=True)
+        return version
+
+    def is_loader(self):
+        """Whether this process is the loader: the first one to lock loader.lock, until it exits."""
+        if self._loader_fd is None:
+            fd = os.open(self.path / 'loader.lock', os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return False
+            self._loader_fd = fd
+        return True
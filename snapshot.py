@@ -0,0 +1,76 @@
+import os
+import json
+import threading
+from pathlib import Path
+
+import pyarrow as pa
+
+### On-disk snapshot of the loaded tables for warm restarts ###
+## Each parsed table is saved as an Arrow IPC file, tagged with the remote version it was loaded from.
+## On the next start the tables are memory-mapped from the snapshot and served immediately,
+## while the remote version is checked in the background.
+
+app_dir = Path(__file__).parent
+
+SNAPSHOT_PATH = Path(os.getenv('WASH_SNAPSHOT_PATH', app_dir / 'data' / 'snapshot'))
+
+
+class Snapshot:
+    """Directory of <table>.arrow files plus a meta.json with the remote version of each table."""
+
+    def __init__(self, path=SNAPSHOT_PATH):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def _meta_path(self):
+        return self.path / 'meta.json'
+
+    def versions(self):
+        """Remote version of each table in the snapshot."""
+        try:
+            return json.loads(self._meta_path().read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+
+    def load(self, names):
+        """Memory-map the tables from the snapshot."""
+        tables = {}
+        for name in names:
+            with pa.memory_map(str(self.path / f'{name}.arrow')) as source:
+                tables[name] = pa.ipc.open_file(source).read_all().to_pandas()
+        return tables
+
+    def save(self, tables, remote_version):
+        """Save the tables (dict name -> DataFrame) as loaded from the given remote version."""
+        saved = []
+        for name, data in tables.items():
+            try:
+                table = pa.Table.from_pandas(data, preserve_index=True)
+            except (pa.ArrowInvalid, pa.ArrowTypeError) as e:
+                ## e.g. a column mixing numbers and text, the table is simply not snapshotted
+                print(f'Could not snapshot {name}: {str(e)}')
+                continue
+            tmp = self.path / f'.{name}.arrow.tmp'
+            with pa.OSFile(str(tmp), 'wb') as sink:
+                with pa.ipc.new_file(sink, table.schema) as writer:
+                    writer.write_table(table)
+            os.replace(tmp, self.path / f'{name}.arrow')
+            saved.append(name)
+
+        with self._lock:
+            meta = self.versions()
+            meta.update({name: remote_version for name in saved})
+            self._write_meta(meta)
+
+    def discard(self, names):
+        """Forget the tables (e.g. saved since they were snapshotted), they are loaded from the remote on the next start."""
+        with self._lock:
+            meta = self.versions()
+            if any(name in meta for name in names):
+                self._write_meta({name: version for name, version in meta.items() if name not in names})
+
+    def _write_meta(self, meta):
+        tmp = self.path / '.meta.json.tmp'
+        tmp.write_text(json.dumps(meta))
+        os.replace(tmp, self._meta_path())
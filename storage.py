@@ -0,0 +1,318 @@
+import os
+import sqlite3
+import threading
+from pathlib import Path
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+from pandas.io.parsers import TextParser
+from gspread.utils import absolute_range_name
+from gspread_dataframe import set_with_dataframe
+
+### Storage backends for the dashboard tables ###
+## The backend is chosen with the WASH_STORAGE environment variable ('sheets', 'sqlite' or 'parquet').
+## WASH_STORAGE_PATH points to the sqlite file or to the parquet directory for the local backends.
+
+app_dir = Path(__file__).parent
+
+TABLES = ['advisors', 'countries', 'types', 'risk_matrix', 'programmes', 'calendar', 'wash_list', 'country_calls']
+
+## Google Sheets serial dates count days from 30-Dec-1899
+SHEETS_EPOCH = pd.Timestamp('1899-12-30')
+DATE_FORMAT = {'numberFormat': {'type': 'DATE_TIME', 'pattern': 'dd-mm-yyyy'}}
+
+## Tables read in parallel by the backends that cannot fetch several tables in one request
+MAX_READ_WORKERS = 4
+
+DEFAULT_PATHS = {
+    'sqlite': app_dir / 'data' / 'wash_sal.db',
+    'parquet': app_dir / 'data' / 'parquet',
+}
+
+
+class StorageBackend:
+    """Read and write whole tables (one worksheet = one table)."""
+
+    name = 'base'
+
+    def read_table(self, name):
+        raise NotImplementedError
+
+    def write_table(self, name, data):
+        raise NotImplementedError
+
+    def read_tables(self, names):
+        """Read several tables at once (in parallel on a small thread pool, backends may do better)."""
+        names = list(names)
+        if len(names) <= 1:
+            return {name: self.read_table(name) for name in names}
+        with ThreadPoolExecutor(max_workers=min(MAX_READ_WORKERS, len(names))) as pool:
+            return dict(zip(names, pool.map(self.read_table, names)))
+
+    def mark_persisted(self, name, data):
+        """Remember the (parsed) table as it is currently stored, used by backends that write incrementally."""
+        pass
+
+    def remote_version(self):
+        """Cheap stamp that changes whenever the stored tables change (None if unknown)."""
+        return None
+
+
+class SheetsBackend(StorageBackend):
+    """Tables stored as worksheets of the Google Sheets database.
+
+    Reads of several tables are done with a single values_batch_get request.
+    Writes are incremental: the new table is compared with the last persisted one and only the deleted,
+    changed and appended rows are sent, together with their date formats, in a single batch_update.
+    """
+
+    name = 'sheets'
+
+    def __init__(self, open_data_file):
+        ## The spreadsheet is opened (authentication + metadata request) on first use only
+        self._open_data_file = open_data_file
+        self._data_file = None
+        self._lock = threading.Lock()
+        self._worksheets = None
+        self._persisted = {}
+
+    @property
+    def data_file(self):
+        if self._data_file is None:
+            with self._lock:
+                if self._data_file is None:
+                    self._data_file = self._open_data_file()
+        return self._data_file
+
+    def _worksheet(self, name):
+        ## The worksheet list is fetched once (each worksheet() call is a metadata request)
+        if self._worksheets is None:
+            self._worksheets = {ws.title: ws for ws in self.data_file.worksheets()}
+        return self._worksheets[name]
+
+    def read_table(self, name):
+        return self.read_tables([name])[name]
+
+    def remote_version(self):
+        ## Drive metadata request, much cheaper than reading the worksheets
+        return self.data_file.get_lastUpdateTime()
+
+    def read_tables(self, names):
+        names = list(names)
+        ## Same render options as gspread_dataframe.get_as_dataframe
+        response = self.data_file.values_batch_get(
+            [absolute_range_name(name) for name in names],
+            params={'valueRenderOption': 'FORMULA', 'dateTimeRenderOption': 'FORMATTED_STRING'}
+        )
+        return {
+            name: values_to_dataframe(value_range.get('values', []))
+            for name, value_range in zip(names, response['valueRanges'])
+        }
+
+    def mark_persisted(self, name, data):
+        ## Row positions are only known if no empty rows were dropped while reading the sheet
+        if data.index.equals(pd.RangeIndex(len(data))):
+            self._persisted[name] = data
+
+    def write_table(self, name, data):
+        try:
+            worksheet = self._worksheet(name)
+        except KeyError:
+            self._worksheets = None
+            worksheet = self._worksheet(name)
+        ## Dropped until the write succeeds: after a failed write the sheet is unknown (a batch_update may have been
+        ## applied without an answer), the next save rewrites the whole table
+        previous = self._persisted.pop(name, None)
+        requests = None if previous is None else diff_requests(worksheet.id, previous, data)
+
+        if requests is None:
+            self._rewrite(worksheet, data)
+        elif requests:
+            self.data_file.batch_update({'requests': requests})
+        self._persisted[name] = data
+
+    def _rewrite(self, worksheet, data):
+        """Full rewrite of the worksheet, used when the row order changed or nothing was persisted yet."""
+        worksheet.clear()
+        set_with_dataframe(worksheet, data)
+
+        ## Format all datetime columns with a single request
+        datetime_columns = data.select_dtypes(include=['datetime64[ns]']).columns
+        requests = [{
+            'repeatCell': {
+                'range': {
+                    'sheetId': worksheet.id,
+                    'startRowIndex': 1,
+                    'endRowIndex': len(data) + 1,
+                    'startColumnIndex': data.columns.get_loc(col),
+                    'endColumnIndex': data.columns.get_loc(col) + 1,
+                },
+                'cell': {'userEnteredFormat': DATE_FORMAT},
+                'fields': 'userEnteredFormat.numberFormat',
+            }
+        } for col in datetime_columns]
+        if requests and len(data):
+            self.data_file.batch_update({'requests': requests})
+
+
+def values_to_dataframe(values):
+    """
+    Turn the cell values of a worksheet into a DataFrame, parsed like gspread_dataframe.get_as_dataframe:
+    first row as header, pandas type inference, empty rows and empty unnamed columns dropped.
+    """
+    if not values:
+        return pd.DataFrame()
+    ## The API does not return trailing empty cells
+    width = max(len(row) for row in values)
+    rows = [row + [''] * (width - len(row)) for row in values]
+    data = TextParser(rows, header=0).read()
+    data = data.dropna(how='all', axis=0)
+    empty_unnamed = [col for col in data.columns if str(col).startswith('Unnamed:') and data[col].isna().all()]
+    return data.drop(columns=empty_unnamed)
+
+def _comparable(data):
+    """Object view of the table with missing values as None, so that rows can be compared cell by cell."""
+    return data.astype(object).where(data.notna(), None).to_numpy()
+
+def _cell(value):
+    """Convert a python value into a Sheets CellData."""
+    if value is None:
+        return {}
+    if isinstance(value, (pd.Timestamp, np.datetime64)) or hasattr(value, 'isoformat'):
+        serial = (pd.Timestamp(value) - SHEETS_EPOCH) / pd.Timedelta(days=1)
+        return {'userEnteredValue': {'numberValue': serial}, 'userEnteredFormat': DATE_FORMAT}
+    if isinstance(value, (bool, np.bool_)):
+        return {'userEnteredValue': {'boolValue': bool(value)}}
+    if isinstance(value, (int, float, np.integer, np.floating)):
+        return {'userEnteredValue': {'numberValue': float(value)}}
+    return {'userEnteredValue': {'stringValue': str(value)}}
+
+def _row_data(values):
+    return [{'values': [_cell(v) for v in row]} for row in values]
+
+def _runs(positions):
+    """Group sorted positions into (start, stop) runs of consecutive values."""
+    runs = []
+    for pos in map(int, positions):
+        if runs and runs[-1][1] == pos:
+            runs[-1][1] = pos + 1
+        else:
+            runs.append([pos, pos + 1])
+    return runs
+
+def diff_requests(sheet_id, previous, data):
+    """
+    Build the batch_update requests turning the persisted table into the new one.
+
+    Rows are matched by index label. Returns None when the change cannot be expressed as
+    deletions + updates + appends (different columns, reordered or inserted rows).
+    """
+    if list(previous.columns) != list(data.columns):
+        return None
+    if not (previous.index.is_unique and data.index.is_unique):
+        return None
+
+    kept = previous.index.isin(data.index)
+    surviving = previous.index[kept]
+    if not data.index[:len(surviving)].equals(surviving):
+        return None
+
+    requests = []
+    ## Delete from the bottom up so that the positions of the remaining rows do not move
+    for start, stop in reversed(_runs(np.flatnonzero(~kept))):
+        requests.append({'deleteDimension': {'range': {
+            'sheetId': sheet_id, 'dimension': 'ROWS', 'startIndex': start + 1, 'endIndex': stop + 1
+        }}})
+
+    old_values = _comparable(previous[kept])
+    new_values = _comparable(data)
+    changed = np.flatnonzero((old_values != new_values[:len(surviving)]).any(axis=1)) if len(surviving) else []
+    for start, stop in _runs(changed):
+        requests.append({'updateCells': {
+            'start': {'sheetId': sheet_id, 'rowIndex': start + 1, 'columnIndex': 0},
+            'rows': _row_data(new_values[start:stop]),
+            'fields': 'userEnteredValue,userEnteredFormat.numberFormat',
+        }})
+
+    if len(data) > len(surviving):
+        requests.append({'appendCells': {
+            'sheetId': sheet_id,
+            'rows': _row_data(new_values[len(surviving):]),
+            'fields': 'userEnteredValue,userEnteredFormat.numberFormat',
+        }})
+
+    return requests
+
+
+class SQLiteBackend(StorageBackend):
+    """Tables stored in a single local sqlite file."""
+
+    name = 'sqlite'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+    def _connect(self):
+        return sqlite3.connect(self.path)
+
+    def remote_version(self):
+        return self.path.stat().st_mtime_ns if self.path.exists() else None
+
+    def read_table(self, name):
+        with self._connect() as conn:
+            ## pandas stores datetime columns as TIMESTAMP, parse them back on the way in
+            columns = conn.execute(f'PRAGMA table_info("{name}")').fetchall()
+            if not columns:
+                raise KeyError(f'Table {name} not found in {self.path}')
+            parse_dates = [col[1] for col in columns if col[2] == 'TIMESTAMP']
+            return pd.read_sql(f'SELECT * FROM "{name}"', conn, parse_dates=parse_dates)
+
+    def write_table(self, name, data):
+        with self._connect() as conn:
+            data.to_sql(name, conn, if_exists='replace', index=False)
+
+
+class ParquetBackend(StorageBackend):
+    """Tables stored as one parquet file per table in a local directory."""
+
+    name = 'parquet'
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def read_table(self, name):
+        return pd.read_parquet(self.path / f'{name}.parquet')
+
+    def remote_version(self):
+        return max((f.stat().st_mtime_ns for f in self.path.glob('*.parquet')), default=None)
+
+    def write_table(self, name, data):
+        ## Write to a temporary file first so that readers never see a half written table
+        tmp = self.path / f'.{name}.parquet.tmp'
+        data.to_parquet(tmp, index=False)
+        os.replace(tmp, self.path / f'{name}.parquet')
+
+
+def get_backend(kind=None, path=None, open_data_file=None):
+    """Return the storage backend selected by the configuration (WASH_STORAGE, WASH_STORAGE_PATH)."""
+    kind = (kind or os.getenv('WASH_STORAGE', 'sheets')).lower()
+    path = path or os.getenv('WASH_STORAGE_PATH')
+
+    if kind == 'sheets':
+        return SheetsBackend(open_data_file)
+    if kind == 'sqlite':
+        return SQLiteBackend(path or DEFAULT_PATHS['sqlite'])
+    if kind == 'parquet':
+        return ParquetBackend(path or DEFAULT_PATHS['parquet'])
+    raise ValueError(f'Unknown storage backend: {kind} (expected sheets, sqlite or parquet)')
+
+
+def copy_tables(source, target, names=TABLES):
+    """Copy tables from one backend to another, e.g. to seed a local store from Google Sheets."""
+    for name in names:
+        target.write_table(name, source.read_table(name))
+        print(f'Copied {name} from {source.name} to {target.name}')
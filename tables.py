@@ -0,0 +1,360 @@
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+import pandas as pd
+
+### In-memory registry of the dashboard tables ###
+## Each table is loaded on first access (nothing is downloaded when the app is imported)
+## and has a version number that is bumped every time the table is replaced.
+## Tables are fetched in bulk: accessing a table also loads the other tables of its group
+## (e.g. the tables shown on the same panel) with a single backend request.
+## The registry is shared by all the sessions of the process. A background thread checks the remote
+## version stamp of the storage (e.g. the Drive modifiedTime) and reloads the tables only when it changed.
+## With a snapshot (see snapshot.py), tables are served from disk right after a restart and revalidated in the background.
+## With a shared store (see shared.py), each table version is published once and loaded by the other worker processes.
+## Tables are handed out as stored and never modified in place: a change produces a new table and version (see journal.py).
+## With copy-on-write, frames derived from a table (filter, assign, rename...) share its data until they are written to,
+## so readers do not need defensive copies.
+
+pd.options.mode.copy_on_write = True
+
+
+class TableRegistry:
+    """Tables loaded on first access, with a version per table."""
+
+    def __init__(self, backend, parsers, groups=(), refresh_interval=None, on_load=None, snapshot=None, shared=None):
+        ## parsers maps each table name to a function turning the raw table into the parsed one
+        self.backend = backend
+        self.parsers = parsers
+        ## Called with (name, parsed table) after every load, from the remote or from the snapshot
+        self.on_load = on_load or (lambda name, data: data)
+        self.snapshot = snapshot
+        ## shared.SharedStore of the workers, None when the app runs in a single process
+        self.shared = shared
+        self.groups = [list(group) for group in groups]
+        ## Seconds between two checks of the remote version (None: never check)
+        self.refresh_interval = refresh_interval
+        self._data = {}
+        self._versions = {name: 0 for name in parsers}
+        ## Per table: the swap of the stored table. All loads are serialized on _load_lock, taken before any table lock
+        self._locks = {name: threading.RLock() for name in parsers}
+        self._load_lock = threading.RLock()
+        self._remote_version = None
+        self._watcher = None
+        self._listeners = []
+        self._loader_listeners = []
+        ## Version of the shared store each table comes from, and the table published last by this process
+        self._shared_versions = {}
+        self._shared_data = {}
+        ## Tables changed in memory since they were loaded (see __setitem__)
+        self._modified = set()
+
+    @property
+    def names(self):
+        return list(self.parsers)
+
+    def group_of(self, name):
+        """The tables loaded together with the given one."""
+        for group in self.groups:
+            if name in group:
+                return group
+        return [name]
+
+    def load(self, names):
+        """Fetch the tables with one backend request, parse them and store them. Returns the tables that were loaded."""
+        with self._shared_lock(), self._load_lock:
+            try:
+                remote_version = self._get_remote_version()
+                raw = self.backend.read_tables(names)
+            except Exception as e:
+                print(f'Oops, something went wrong while trying to import {", ".join(names)}.\nException: {str(e)}')
+                return {}
+            loaded, parsed, changed = {}, {}, []
+            for name in names:
+                stored = self._before_load(name)
+                try:
+                    parsed[name] = self.parsers[name](raw[name])
+                    data = self.on_load(name, parsed[name])
+                except Exception as e:
+                    ## Do not store a failed load, it will be retried on the next access
+                    print(f'Oops, something went wrong while trying to import the {name} db.\nException: {str(e)}')
+                    continue
+                data, replaced = self._store_loaded(name, data, stored)
+                if replaced:
+                    changed.append(name)
+                loaded[name] = data
+                self._publish(name)
+            ## The tables loaded earlier are only up to date if the remote did not change in the meantime,
+            ## otherwise keep the old stamp so that the next check reloads everything
+            if len(loaded) == len(names) and (remote_version == self._remote_version or not self._others_loaded(names)):
+                self._remote_version = remote_version
+            self._save_snapshot(parsed, remote_version)
+            self._start_watching()
+        self._notify(changed)
+        return loaded
+
+    def _stored(self, name):
+        ## Changes when a table is stored (see __setitem__), to tell whether on_load stored the table itself
+        with self._locks[name]:
+            return self._versions[name], name in self._data
+
+    def _before_load(self, name):
+        ## The table about to be loaded matches the snapshot, unless on_load stores it with changes (see __setitem__)
+        with self._locks[name]:
+            self._modified.discard(name)
+            return self._stored(name)
+
+    def _store_loaded(self, name, data, stored):
+        """Store the table returned by on_load, unless on_load stored it (see stored). Returns (the table, whether it was replaced here)."""
+        with self._locks[name]:
+            if self._stored(name) != stored:
+                ## Stored by on_load (e.g. journal.WriteBehind.track), and maybe changed since (a mutation submitted
+                ## right after the replay): the stored table is the latest, it must not be overwritten
+                return self._data[name], False
+            if name in self._data and self._data[name].equals(data):
+                ## Unchanged: keep the current table and version, nothing to re-render
+                return self._data[name], False
+            if name in self._data:
+                self._versions[name] += 1
+            self._data[name] = data
+            return data, True
+
+    def _others_loaded(self, names):
+        return any(name not in names for name in self._data)
+
+    def get(self, name):
+        """Return the table, loading it (and the rest of its group) on first access. Returns None if it could not be loaded."""
+        if name not in self._data:
+            ## With workers, only one of them loads the tables (the others take the published versions)
+            with self._shared_lock(), self._load_lock:
+                if name not in self._data:
+                    self.sync(self.group_of(name))
+                    group = [n for n in self.group_of(name) if n not in self._data]
+                    if group and not self._restore(group):
+                        self.load(group)
+                    self._start_watching()
+        return self._data.get(name)
+
+    def refresh(self, names=None):
+        """Reload the given tables (default: all the loaded ones) with one backend request."""
+        names = [n for n in (names or self.names) if n in self._data]
+        return self.load(names) if names else {}
+
+    ## Snapshot
+
+    def _save_snapshot(self, parsed, remote_version):
+        if self.snapshot is None or remote_version is None or not parsed:
+            return
+        try:
+            self.snapshot.save(parsed, remote_version)
+        except Exception as e:
+            print(f'Could not save the snapshot of {", ".join(parsed)}: {str(e)}')
+
+    def _restore(self, names):
+        """Serve the tables from the snapshot if it has all of them, the remote is then checked in the background."""
+        if self.snapshot is None:
+            return False
+        versions = self.snapshot.versions()
+        if not all(name in versions for name in names):
+            return False
+        stored = {name: self._before_load(name) for name in names}
+        try:
+            restored = {name: self.on_load(name, data) for name, data in self.snapshot.load(names).items()}
+        except Exception as e:
+            print(f'Could not load {", ".join(names)} from the snapshot, loading them from the storage.\nException: {str(e)}')
+            return False
+
+        with self._shared_lock(), self._load_lock:
+            for name, data in restored.items():
+                self._store_loaded(name, data, stored[name])
+                self._publish(name)
+            stamps = {versions[name] for name in names}
+            if len(stamps) == 1 and (self._remote_version in stamps or not self._others_loaded(names)):
+                self._remote_version = stamps.pop()
+            else:
+                ## Tables from different remote versions: the next check reloads everything
+                self._remote_version = None
+        print(f'Loaded {", ".join(names)} from the snapshot')
+        self._notify(names)
+        threading.Thread(target=self.check_for_changes, name='table-revalidate', daemon=True).start()
+        self._start_watching()
+        return True
+
+    ## Remote change detection
+
+    def _get_remote_version(self):
+        try:
+            return self.backend.remote_version()
+        except Exception as e:
+            print(f'Could not check the remote version: {str(e)}')
+            return None
+
+    def check_for_changes(self):
+        """Reload the loaded tables if the storage changed since they were loaded. Returns the reloaded tables."""
+        if not self._data or not self.is_loader():
+            return {}
+        remote_version = self._get_remote_version()
+        if remote_version is None or remote_version == self._remote_version:
+            return {}
+        print(f'Remote data changed ({self._remote_version} -> {remote_version}), reloading')
+        ## Reload everything that is loaded, so that all tables come from the same remote version
+        return self.load(list(self._data))
+
+    @contextmanager
+    def own_write(self):
+        """Wrap the writes of this process, so that they are not seen as remote changes."""
+        before = self._get_remote_version()
+        if before is not None and before != self._remote_version and self._data:
+            ## Never write over tables that changed remotely (or were served from an old snapshot):
+            ## reload them first, the unsaved changes are replayed on top
+            names = list(self._data)
+            if len(self.load(names)) < len(names):
+                raise RuntimeError('Could not reload the tables before saving')
+            before = self._remote_version
+        yield
+        after = self._get_remote_version()
+        if before is not None and before == self._remote_version:
+            self._remote_version = after
+        if self.snapshot is not None and self._modified:
+            ## The saved tables no longer match the snapshot: the unsaved changes would be replayed on outdated rows
+            self.snapshot.discard(set(self._modified))
+
+    def _start_watching(self):
+        if (self.refresh_interval is None and self.shared is None) or (self._watcher is not None and self._watcher.is_alive()):
+            return
+        self._watcher = threading.Thread(target=self._watch, name='table-watcher', daemon=True)
+        self._watcher.start()
+
+    def _watch(self):
+        if self.shared is not None:
+            return self._watch_shared()
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.check_for_changes()
+            except Exception as e:
+                print(f'Something went wrong while checking for remote changes: {str(e)}')
+
+    def _watch_shared(self):
+        ## Workers: take the versions published by the others, the loader also checks the remote
+        last_check, loader = time.monotonic(), False
+        while True:
+            time.sleep(self.shared.poll_interval)
+            try:
+                self.sync()
+                if not loader and self.is_loader():
+                    loader = True
+                    print('This worker is now the loader of the shared tables')
+                    self._notify_loader()
+                if loader and self.refresh_interval is not None and time.monotonic() - last_check >= self.refresh_interval:
+                    last_check = time.monotonic()
+                    self.check_for_changes()
+            except Exception as e:
+                print(f'Something went wrong while checking for changes: {str(e)}')
+
+    ## Shared store of the workers
+
+    def is_loader(self):
+        """Whether this process checks the remote and saves the changes (always, unless the tables are shared by workers)."""
+        return self.shared is None or self.shared.is_loader()
+
+    def _shared_lock(self):
+        return nullcontext() if self.shared is None else self.shared.lock
+
+    def sync(self, names=None):
+        """Take the versions published by the other workers of the given tables (default: the loaded ones). Returns the replaced tables."""
+        if self.shared is None:
+            return []
+        manifest = self.shared.manifest()
+        names = [n for n in (list(self._data) if names is None else names) if n in manifest]
+        changed = []
+        for name in names:
+            version = manifest[name]
+            if self._shared_versions.get(name) == version:
+                continue
+            try:
+                data = self.shared.load(name, version)
+            except Exception as e:
+                ## e.g. replaced by a newer version in the meantime, taken on the next check
+                print(f'Could not read version {version} of the shared {name}: {str(e)}')
+                continue
+            with self._locks[name]:
+                if name in self._data:
+                    self._versions[name] += 1
+                    ## e.g. changed by another worker, saved by the loader
+                    self._modified.add(name)
+                self._data[name] = data
+                self._shared_versions[name] = version
+                self._shared_data[name] = data
+            changed.append(name)
+        self._notify(changed)
+        return changed
+
+    def _publish(self, name):
+        """Publish the table for the other workers, unless it is the version this process already has from the store."""
+        data = self._data.get(name)
+        if self.shared is None or data is None or self._shared_data.get(name) is data:
+            return
+        with self.shared.lock:
+            version = self.shared.publish(name, data)
+            if version is not None:
+                self._shared_versions[name] = version
+                self._shared_data[name] = data
+
+    def on_loader(self, callback):
+        """Call callback() when this worker becomes the loader (e.g. to save the changes left by the previous one)."""
+        self._loader_listeners.append(callback)
+
+    def _notify_loader(self):
+        for callback in self._loader_listeners:
+            try:
+                callback()
+            except Exception as e:
+                print(f'Something went wrong while taking over as the loader: {str(e)}')
+
+    ## Change notifications
+
+    def on_change(self, callback):
+        """Call callback(names) whenever tables are loaded or replaced (e.g. to prerender the default views)."""
+        self._listeners.append(callback)
+
+    def _notify(self, names):
+        if not names:
+            return
+        for callback in self._listeners:
+            try:
+                callback(list(names))
+            except Exception as e:
+                print(f'Something went wrong while notifying the change of {", ".join(names)}: {str(e)}')
+
+    def __getitem__(self, name):
+        ## Used by the writer (see journal.WriteBehind): changes apply to the latest version of any worker
+        self.sync([name])
+        return self.get(name)
+
+    def __setitem__(self, name, data):
+        with self._locks[name]:
+            current = self._data.get(name)
+            if current is not None and (current is data or current.equals(data)):
+                ## Unchanged (e.g. a reloaded table with nothing to replay): keep the version, as load() does
+                return
+            self._data[name] = data
+            ## e.g. a change or the unsaved changes replayed on a reload: the snapshot is outdated once they are saved
+            self._modified.add(name)
+            if current is not None:
+                self._versions[name] += 1
+        self._publish(name)
+        self._notify([name])
+
+    def version(self, name):
+        return self._versions[name]
+
+    def is_loaded(self, name):
+        return name in self._data
+
+    def invalidate(self, name):
+        """Drop the table from memory, it will be reloaded on the next access."""
+        with self._locks[name]:
+            self._data.pop(name, None)
+            self._versions[name] += 1
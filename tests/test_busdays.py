@@ -0,0 +1,75 @@
+import random
+from datetime import date, timedelta
+
+import pandas as pd
+
+import busdays
+
+### Business days of the events (busdays.count_busdays) ###
+## Checked against a day by day count with each advisor's working week and holidays.
+
+WEEKDAYS = ['Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun']
+HOLIDAYS = {'JO': [date(2024, 1, 1), date(2024, 1, 7), date(2024, 5, 1)], 'KE': [date(2024, 1, 1), date(2024, 6, 1)]}
+
+ADVISORS = pd.DataFrame({
+    'short_name': ['AB', 'CD', 'EF'],
+    'weekmask': ['Sun Mon Tue Wed Thu', None, 'Mon Tue Wed Thu Fri Sat'],
+    'duty_country': ['JO', None, 'KE'],
+})
+
+
+def brute_force(start, end, weekmask, holidays):
+    if pd.isna(start) or pd.isna(end):
+        return 0
+    days, day = 0, start.date()
+    while day <= end.date():
+        days += WEEKDAYS[day.weekday()] in weekmask.split() and day not in holidays
+        day += timedelta(days=1)
+    return days
+
+def events(rng, count):
+    starts, ends = [], []
+    for _ in range(count):
+        start = pd.Timestamp(2024, 1, 1) + pd.Timedelta(days=rng.randrange(0, 180))
+        ## A few events end before they start or miss a date
+        end = start + pd.Timedelta(days=rng.randrange(-3, 40))
+        starts.append(pd.NaT if rng.random() < 0.05 else start)
+        ends.append(pd.NaT if rng.random() < 0.05 else end)
+    return pd.Series(starts, dtype='datetime64[ns]'), pd.Series(ends, dtype='datetime64[ns]')
+
+
+def test_counts_match_a_day_by_day_count(monkeypatch):
+    monkeypatch.setattr(busdays, 'country_holidays', lambda country, years: HOLIDAYS.get(country, []))
+    calendars = busdays.advisor_calendars(ADVISORS, [2024])
+    rng = random.Random(3)
+    start, end = events(rng, 300)
+    ## Advisors without a calendar (unknown or missing) count Mon-Fri without holidays
+    keys = pd.Series([rng.choice(['AB', 'CD', 'EF', 'XY', None]) for _ in range(len(start))])
+
+    counts = busdays.count_busdays(start, end, keys, calendars)
+
+    masks = dict(zip(ADVISORS.short_name, ADVISORS.weekmask.fillna(busdays.DEFAULT_WEEKMASK)))
+    countries = dict(zip(ADVISORS.short_name, ADVISORS.duty_country))
+    expected = [
+        brute_force(s, e, masks.get(key, busdays.DEFAULT_WEEKMASK), HOLIDAYS.get(countries.get(key), []))
+        for s, e, key in zip(start, end, keys)
+    ]
+    assert counts.tolist() == expected
+
+
+def test_counts_without_calendars_use_the_default_week():
+    start, end = events(random.Random(4), 100)
+    expected = [brute_force(s, e, busdays.DEFAULT_WEEKMASK, []) for s, e in zip(start, end)]
+    assert busdays.count_busdays(start, end).tolist() == expected
+
+
+def test_period_busdays_of_each_advisor(monkeypatch):
+    monkeypatch.setattr(busdays, 'country_holidays', lambda country, years: HOLIDAYS.get(country, []))
+    calendars = busdays.advisor_calendars(ADVISORS, [2024])
+    counts = busdays.period_busdays(date(2024, 1, 1), date(2024, 1, 31), ADVISORS.short_name, calendars)
+    january = pd.Timestamp(2024, 1, 1), pd.Timestamp(2024, 1, 31)
+    assert counts.to_dict() == {
+        'AB': brute_force(*january, 'Sun Mon Tue Wed Thu', HOLIDAYS['JO']),
+        'CD': brute_force(*january, busdays.DEFAULT_WEEKMASK, []),
+        'EF': brute_force(*january, 'Mon Tue Wed Thu Fri Sat', HOLIDAYS['KE']),
+    }
@@ -0,0 +1,47 @@
+import pandas as pd
+import pytest
+
+import export
+import helpers as hp
+
+### ETag of the exports (export.fingerprint) ###
+## The tables are set in the registry of the app, as the writer does, so nothing is downloaded.
+
+
+def tables():
+    return {
+        name: pd.DataFrame({'name': [f'{name} {i}' for i in range(3)], 'start_date': pd.date_range('2024-01-01', periods=3)})
+        for name in hp.TABLES.names
+    }
+
+@pytest.fixture
+def loaded(tmp_path, monkeypatch):
+    monkeypatch.setattr(export, 'EXPORT_PATH', tmp_path)
+    for name, data in tables().items():
+        hp.TABLES[name] = data
+    yield
+    for name in hp.TABLES.names:
+        hp.TABLES.invalidate(name)
+
+
+def test_etag_is_kept_while_the_data_is_unchanged(loaded):
+    path, etag = export.export('csv')
+    ## A reload with the same content: a new version of every table
+    for name, data in tables().items():
+        hp.TABLES.invalidate(name)
+        hp.TABLES[name] = data
+    assert export.export('csv') == (path, etag)
+    assert export.export('parquet')[1].startswith(etag.split('-')[0])
+
+
+def test_etag_changes_with_the_data(loaded):
+    path, etag = export.export('csv')
+    calendar = hp.TABLES.get('calendar')
+    hp.TABLES['calendar'] = calendar.assign(name=['a', 'b', 'c'])
+    changed_path, changed_etag = export.export('csv')
+    assert changed_etag != etag and changed_path != path
+    ## The previous export is kept for the clients still downloading it
+    assert path.exists() and changed_path.exists()
+    ## Back to the previous content: the previous ETag
+    hp.TABLES['calendar'] = calendar
+    assert export.export('csv') == (path, etag)
@@ -0,0 +1,57 @@
+import pytest
+import requests
+from gspread.exceptions import APIError
+
+import gateway
+
+### Retries of the requests to the API (gateway.Gateway) ###
+## Writes may have been applied when the answer is lost or is a server error: only reads are retried then.
+
+
+class Response:
+    def __init__(self, code, reason=None):
+        self.code, self.reason = code, reason
+        self.headers = {'Retry-After': '0'}
+        self.text = ''
+
+    def json(self):
+        errors = [{'reason': self.reason}] if self.reason else []
+        return {'error': {'code': self.code, 'message': '', 'errors': errors}}
+
+
+def send(*errors):
+    ## Raises the errors in turn, then answers
+    calls = []
+    def send():
+        calls.append(None)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return 'ok'
+    return send, calls
+
+def fast_gateway(monkeypatch):
+    monkeypatch.setattr(gateway.time, 'sleep', lambda seconds: None)
+    return gateway.Gateway(reads_per_minute=6000, writes_per_minute=6000, max_retries=2)
+
+
+@pytest.mark.parametrize('error', [
+    APIError(Response(503)), APIError(Response(408)), requests.ConnectionError(), requests.Timeout(),
+])
+def test_write_is_not_retried_when_it_may_have_been_applied(monkeypatch, error):
+    func, calls = send(error)
+    with pytest.raises(type(error)):
+        fast_gateway(monkeypatch).request('POST', 'https://sheets/v4/spreadsheets/id:batchUpdate', None, func)
+    assert len(calls) == 1
+
+
+@pytest.mark.parametrize('error', [APIError(Response(429)), APIError(Response(403, 'userRateLimitExceeded'))])
+def test_write_is_retried_when_the_quota_was_exceeded(monkeypatch, error):
+    func, calls = send(error)
+    assert fast_gateway(monkeypatch).request('POST', 'https://sheets/v4/spreadsheets/id:batchUpdate', None, func) == 'ok'
+    assert len(calls) == 2
+
+
+def test_read_is_retried_after_a_server_error(monkeypatch):
+    func, calls = send(APIError(Response(503)), requests.ConnectionError())
+    assert fast_gateway(monkeypatch).request('GET', 'https://sheets/v4/spreadsheets/id', None, func) == 'ok'
+    assert len(calls) == 3
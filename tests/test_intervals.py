@@ -0,0 +1,53 @@
+import random
+
+import pandas as pd
+
+from intervals import IntervalIndex
+
+### Double bookings of the calendar (intervals.IntervalIndex) ###
+## Checked against a pairwise comparison of the events of each advisor (both dates included).
+
+
+def calendar(rng, count):
+    rows = []
+    for _ in range(count):
+        start = pd.Timestamp(2024, 1, 1) + pd.Timedelta(days=rng.randrange(0, 200))
+        rows.append({
+            'advisor': rng.choice(['AB', 'CD', 'EF', None]),
+            'start_date': pd.NaT if rng.random() < 0.03 else start,
+            'end_date': start + pd.Timedelta(days=rng.randrange(0, 15)),
+        })
+    ## Labels as left by deletions in the dashboard
+    return pd.DataFrame(rows, index=rng.sample(range(10 * count), count))
+
+def overlap(a, b):
+    return a.start_date <= b.end_date and b.start_date <= a.end_date
+
+def pairwise(data, advisor, start, end):
+    event = pd.Series({'start_date': pd.Timestamp(start), 'end_date': pd.Timestamp(end)})
+    events = data.dropna(subset=['advisor', 'start_date', 'end_date'])
+    return {label for label, row in events.iterrows() if row.advisor == advisor and overlap(row, event)}
+
+
+def test_audit_matches_a_pairwise_check():
+    for seed in range(5):
+        data = calendar(random.Random(seed), 80)
+        events = data.dropna(subset=['advisor', 'start_date', 'end_date'])
+        expected = {
+            a for a, row in events.iterrows()
+            for b, other in events.iterrows() if a != b and row.advisor == other.advisor and overlap(row, other)
+        }
+        assert set(IntervalIndex().update(data).audit().index) == expected
+
+
+def test_conflicts_match_a_pairwise_check():
+    rng = random.Random(9)
+    data = calendar(rng, 120)
+    index = IntervalIndex().update(data)
+    for _ in range(100):
+        advisor = rng.choice(['AB', 'CD', 'EF', 'XY'])
+        start = pd.Timestamp(2024, 1, 1) + pd.Timedelta(days=rng.randrange(-10, 220))
+        end = start + pd.Timedelta(days=rng.randrange(0, 10))
+        excluded = set(rng.sample(list(data.index), 10))
+        expected = pairwise(data, advisor, start, end) - excluded
+        assert set(index.conflicts(advisor, start, end, exclude=excluded)) == expected
@@ -0,0 +1,135 @@
+import pandas as pd
+import pytest
+
+import journal
+
+### Replay of the journal across saves and reloads ###
+## The backend keeps the tables as a worksheet does: rows by position, so a reload numbers them 0..n-1.
+
+
+class Backend:
+    def __init__(self, **tables):
+        self.tables = {name: data.reset_index(drop=True) for name, data in tables.items()}
+
+    def read_table(self, name):
+        return self.tables[name].copy()
+
+    def write_table(self, name, data):
+        self.tables[name] = data.reset_index(drop=True)
+
+
+def calendar(*remarks):
+    return pd.DataFrame({'advisor': ['AB'] * len(remarks), 'remarks': list(remarks)})
+
+@pytest.fixture
+def backend():
+    return Backend(calendar=calendar('a', 'b', 'c', 'd', 'e'))
+
+def writer(backend, tmp_path):
+    ## No background save during the test: flush() is called explicitly
+    writer = journal.WriteBehind(journal.Journal(tmp_path / 'journal.jsonl'), backend, {}, delay=3600)
+    writer.track('calendar', backend.read_table('calendar'))
+    return writer
+
+def delete(writer, labels):
+    data = writer.tables['calendar']
+    return writer.submit(journal.delete('calendar', labels, journal.row_versions(data, labels)))
+
+def edit(writer, label, remarks):
+    data = writer.tables['calendar']
+    row = data.loc[[label]].assign(remarks=remarks)
+    return writer.submit(journal.upsert('calendar', row, journal.row_versions(data, [label])))
+
+def saved(backend):
+    return backend.tables['calendar'].remarks.tolist()
+
+
+def test_edit_after_delete_and_save_replayed_on_reload(backend, tmp_path):
+    w = writer(backend, tmp_path)
+    delete(w, [1])
+    assert w.flush()
+    ## The in-memory table keeps its labels: 'd' is still row 3
+    edit(w, 3, 'D')
+    ## Remote change: the table is reloaded numbered by position ('d' is now row 2) and the edit replayed
+    reloaded = w.track('calendar', backend.read_table('calendar'))
+    assert reloaded.remarks.tolist() == ['a', 'c', 'D', 'e']
+    assert w.flush()
+    assert saved(backend) == ['a', 'c', 'D', 'e']
+
+
+def test_pending_changes_replayed_after_restart(backend, tmp_path):
+    w = writer(backend, tmp_path)
+    delete(w, [0, 2])
+    assert w.flush()
+    edit(w, 4, 'E')
+    delete(w, [3])
+    w.insert('calendar', calendar('f'))
+
+    ## Crash before saving: a new process loads the saved table and replays the journal
+    restarted = writer(backend, tmp_path)
+    assert restarted.tables['calendar'].remarks.tolist() == ['b', 'E', 'f']
+    assert restarted.flush()
+    assert saved(backend) == ['b', 'E', 'f']
+    assert restarted.journal.pending() == []
+
+
+def test_labels_kept_across_saves_of_other_tables(tmp_path):
+    backend = Backend(calendar=calendar('a', 'b', 'c'), country_calls=calendar('x', 'y'))
+    w = writer(backend, tmp_path)
+    w.track('country_calls', backend.read_table('country_calls'))
+    delete(w, [0])
+    assert w.flush()
+    ## A save of another table does not forget how the calendar rows were renumbered
+    w.submit(journal.upsert('country_calls', calendar('z').set_axis([2])))
+    assert w.flush()
+    edit(w, 2, 'C')
+    w.track('country_calls', backend.read_table('country_calls'))
+    reloaded = w.track('calendar', backend.read_table('calendar'))
+    assert reloaded.remarks.tolist() == ['b', 'C']
+
+
+def test_conflicting_change_dropped_on_reload(backend, tmp_path):
+    w = writer(backend, tmp_path)
+    edit(w, 1, 'B')
+    ## Someone else changed the row in the spreadsheet in the meantime
+    backend.tables['calendar'].loc[1, 'remarks'] = 'b2'
+    reloaded = w.track('calendar', backend.read_table('calendar'))
+    assert reloaded.remarks.tolist() == ['a', 'b2', 'c', 'd', 'e']
+    assert w.journal.pending() == []
+
+
+def test_apply_mutation_is_idempotent():
+    data = calendar('a', 'b')
+    entry = journal.upsert('calendar', calendar('c').set_axis([2]))
+    once = journal.apply_mutation(data, entry)
+    assert journal.apply_mutation(once, entry).equals(once)
+    removed = journal.apply_mutation(once, journal.delete('calendar', [0]))
+    assert journal.apply_mutation(removed, journal.delete('calendar', [0])).equals(removed)
+
+
+def test_failed_save_noticed_until_saved(backend, tmp_path):
+    w = writer(backend, tmp_path)
+    start = w.journal.notices()[1]
+    write_table = backend.write_table
+    backend.write_table = lambda name, data: (_ for _ in ()).throw(ConnectionError('offline'))
+    edit(w, 0, 'A')
+    assert not w.flush() and not w.flush()
+    notices, offset = w.journal.notices(start)
+    assert [(n['kind'], n['tables']) for n in notices] == [('failed', ['calendar'])]
+
+    backend.write_table = write_table
+    assert w.flush()
+    notices, _ = w.journal.notices(offset)
+    assert [n['kind'] for n in notices] == ['saved']
+    assert saved(backend)[0] == 'A'
+
+
+def test_conflicting_change_noticed_to_its_author(backend, tmp_path):
+    w = writer(backend, tmp_path)
+    start = w.journal.notices()[1]
+    data = w.tables['calendar']
+    w.submit(journal.upsert('calendar', data.loc[[1]].assign(remarks='B'), journal.row_versions(data, [1]), origin='session-1'))
+    backend.tables['calendar'].loc[1, 'remarks'] = 'b2'
+    w.track('calendar', backend.read_table('calendar'))
+    notices, _ = w.journal.notices(start)
+    assert [(n['kind'], n['origin'], n['labels']) for n in notices] == [('rejected', 'session-1', [1])]
@@ -0,0 +1,73 @@
+import random
+
+import numpy as np
+import pandas as pd
+
+from occupancy import Occupancy
+
+### Incremental updates of the occupancy matrix (occupancy.Occupancy) ###
+## After every change the matrix must be the one built from scratch, and the busy days a day by day count.
+
+ADVISORS = ['AB', 'CD', 'EF', 'GH']
+TYPES = ['Mission', 'Leave', 'Remote']
+
+
+def event(rng):
+    start = pd.Timestamp(2024, 1, 1) + pd.Timedelta(days=rng.randrange(0, 330))
+    return {
+        'advisor': rng.choice(ADVISORS), 'type': rng.choice(TYPES),
+        'start_date': start, 'end_date': start + pd.Timedelta(days=rng.randrange(0, 20)),
+    }
+
+def change(rng, data):
+    """Add, edit or delete a few events, as the dashboard does (index labels of the remaining rows kept)."""
+    for _ in range(rng.randrange(1, 4)):
+        kind = rng.choice(['add', 'edit', 'delete'])
+        if kind == 'add' or data.empty:
+            data = pd.concat([data, pd.DataFrame([event(rng)], index=[data.index.max() + 1])])
+        elif kind == 'edit':
+            data = data.copy()
+            data.loc[rng.choice(data.index)] = pd.Series(event(rng))
+        else:
+            data = data.drop(rng.choice(data.index))
+    return data
+
+def busy_days(data, advisor, start, end):
+    """Business days (Mon-Fri) from start to end with at least one event of the advisor, day by day."""
+    events = data[data.advisor == advisor]
+    return sum(
+        day.weekday() < 5 and bool(((events.start_date <= day) & (events.end_date >= day)).any())
+        for day in pd.date_range(start, end)
+    )
+
+
+def test_incremental_updates_match_a_rebuild():
+    rng = random.Random(5)
+    data = pd.DataFrame([event(rng) for _ in range(60)])
+    occupancy = Occupancy().update(data)
+    builds = []
+    occupancy._build = lambda *args, build=occupancy._build: builds.append(None) or build(*args)
+
+    for _ in range(40):
+        data = change(rng, data)
+        occupancy.update(data)
+        rebuilt = Occupancy().update(data)
+        assert occupancy.advisors == rebuilt.advisors
+        np.testing.assert_array_equal(occupancy.days, rebuilt.days)
+        np.testing.assert_array_equal(occupancy.counts, rebuilt.counts)
+        np.testing.assert_array_equal(occupancy.codes, rebuilt.codes)
+        np.testing.assert_array_equal(occupancy.busy_cum, rebuilt.busy_cum)
+    ## The changes were applied in place, not by rebuilding the matrix
+    assert builds == []
+
+
+def test_busy_days_match_a_day_by_day_count():
+    rng = random.Random(6)
+    data = pd.DataFrame([event(rng) for _ in range(40)])
+    occupancy = Occupancy().update(data)
+    for _ in range(5):
+        data = change(rng, data)
+        occupancy.update(data)
+    for start, end in [('2024-01-01', '2024-01-31'), ('2024-03-10', '2024-06-20'), ('2024-12-20', '2025-01-10')]:
+        expected = [busy_days(data, advisor, start, end) for advisor in occupancy.advisors]
+        assert occupancy.busy_days(start, end).tolist() == expected
@@ -0,0 +1,40 @@
+import pandas as pd
+
+from shared import SharedStore
+
+### Tables shared by the workers (shared.SharedStore) ###
+## A second store on the same directory stands for another worker.
+
+
+def calendar(*remarks):
+    return pd.DataFrame({
+        'advisor': pd.Categorical(['AB', 'CD', 'AB'][:len(remarks)]),
+        'start_date': pd.to_datetime(['2024-01-02', '2024-02-05', '2024-03-04'][:len(remarks)]),
+        'days': [3, 5, 1][:len(remarks)],
+        'remarks': list(remarks),
+    }, index=[4, 7, 9][:len(remarks)])
+
+
+def test_published_table_is_loaded_back_by_another_worker(tmp_path):
+    store, other = SharedStore(tmp_path), SharedStore(tmp_path)
+    data = calendar('a', None, 'c')
+    version = store.publish('calendar', data)
+    assert other.manifest() == {'calendar': version}
+    pd.testing.assert_frame_equal(other.load('calendar', version), data)
+
+
+def test_each_publication_is_a_new_version(tmp_path):
+    store, other = SharedStore(tmp_path), SharedStore(tmp_path)
+    versions = [store.publish('calendar', calendar(*'abc'[:size])) for size in (1, 2, 3)]
+    other.publish('advisors', pd.DataFrame({'short_name': ['AB']}))
+    assert versions == [1, 2, 3]
+    assert store.manifest() == {'calendar': 3, 'advisors': 1}
+    pd.testing.assert_frame_equal(other.load('calendar', 3), calendar(*'abc'))
+    ## The previous version is kept for the workers still reading it, older ones are deleted
+    assert sorted(path.name for path in tmp_path.glob('calendar.*.arrow')) == ['calendar.2.arrow', 'calendar.3.arrow']
+
+
+def test_table_that_arrow_cannot_store_is_not_published(tmp_path):
+    store = SharedStore(tmp_path)
+    assert store.publish('calendar', pd.DataFrame({'remarks': ['a', 1]})) is None
+    assert store.manifest() == {}
@@ -0,0 +1,72 @@
+import pandas as pd
+
+import storage
+
+### Incremental updates sent to Google Sheets (storage.diff_requests) ###
+## Positions in the requests count the header row: the first data row is row 1.
+
+SHEET = 7
+
+
+def table(remarks, index=None):
+    return pd.DataFrame({'advisor': ['AB'] * len(remarks), 'remarks': list(remarks)}, index=index)
+
+def kinds(requests):
+    return [next(iter(request)) for request in requests]
+
+def values(rows):
+    return [[cell['userEnteredValue']['stringValue'] for cell in row['values']] for row in rows]
+
+
+def test_unchanged_table_sends_nothing():
+    previous = table('abc')
+    assert storage.diff_requests(SHEET, previous, previous.copy()) == []
+
+
+def test_update_sends_the_changed_rows_only():
+    previous = table('abcd')
+    requests = storage.diff_requests(SHEET, previous, table(['a', 'B', 'C', 'd']))
+    assert kinds(requests) == ['updateCells']
+    assert requests[0]['updateCells']['start'] == {'sheetId': SHEET, 'rowIndex': 2, 'columnIndex': 0}
+    assert values(requests[0]['updateCells']['rows']) == [['AB', 'B'], ['AB', 'C']]
+
+
+def test_delete_runs_from_the_bottom_up():
+    previous = table('abcdef')
+    requests = storage.diff_requests(SHEET, previous, previous.drop(index=[1, 2, 4]))
+    assert kinds(requests) == ['deleteDimension', 'deleteDimension']
+    ranges = [(r['deleteDimension']['range']['startIndex'], r['deleteDimension']['range']['endIndex']) for r in requests]
+    assert ranges == [(5, 6), (2, 4)]
+
+
+def test_append_sends_the_new_rows():
+    previous = table('ab')
+    requests = storage.diff_requests(SHEET, previous, table('abcd'))
+    assert kinds(requests) == ['appendCells']
+    assert values(requests[0]['appendCells']['rows']) == [['AB', 'c'], ['AB', 'd']]
+
+
+def test_delete_update_and_append_together():
+    previous = table('abcd')
+    data = pd.concat([previous.drop(index=[0]).assign(remarks=['b', 'C', 'd']), table('e', index=[4])])
+    requests = storage.diff_requests(SHEET, previous, data)
+    assert kinds(requests) == ['deleteDimension', 'updateCells', 'appendCells']
+    ## Updates are positioned after the deletion: 'c' moved from row 3 to row 2
+    assert requests[1]['updateCells']['start']['rowIndex'] == 2
+    assert values(requests[2]['appendCells']['rows']) == [['AB', 'e']]
+
+
+def test_reordered_or_inserted_rows_need_a_full_rewrite():
+    previous = table('abc')
+    assert storage.diff_requests(SHEET, previous, previous.iloc[[1, 0, 2]]) is None
+    inserted = pd.concat([previous.iloc[:1], table('x', index=[5]), previous.iloc[1:]])
+    assert storage.diff_requests(SHEET, previous, inserted) is None
+    assert storage.diff_requests(SHEET, previous, previous.assign(type='Mission')) is None
+
+
+def test_dates_are_sent_as_serial_numbers():
+    previous = pd.DataFrame({'date': pd.to_datetime(['2024-01-01'])})
+    requests = storage.diff_requests(SHEET, previous, pd.DataFrame({'date': pd.to_datetime(['2024-01-02'])}))
+    cell = requests[0]['updateCells']['rows'][0]['values'][0]
+    assert cell['userEnteredValue']['numberValue'] == (pd.Timestamp('2024-01-02') - storage.SHEETS_EPOCH).days
+    assert cell['userEnteredFormat'] == storage.DATE_FORMAT
@@ -0,0 +1,59 @@
+import time
+import threading
+
+import pandas as pd
+
+import tables
+
+### Loading of the table registry ###
+
+
+class Backend:
+    """Slow reads, so that concurrent first accesses overlap."""
+
+    def __init__(self, delay=0.2):
+        self.delay = delay
+        self.reads = 0
+
+    def remote_version(self):
+        return 1
+
+    def read_tables(self, names):
+        self.reads += 1
+        time.sleep(self.delay)
+        return {name: pd.DataFrame({'name': [name]}) for name in names}
+
+
+def registry(backend, on_load=None):
+    parsers = {name: lambda data: data for name in ['calendar', 'advisors', 'types', 'countries']}
+    return tables.TableRegistry(backend, parsers, groups=[['calendar', 'advisors', 'types'], ['countries']], on_load=on_load)
+
+
+def test_concurrent_first_accesses_load_the_group_once():
+    backend = Backend()
+    r = registry(backend)
+    threads = [threading.Thread(target=r.get, args=(name,), daemon=True) for name in ['calendar', 'advisors', 'types']]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+    assert not any(thread.is_alive() for thread in threads)
+    assert backend.reads == 1
+    assert all(r.is_loaded(name) for name in ['calendar', 'advisors', 'types'])
+    assert not r.is_loaded('countries')
+
+
+def test_change_stored_during_a_reload_is_kept():
+    ## A change stored right after the reloaded table (e.g. a submit after WriteBehind.track) is not overwritten
+    r, loads = None, []
+    def on_load(name, data):
+        r[name] = data
+        if loads:
+            r[name] = data.assign(name='edited')
+        loads.append(name)
+        return data
+    r = registry(Backend(delay=0), on_load)
+    r.get('countries')
+    r.refresh(['countries'])
+    assert r.get('countries').name.tolist() == ['edited']
+    assert r.version('countries') == 1